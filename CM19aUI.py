@@ -5,8 +5,11 @@ A simple and not very pretty user interface for my Python driver for the CM19a X
 
 Functionality
  - Send ON/OFF/DIM/BRIGHT commands wirelessly to any X10 device via the CM19a (requires a transceiver)
+ - Shows the commands received from X10 RF remotes as they arrive
  - Displays some basic info about the device
 
+Commands are sent on a background thread so the window stays responsive while the CM19a is busy
+
 Requires my CM19a driver version 0.11 or above
 
 Version 3.00
@@ -18,7 +21,7 @@ Requires tkinter 8.4 or later (on Ubuntu: sudo apt-get install python-tk)
 
 """
 
-import time
+import time, threading, Queue
 
 from Tkinter import *
 import tkMessageBox
@@ -28,6 +31,10 @@ import CM19aDriver
 class App:
     def __init__(self, master):
         # Construct the App object
+        self.master = master
+        self.sendqueue = Queue.Queue()          # Commands waiting to be sent by the send worker
+        self.results = Queue.Queue()            # Results from the send worker (shown by poll)
+        self.received = Queue.Queue()           # Commands received from RF remotes (shown by poll)
 
         self.statusText = StringVar()
         self.statusText.set("Starting up...")
@@ -62,6 +69,12 @@ class App:
         self.statusTextLabel = Label(group2,  textvariable=self.statusText, anchor=W, justify=LEFT,  relief=FLAT,  fg="blue",  width=60)
         self.statusTextLabel.pack(side=LEFT)
 
+        # Add another frame widget for the commands received from RF remotes
+        group5 = LabelFrame(master, text="Received", padx=5, pady=5)
+        group5.pack()
+        self.eventList = Listbox(group5, height=EVENT_LIST_HEIGHT, width=60)
+        self.eventList.pack(side=LEFT)
+
         # Add another (invisible) frame widget for the quit and queue buttons
         group3 = Frame(master)
         group3.pack()
@@ -90,15 +103,46 @@ class App:
 
         self.statusText.set("Ready.. Select a house code, unit and then click an action button.")
 
+        # Start the send worker and listen for commands received
+        worker = threading.Thread(target=self.sendWorker)
+        worker.setDaemon(True)
+        worker.start()
+        self.subscriber = cm19a.subscribe(self.received.put, maxbacklog=EVENT_LIST_LENGTH)
+        self.master.after(POLL_INTERVAL, self.poll)
+
 
     def x10command(self,  cmd):
-        print "Doing command %s on %s%s" % (cmd, self.house.get(), self.unit.get())
-        result = cm19a.send(self.house.get(), self.unit.get(), cmd)       # True if the command was sent OK
-        if not result:
-            tkMessageBox.showerror("Cm19a UI","Command Failed:\n")
-            self.statusText.set("Command %s on %s%s FAILED!" % (cmd, self.house.get(), self.unit.get()))
-        else:
-            self.statusText.set("Command %s on %s%s sent OK!" % (cmd, self.house.get(), self.unit.get()))
+        # Queue the command for the send worker so the window does not freeze while it is sent
+        house, unit = self.house.get(), self.unit.get()
+        print "Doing command %s on %s%s" % (cmd, house, unit)
+        self.sendqueue.put((house, unit, cmd))
+        self.statusText.set("Sending %s to %s%s..." % (cmd, house, unit))
+
+    def sendWorker(self):
+        # Runs in a background thread: sends each queued command (Tk must not be used from here)
+        while True:
+            house, unit, cmd = self.sendqueue.get()
+            result = cm19a.send(house, unit, cmd)       # True if the command was sent OK
+            self.results.put((house, unit, cmd, result))
+
+    def poll(self):
+        # Runs in the Tk thread every POLL_INTERVAL ms to show send results and received commands
+        while not self.results.empty():
+            house, unit, cmd, result = self.results.get()
+            if not result:
+                self.statusText.set("Command %s on %s%s FAILED!" % (cmd, house, unit))
+                tkMessageBox.showerror("Cm19a UI","Command Failed:\n")
+            else:
+                self.statusText.set("Command %s on %s%s sent OK!" % (cmd, house, unit))
+
+        while not self.received.empty():
+            self.eventList.insert(END, "%s  %s" % (time.strftime("%H:%M:%S"), self.received.get()))
+        if self.eventList.size() > EVENT_LIST_LENGTH:
+            # Only keep the latest commands
+            self.eventList.delete(0, self.eventList.size() - EVENT_LIST_LENGTH - 1)
+        self.eventList.see(END)
+
+        self.master.after(POLL_INTERVAL, self.poll)
 
     def cm19aGetReceiveQueue(self):
         queue = cm19a.getReceiveQueue()
@@ -114,7 +158,10 @@ class App:
 VERSION = "3.00"
 POLLFREQ = 1
 WINDOW_WIDTH = 600
-WINDOW_HEIGHT = 300
+WINDOW_HEIGHT = 450
+POLL_INTERVAL = 100         # ms between checks for send results and received commands
+EVENT_LIST_HEIGHT = 8       # Number of received commands visible at once
+EVENT_LIST_LENGTH = 100     # Maximum number of received commands kept in the list
 
 # Create the root widget for the application
 root = Tk()
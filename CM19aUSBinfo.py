@@ -3,6 +3,7 @@
 """
 Scans through the USB busses and devices to detect a CM19a X10 USB Transceiver
 If a CM19a is found it prints out the device information
+Every CM19a plugged in is listed with its port, bus and device number (found quickly from sysfs on Linux)
 
 Andrew Cuddon August 2009
 
@@ -25,6 +26,7 @@ NOTES:
 """
 
 import usb
+import cm19adriver
 
 ENDPOINT_TYPE = ["Control", "ISOCHRONOUS",  "BULK",  "INTERRUPT"  ]
 DEVICE_CLASS = ["Vendor Specific"] * 256
@@ -37,57 +39,81 @@ DEVICE_CLASS [8] = "Mass Storage"
 DEVICE_CLASS [9] = "Hub"
 DEVICE_CLASS [10] = "Data"
 
-busses = usb.busses()               # busses is a tuple/list of USB buses (bus objects) on the machine
+VENDOR_ID = cm19adriver.CM19aDevice.VENDOR_ID
+PRODUCT_ID = cm19adriver.CM19aDevice.PRODUCT_ID
+
+
+def print_device(dev):
+    print "  Device Number(dev.filename):", dev.filename
+    print "    Device class: %d (%s)" % (dev.deviceClass,  DEVICE_CLASS[dev.deviceClass])
+    print "    Device sub class: %d (%s)" % (dev.deviceSubClass,  DEVICE_CLASS[dev.deviceSubClass])
+    print "    Device protocol:",dev.deviceProtocol
+    print "    Max packet size for Endpoint 0:", dev.maxPacketSize
+    print "    Vendor ID (dev.idVendor): %d (%04x hex)" % (dev.idVendor, dev.idVendor)
+    print "    Product ID (dev.idProduct): %d (%04x hex)" % (dev.idProduct, dev.idProduct)
+    print "    Device Version:",dev.deviceVersion
+    #print "    Manufacturer (dev.iManufacturer): %d, %s" %  (dev.iManufacturer,  dev.open().getString(dev.iManufacturer,50))
+    #print "    Product (dev.iProduct): %d, %s" %  (dev.iProduct,  dev.open().getString(dev.iProduct,50))
+    #print "    SerialNumber (dev.iSerialNumber):  %d, %s" %  (dev.iSerialNumber,  dev.open().getString(dev.iSerialNumber,50))
+    print "    usbVersion: ",  dev.usbVersion
+    print "    Number of Configurations: ",  len(dev.configurations)
+    for config in dev.configurations:
+        print "    Configuration:", config.value
+        print "      Total length:", config.totalLength
+        print "      selfPowered:", config.selfPowered
+        print "      remoteWakeup:", config.remoteWakeup
+        print "      maxPower:", config.maxPower
+        print "      Configuration Description: ",  config.iConfiguration
+        print "      Number of Interfaces: ",  len(config.interfaces)
+        print "      Interface tuple: ",  config.interfaces             # --> Tupe of a tuple of interface objects
+        for intf in config.interfaces:
+            # intf is a tuple where each item is a tuple of alternative settings (which are actually interface objects)
+            for alt in intf:
+                # alt is an interface object
+                print "      Interface Number: ", alt.interfaceNumber
+                print "      Alternate Setting Number:",alt.alternateSetting
+                print "        Interface class: %d (%s)" % (alt.interfaceClass,  DEVICE_CLASS[alt.interfaceClass])
+                print "        Interface sub class: %d (%s)" % (alt.interfaceSubClass,  DEVICE_CLASS[alt.interfaceSubClass])
+                print "        Interface protocol:",alt.interfaceProtocol
+                print "        Number of end points: ",  len(alt.endpoints)
+                print "        Endpoint tuple: ",  alt.endpoints
+                for ep in alt.endpoints:
+                    print "        Endpoint address: %d (%04x hex)" % (ep.address,  ep.address)
+                    print "          Type: %d (%s):" % (ep.type, ENDPOINT_TYPE[ep.type])
+                    print "          Max packet size: %d bytes" % ep.maxPacketSize
+                    print "         Interval:",ep.interval
+
 
 print "Extracting info..."
-for bus in busses:                  # bus is a bus object
-    print "\nBus number (bus.dirname): %s" % bus.dirname
-    # print "  Bus Location (bus.location): %s" % bus.location
+cm19as = []                         # [(where it was found, device object)]
 
-    devices = bus.devices           # devices is a tuple/list of the devices on a bus
-    for dev in devices: # dev is a device object
-        if dev.idVendor <> 0x0bc7:
+# Quick search: find every CM19a in sysfs (Linux) and look up just those devices
+found = cm19adriver.find_devices(VENDOR_ID, PRODUCT_ID)
+if found is not None:
+    print "%d CM19a found in sysfs" % len(found)
+    for port, busnum, address in found:
+        print "  Port %s: bus %03d, device %03d" % (port, busnum, address)
+        dev = cm19adriver.pyusb_device(busnum, address, VENDOR_ID, PRODUCT_ID)
+        if dev:
+            cm19as.append(("Port %s (bus %03d, device %03d)" % (port, busnum, address), dev))
+
+if found is None or (found and not cm19as):
+    # Not Linux (or sysfs cannot be read) or pyUSB 0.4 so scan every device on every bus
+    # (if sysfs lists no CM19a then none is plugged in and the slow scan would not find one either)
+    busses = usb.busses()               # busses is a tuple/list of USB buses (bus objects) on the machine
+    for bus in busses:                  # bus is a bus object
+        print "\nBus number (bus.dirname): %s" % bus.dirname
+        # print "  Bus Location (bus.location): %s" % bus.location
+
+        devices = bus.devices           # devices is a tuple/list of the devices on a bus
+        matches = [dev for dev in devices if dev.idVendor == VENDOR_ID and dev.idProduct == PRODUCT_ID]
+        if not matches:
             print "No CM19a found on this USB bus."
-            break
-
-        print "CM19a found:"
-        print "  Device Number(dev.filename):", dev.filename
-        print "    Device class: %d (%s)" % (dev.deviceClass,  DEVICE_CLASS[dev.deviceClass])
-        print "    Device sub class: %d (%s)" % (dev.deviceSubClass,  DEVICE_CLASS[dev.deviceSubClass])
-        print "    Device protocol:",dev.deviceProtocol
-        print "    Max packet size for Endpoint 0:", dev.maxPacketSize
-        print "    Vendor ID (dev.idVendor): %d (%04x hex)" % (dev.idVendor, dev.idVendor)
-        print "    Product ID (dev.idProduct): %d (%04x hex)" % (dev.idProduct, dev.idProduct)
-        print "    Device Version:",dev.deviceVersion
-        #print "    Manufacturer (dev.iManufacturer): %d, %s" %  (dev.iManufacturer,  dev.open().getString(dev.iManufacturer,50))
-        #print "    Product (dev.iProduct): %d, %s" %  (dev.iProduct,  dev.open().getString(dev.iProduct,50))
-        #print "    SerialNumber (dev.iSerialNumber):  %d, %s" %  (dev.iSerialNumber,  dev.open().getString(dev.iSerialNumber,50))
-        print "    usbVersion: ",  dev.usbVersion
-        print "    Number of Configurations: ",  len(dev.configurations)
-        for config in dev.configurations:
-            print "    Configuration:", config.value
-            print "      Total length:", config.totalLength
-            print "      selfPowered:", config.selfPowered
-            print "      remoteWakeup:", config.remoteWakeup
-            print "      maxPower:", config.maxPower
-            print "      Configuration Description: ",  config.iConfiguration
-            print "      Number of Interfaces: ",  len(config.interfaces)
-            print "      Interface tuple: ",  config.interfaces             # --> Tupe of a tuple of interface objects
-            for intf in config.interfaces:
-                # intf is a tuple where each item is a tuple of alternative settings (which are actually interface objects)
-                for alt in intf:
-                    # alt is an interface object
-                    print "      Interface Number: ", alt.interfaceNumber
-                    print "      Alternate Setting Number:",alt.alternateSetting
-                    print "        Interface class: %d (%s)" % (alt.interfaceClass,  DEVICE_CLASS[alt.interfaceClass])
-                    print "        Interface sub class: %d (%s)" % (alt.interfaceSubClass,  DEVICE_CLASS[alt.interfaceSubClass])
-                    print "        Interface protocol:",alt.interfaceProtocol
-                    print "        Number of end points: ",  len(alt.endpoints)
-                    print "        Endpoint tuple: ",  alt.endpoints
-                    for ep in alt.endpoints:
-                        print "        Endpoint address: %d (%04x hex)" % (ep.address,  ep.address)
-                        print "          Type: %d (%s):" % (ep.type, ENDPOINT_TYPE[ep.type])
-                        print "          Max packet size: %d bytes" % ep.maxPacketSize
-                        print "         Interval:",ep.interval
+        for dev in matches:
+            cm19as.append(("Bus %s" % bus.dirname, dev))
+
+for where, dev in cm19as:
+    print "\nCM19a found: %s" % where
+    print_device(dev)
 
 raw_input("Press Enter to finish")
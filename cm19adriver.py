@@ -83,6 +83,8 @@ TTDs
 # *************** CONFIGURATION ***************
 
 LOGFILE = './cm19a.log'             # Path and filename for the logfile
+LOG_MAX_BYTES = 1024 * 1024         # The log is rotated when it reaches this size (0 = never)
+LOG_BACKUPS = 5                     # Number of rotated logs kept (cm19a.log.1 ...)
 
 #MODE = 'Command Line'              # Mode of operation: either 'Command Line', 'HTTP Server'
 MODE = 'HTTP Server'
@@ -90,6 +92,27 @@ MODE = 'HTTP Server'
 # Required only if MODE == 'HTTP Server'
 SERVER_IP_ADDRESS = '192.168.1.3'              # Set SERVERIP to the IP address of the server
 SERVER_PORT = 8008                             # Consider firewall rules if any
+HTTP_IDLE_TIMEOUT = 30                         # Seconds an idle keep-alive connection is held open
+HTTP_MAX_CONNECTIONS = 20                      # Maximum number of open connections (any more are refused with a 503)
+CAPTURE_FILE = './cm19a.trace'                 # Raw reads are recorded here after ?command=startcapture (replay with cm19atrace.py)
+HTTP_RATE = 20                                 # Requests a second allowed from each client (0 = no limit), any more get a 429
+HTTP_BURST = 40                                # ... with bursts of up to this many
+HTTP_MAX_SENDS = 8                             # Sends in progress at once (0 = no limit), any more get a 503
+HTTP_LOG_TAIL = 64 * 1024                      # ?command=getlog returns at most the last this many bytes of the log
+JOURNAL_DIR = None                             # Every command sent and received is journalled here, eg './journal' (None = no journal, see cm19ajournal.py)
+JOURNAL_MAX_BYTES = 1024 * 1024                # A new journal segment is started when the current one reaches this size
+JOURNAL_MAX_AGE = 24 * 60 * 60                 # ... or is this many seconds old
+JOURNAL_SEGMENTS = 10                          # Number of journal segments kept
+HISTORY_DB = None                              # SQLite database of every command sent and received, eg './cm19a.db' (None = no history, see cm19ahistory.py)
+HISTORY_MAX_AGE = 365 * 24 * 60 * 60           # Commands older than this many seconds are deleted from the history
+TRACE_LOG = './cm19a.timing.log'               # The time each stage of every HTTP command took, by correlation id (None = not logged)
+
+UDP_PORT = None                                # Port for command datagrams, eg 8009 (None = no UDP listener, see cm19audp.py)
+HTTP_WORKERS = 0                               # Number of processes handling HTTP requests (0 = handle them in the driver process, see cm19aproxy.py)
+SHUTDOWN_TIMEOUT = 10                          # Seconds allowed for requests and sends in progress to finish when shutting down
+
+# Command line mode only
+SHOW_STARTUP_TIMING = False                    # Print how long each startup stage took (it is always logged)
 
 # Required only for HTTP Server and importing into another script
 REFRESH = 1.0               # Refresh rate (seconds) for polling the transceiver for inbound commands
@@ -99,27 +122,141 @@ REFRESH = 1.0               # Refresh rate (seconds) for polling the transceiver
 VERSION = "3.00"
 
 # Standard modules
-import sys, time, os, threading, types
-import socket, BaseHTTPServer, httplib
+# (modules needed by only one mode, eg the HTTP server in cm19ahttp.py and the logger, are imported when that mode starts)
+import sys, time, os, threading, types, fnmatch, collections, Queue, array, errno
 
 # pyUSB 1.0 (for libUSB 1.0 series)
-import usb
-
-# Code Modules
-import logger
+_start = time.time()
+try:
+    import usb
+except ImportError:
+    usb = None          # Only needed to open the CM19a (not to replay a trace through a handle, see cm19atrace.py)
+USB_IMPORT_TIME = time.time() - _start      # Reported with the other startup stages
 
 # Globals
 global cm19a, log, server
 
+
+def _acquire(lock, timeout):
+    # lock.acquire() that gives up after 'timeout' seconds (Python 2 locks have no timeout), returns True if acquired
+    deadline = time.time() + timeout
+    while not lock.acquire(False):
+        if time.time() >= deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+def _is_timeout(err):
+    # True if a USB error is just a read/write timing out rather than a real error
+    # (pyUSB 1.0 sets errno or the libusb error code, libusb 0.1 only gives a message)
+    if getattr(err, 'errno', None) == errno.ETIMEDOUT or getattr(err, 'backend_error_code', None) == -7:
+        return True
+    return 'timed out' in str(err).lower() or 'timeout' in str(err).lower()
+
+SYSFS_USB_DEVICES = "/sys/bus/usb/devices"      # Where Linux lists the USB devices (one directory per port, eg 1-1.2)
+
+
+def find_devices(vendor_id, product_id):
+    """
+        Returns [(port, bus number, device address)] for every USB device with the vendor and product id (eg every CM19a plugged in)
+        Only the id files in sysfs are read so no device is opened and other devices are not touched
+        Returns None if sysfs is not available (ie not Linux) or cannot be read
+    """
+    try:
+        ports = [port for port in os.listdir(SYSFS_USB_DEVICES) if ":" not in port]      # (not the interfaces, eg 1-1.2:1.0)
+    except OSError:
+        return None
+    if not ports:
+        # not even the root hubs (usb1...) are listed so sysfs cannot be relied on
+        return None
+
+    found = []
+    for port in sorted(ports):
+        device = _sysfs_device(port, vendor_id, product_id)
+        if device:
+            found.append(device)
+    #end for
+    return found
+
+
+def _sysfs_device(port, vendor_id, product_id):
+    # Returns (port, bus number, device address) if the USB device on 'port' has the vendor and product id, otherwise None
+    path = os.path.join(SYSFS_USB_DEVICES, port)
+    try:
+        if int(_read_sysfs(path, "idVendor"), 16) != vendor_id or int(_read_sysfs(path, "idProduct"), 16) != product_id:
+            return None
+        return port, int(_read_sysfs(path, "busnum")), int(_read_sysfs(path, "devnum"))
+    except (IOError, OSError, ValueError):
+        # nothing on the port (any more) or not a device
+        return None
+
+
+def _read_sysfs(path, name):
+    f = open(os.path.join(path, name), "r")
+    try:
+        return f.read().strip()
+    finally:
+        f.close()
+
+
+def pyusb_device(bus, address, vendor_id, product_id):
+    """
+        Returns the pyUSB (legacy API) device at the bus number and device address or None if there isn't one
+        pyUSB 1.0 looks up just that device rather than building every device on every bus as usb.busses() does
+    """
+    try:
+        import usb.core, usb.legacy
+    except ImportError:
+        # pyUSB 0.4 (only the legacy API)
+        return None
+    try:
+        dev = usb.core.find(idVendor=vendor_id, idProduct=product_id, bus=bus, address=address)
+    except usb.core.USBError:
+        return None
+    if dev is None:
+        return None
+    return usb.legacy.Device(dev)
+
+
 class USBdevice:
-    def __init__(self, vendor_id, product_id) :
+    def __init__(self, vendor_id, product_id, cachefile=None) :
         self.vendor_id = vendor_id
         self.product_id = product_id
+        self.cachefile = cachefile      # Remembers the port the device was found on so the next run checks it first
         self.bus = None
         self.device = None
+        self.port = None                # eg 1-1.2 (None if found by searching the busses)
+        self.busnum = None
+        self.address = None
+        self.found = []                 # [(port, bus number, device address)] of every matching device found in sysfs
         self._find_device()
 
     def _find_device(self):
+        # Check the port the device was on last time, then look through sysfs for the device
+        # (both much quicker than enumerating every device with pyUSB)
+        # The USB busses are only searched if sysfs is not available or pyUSB cannot look up the device found (pyUSB 0.4)
+        cached = self._cached_port()
+        if cached:
+            self.found = [cached]
+        else:
+            found = find_devices(self.vendor_id, self.product_id)
+            if found == []:
+                # sysfs lists every USB device and none of them is a CM19a, so it is not plugged in
+                return
+            self.found = found or []
+
+        for port, busnum, address in self.found:
+            device = pyusb_device(busnum, address, self.vendor_id, self.product_id)
+            if device:
+                self.device = device
+                self.port, self.busnum, self.address = port, busnum, address
+                self._cache_port()
+                return
+        #end for
+
+        self._search_busses()
+
+    def _search_busses(self):
         # Search across all USB busses for the nominated device
         # Finishes searching when the first matching device is found
         buses = usb.busses()
@@ -135,6 +272,35 @@ class USBdevice:
                 break
         #end for loop
 
+    def _cached_port(self):
+        # Returns (port, bus number, device address) if the device is still on the cached port
+        if not self.cachefile or not os.path.isfile(self.cachefile):
+            return None
+        try:
+            f = open(self.cachefile, "r")
+            try:
+                port = f.read().strip()
+            finally:
+                f.close()
+        except IOError:
+            return None
+        if not port or "/" in port:
+            return None
+        return _sysfs_device(port, self.vendor_id, self.product_id)
+
+    def _cache_port(self):
+        if not self.cachefile:
+            return
+        try:
+            f = open(self.cachefile, "w")
+            try:
+                f.write(self.port + "\n")
+            finally:
+                f.close()
+        except IOError:
+            # eg a read only directory, the device is simply found the slower way next time
+            pass
+
     def get_device(self):
         return self.device
 
@@ -144,6 +310,11 @@ class USBdevice:
             print "Device (%r, %r) not found" % (self.vendor_id, self.product_id)
             return
 
+        if self.port:
+            print "  Port: %s (bus %03d, device %03d)" % (self.port, self.busnum, self.address)
+        for port, busnum, address in self.found:
+            if port != self.port:
+                print "  Also found on port: %s (bus %03d, device %03d)" % (port, busnum, address)
         print "  Vendor ID (dev.idVendor): %d (%04x hex)" % (self.device.idVendor, self.device.idVendor)
         print "  Product ID (dev.idProduct): %d (%04x hex)" % (self.device.idProduct, self.device.idProduct)
         print "  Device Version:",self.device.deviceVersion
@@ -152,6 +323,167 @@ class USBdevice:
 #end of class
 
 
+class X10Frame(object):
+    """
+        A command from the protocol file (eg A1ON) with its byte sequence ready to write to the CM19a
+        'data' (a string of the bytes) is used to look up received byte sequences
+        'buffer' is passed straight to interruptWrite (pyUSB writes an array without converting it first)
+    """
+    __slots__ = ('house', 'unit', 'function', 'command', 'data', 'buffer')
+
+    def __init__(self, house, unit, function, sequence):
+        self.house = house
+        self.unit = unit
+        self.function = function
+        self.command = house + unit + function
+        self.buffer = array.array('B', sequence)
+        self.data = self.buffer.tostring()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def __repr__(self):
+        return "<X10Frame %s %s>" % (self.command, " ".join(["0x%02x" % b for b in self.buffer]))
+#end of class
+
+
+class X10Protocol:
+    """
+        The X10 protocol loaded from the protocol file
+            frames      {(house, unit, function): X10Frame}     Commands that can be sent
+            remote      {(house, unit, function): X10Frame}     Codes sent by X10 RF remotes (receive only)
+            commands    {command: X10Frame}                     Every command that can be decoded (eg A1ON, A0BRIGHTBUTTONPRESSED)
+            received    {bytes: X10Frame}                       Used to decode the bytes received (RF remote codes take precedence)
+            trie        {byte: {byte: ... {END: X10Frame}}}     'received' keyed one byte (int) at a time so a read buffer can be
+                                                                decoded without first turning it into a string
+    """
+
+    END = None          # Key of the frame in the trie node reached by its last byte
+
+    def __init__(self, fname=None):
+        self.frames = {}
+        self.remote = {}
+        self.commands = {}
+        self.received = {}
+        self.trie = {}
+        if fname:
+            self.load(fname)
+
+    def load(self, fname):
+        f = open(fname, "r")
+
+        section=None
+        for aline in f.readlines():
+            aline = aline.strip()
+            if not aline or aline[0] == "#":
+                # comment or blank line so ignore
+                pass
+            elif aline[0] == "[":
+                # new section
+                section = aline
+            elif section in ["[CM19A X10 CODES]", "[X10 RF REMOTE DIM/BRIGHT CODES]"]:
+                aline = aline.replace(" ", "")  # remove any whitespace
+                data = aline.split(',', 3)     # Comma separate data but keep the command sequence as a single string
+                house_code = data[0].upper()
+                unit_number = data[1]
+                on_off_dim = data[2].upper()
+                # Convert the command sequence from text to values (the text representation is hex)
+                frame = X10Frame(house_code, unit_number, on_off_dim, [int(b, 16) for b in data[3].split(',')])
+                if section == "[CM19A X10 CODES]":
+                    self.frames[(house_code, unit_number, on_off_dim)] = frame
+                    # Some commands share a byte sequence (eg several DIM codes) so the first in the file is used to decode it
+                    self.received.setdefault(frame.data, frame)
+                else:
+                    self.remote[(house_code, unit_number, on_off_dim)] = frame
+                self.commands[frame.command] = frame
+            elif section == "[OTHER]":
+                # Not required
+                pass
+            #endif
+        #end for
+
+        f.close()
+
+        # RF remote codes override the std x10 codes when decoding
+        for frame in self.remote.values():
+            self.received[frame.data] = frame
+
+        self.trie = {}
+        for frame in self.received.values():
+            node = self.trie
+            for b in frame.buffer:
+                node = node.setdefault(b, {})
+            node[self.END] = frame
+#end of class
+
+
+class USBTransport:
+    """
+        Reads and writes the CM19a through pyUSB 1.0's core API
+        The endpoints are looked up once when the device is opened and readinto() reads straight into a buffer
+        that is reused for every read, so no tuple is created for each packet received
+        Has the same methods as the legacy device handle used by the rest of the driver
+    """
+
+    def __init__(self, device, configuration, interface, alternate, readaddress, writeaddress):
+        import usb.util         # (usb.util is then available to the other methods)
+        self.device = device            # usb.core.Device
+        self.interface = interface
+        device.set_configuration(configuration)
+        usb.util.claim_interface(device, interface)
+        self.setAltInterface(alternate)
+        self.readendpoint = usb.util.find_descriptor(device.get_active_configuration()[(interface, alternate)], bEndpointAddress=readaddress)
+        self.writeendpoint = usb.util.find_descriptor(device.get_active_configuration()[(interface, alternate)], bEndpointAddress=writeaddress)
+        if self.readendpoint is None or self.writeendpoint is None:
+            raise usb.USBError("CM19a endpoints not found")
+        self.read = self.readendpoint.read      # (looked up once)
+
+    def readinto(self, buffer, timeout):
+        # Reads into 'buffer' (an array('B')), returns the number of bytes read
+        return self.read(buffer, timeout)
+
+    def interruptRead(self, endpoint, size, timeout):
+        return tuple(self.read(size, timeout))
+
+    def interruptWrite(self, endpoint, buffer, timeout):
+        return self.writeendpoint.write(buffer, timeout)
+
+    def claimInterface(self, interface):
+        usb.util.claim_interface(self.device, interface)
+
+    def releaseInterface(self):
+        usb.util.release_interface(self.device, self.interface)
+
+    def setAltInterface(self, alternate):
+        self.device.set_interface_altsetting(self.interface, alternate)
+
+    def reset(self):
+        self.device.reset()
+#end of class
+
+
+class LegacyHandle:
+    """
+        Adds readinto() to a device handle that only has interruptRead() (a pyUSB legacy handle, or one supplied by another script)
+        The bytes are still read into a new tuple but are then copied into the buffer the driver reuses
+    """
+
+    def __init__(self, handle, readaddress):
+        self.handle = handle
+        self.readaddress = readaddress
+
+    def readinto(self, buffer, timeout):
+        data = self.handle.interruptRead(self.readaddress, len(buffer), timeout)
+        count = len(data)
+        buffer[:count] = array.array('B', data)
+        return count
+
+    def __getattr__(self, name):
+        # everything else is passed straight to the handle
+        return getattr(self.handle, name)
+#end of class
+
+
 class CM19aDevice(threading.Thread):
     # subclasses the Thread class from the threading module
 
@@ -165,13 +497,40 @@ class CM19aDevice(threading.Thread):
     WRITE_EP_ADDRESS  = 0x002       # Endpoint for writing to the device: 2  (decimal)
     PACKET_LENGTH = 8               # Maximum packet length is 8 bytes (possibly 5 for std X10 remotes)
     ACK = 0x0FF                     # Bit string received on CM19a send success = 11111111 (binary) = 255 (decimal)
+    REMOTE_INIT_SEQUENCES = [       # Sequences that initialise the CM19a for wireless remote controls
+        array.array('B', [0x020,0x034,0x0cb,0x058,0x0a7]),                          # 5 byte sequence (interestingly this is the same sequence as P16 ON)
+        array.array('B', [0x080,0x001,0x000,0x020,0x014]),                          # 5 byte sequence
+        array.array('B', [0x080,0x001,0x000,0x000,0x014,0x024,0x020,0x020]),        # 8 byte sequence
+    ]
 
+    USE_CORE_API = True             # Use pyUSB 1.0's core API when it is available (reads go straight into a reused buffer)
     SEND_TIMEOUT = 1000             # 1000 ms = 1s
     RECEIVE_TIMEOUT = 100           # 100 ms
+    VERIFY_ACK = True               # Wait for the CM19a to acknowledge each send (and retry ON/OFF if it does not, see RETRY_FUNCTIONS)
+                                    # On a unit that does not ACK every send then takes ACK_TIMEOUT for each try plus the backoffs
+                                    # (about 1.8 seconds with the defaults) and returns False, so set it to False for such a unit
+    ACK_TIMEOUT = 500               # 500 ms
+    SEND_RETRIES = 2                # Number of times a send is retried if it is not acknowledged
+    RETRY_BACKOFF = 100             # 100 ms before the first retry (doubled for each retry after that)
+    RETRY_FUNCTIONS = ['ON', 'OFF', 'ALLON', 'ALLOFF']     # Resent when their ACK is missed (DIM/BRIGHT are not, see _resendable)
+    MAX_OUTSTANDING = 4             # Maximum number of sends waiting for an ACK at once
+    RECOVERY_LOCK_WAIT = 2          # Seconds a watchdog recovery step waits for a read or write in progress to finish
+    FINISH_TIMEOUT = 5              # Seconds finish() waits for sends in progress and the receive thread
+    PROTOCOL_WATCH = 0              # Check the protocol file for changes (and reload it) every this many seconds (0 = only reload when asked)
     PROTOCOL_FILE = "./CM19aProtocol.ini"
-
-    def __init__(self, refresh=1, loginstance=None, polling=False):
+    DEVICE_CACHE = "./cm19a.device"        # The USB port the CM19a was found on (checked first next time it starts)
+    RULES_FILE = "./CM19aRules.ini"         # Macros to run when a command is received (optional)
+    SUBSCRIBER_WORKERS = 2          # Number of threads passing received commands to subscribers
+    SENT = "S"                      # Direction passed to the recorders (see recorders)
+    RECEIVED = "R"
+    WATCHDOG_INTERVAL = 5           # Seconds between watchdog checks of the receive thread and the USB transfers (0 = no watchdog)
+    WATCHDOG_STALL = 30             # Seconds the receive thread can go without finishing a read before it is treated as stuck
+    WATCHDOG_ERRORS = 10            # Number of read/write errors in a row before the device is recovered
+
+    def __init__(self, refresh=1, loginstance=None, polling=False, handle=None, verbose=True):
         # Initialise the object and create the device driver
+        # 'handle' is only needed to use something other than the CM19a (eg a trace being replayed, see cm19atrace.py)
+        # Set 'verbose' to False to skip printing the device info
         threading.Thread.__init__(self)     # initialise the thread for automatic monitoring
         self.refresh = refresh
         self.polling = polling
@@ -179,9 +538,46 @@ class CM19aDevice(threading.Thread):
         self.paused = False                 # Set to True to temporarily stop automatic monitoring of receive commands
         self.initialised = False            # True when the device has been opened and the driver initialised successfully
         self.device = False                 # USB device class instance
+        self.USB_device = None
+        self.handle = None                  # Device handle used to read from and write to the device (see USBTransport and LegacyHandle)
+        self.readbuffer = array.array('B', [0] * self.PACKET_LENGTH)    # Every read goes into this buffer (used with readlock held)
+        self.capture = None                 # Records every raw read while capturing (see startCapture)
+        self.verbose = verbose
+        self.startuptimes = [("import pyusb", USB_IMPORT_TIME)]     # How long each startup stage took [(stage, seconds)]
         self.receivequeue = []              # Queue of commands received automatically
         self.receivequeuecount = 0          # Number of items in the receive queue
-        self.protocol = {}                  # Dict containing the communications protocol for the CM19a
+        self.protocol = X10Protocol()       # The communications protocol for the CM19a
+        self.protocolmtime = None           # When the protocol file was last changed (when it was loaded)
+        self.reloadlock = threading.Lock()
+        self.sendlock = threading.RLock()   # Only one write at a time
+        self.readlock = threading.RLock()   # Only one read at a time (senders read while waiting for their ACK)
+        self.acklock = threading.Lock()
+        self.pending = collections.deque()  # Sends waiting for an ACK, oldest first
+        self.resyncs = 0                    # Times the sends waiting were abandoned after a missing ACK (see _resync)
+        self.outstanding = threading.BoundedSemaphore(self.MAX_OUTSTANDING)
+        self.inflight = 0                   # Number of sends in progress
+        self.inflightlock = threading.Condition()
+        self.closing = False                # True once finish() has been called (no more sends are accepted)
+        self.rules = RuleEngine(self)       # Macros that run as soon as a command is received
+        self.events = None                  # Passes received commands to subscribers (created by the first subscribe)
+        self.receiver = self                # The thread reading from the device (replaced if the watchdog has to restart it)
+        self.watchdog = None                # Recovers the receive thread and the device when they stop working (see Watchdog)
+        self.profiler = None                # Profiles each read and HTTP request while set (see profile())
+        self.recorders = []                 # Functions called with (direction, command, raw bytes, result) for every command sent and received
+        self.journal = None                 # Records every command sent and received (see startJournal)
+        self.history = None                 # ... in a searchable database (see startHistory)
+        self.tracing = threading.local()    # The Trace of the command being sent by each thread (see sendTraced)
+        self.tracelog = None                # Logger the stage timings of each traced command are written to
+
+        # Transfer counts for the watchdog and ?command=getstatus
+        self.reads = 0                      # Reads that returned data
+        self.readtimeouts = 0               # Reads that timed out (nothing to read, the normal case)
+        self.readerrors = 0                 # Reads that failed for any other reason
+        self.writes = 0
+        self.writeerrors = 0
+        self.errorrun = 0                   # Read/write errors in a row (reset by any successful transfer)
+        self.lasttransfer = time.time()     # When the device last answered a read or write (a read timing out counts)
+        self.lastpoll = time.time()         # When the receive thread last went round its loop
 
         # Set up logging
         if loginstance:
@@ -191,27 +587,65 @@ class CM19aDevice(threading.Thread):
             import logger
             self.log = logger.start_logging("CM19a_X10_USB", "./CM19a.log")
 
-        # Find the correct USB device
-        self.USB_device = USBdevice(self.VENDOR_ID, self.PRODUCT_ID)
-        # save the USB instance that points to the CM19a
-        self.device = self.USB_device.device
-        if not self.device:
-            print >> sys.stderr, "The CM19a is probably not plugged in or is being controlled by another USB driver."
-            self.log.error('The CM19a is probably not plugged in or is being controlled by another USB driver.')
-            return
-
-        # Open the device for send/receive
-        if not self._open_device():
-            # Device was not opened successfully
+        if handle:
+            # Use the handle supplied rather than the USB device
+            if not hasattr(handle, 'readinto'):
+                handle = LegacyHandle(handle, self.READ_EP_ADDRESS)
+            self.handle = handle
+            self.initialised = True
+        elif usb is None:
+            print >> sys.stderr, "pyUSB is not installed so the CM19a cannot be opened."
+            self.log.error("pyUSB is not installed so the CM19a cannot be opened.")
             return
-
-        self.print_device_info()
+        else:
+            # Find the correct USB device
+            start = time.time()
+            self.USB_device = USBdevice(self.VENDOR_ID, self.PRODUCT_ID, self.DEVICE_CACHE)
+            self._timed("find device", start)
+            # save the USB instance that points to the CM19a
+            self.device = self.USB_device.device
+            if len(self.USB_device.found) > 1:
+                self.log.warning("%d CM19a found, using the one on port %s" % (len(self.USB_device.found), self.USB_device.port))
+            if not self.device:
+                print >> sys.stderr, "The CM19a is probably not plugged in or is being controlled by another USB driver."
+                self.log.error('The CM19a is probably not plugged in or is being controlled by another USB driver.')
+                return
+
+            # Open the device for send/receive
+            start = time.time()
+            if not self._open_device():
+                # Device was not opened successfully
+                return
+            self._timed("open device", start)
+
+            if self.verbose:
+                self.print_device_info()
 
         # Load the communications protocol
+        start = time.time()
         self._load_protocol()
+        self._timed("load protocol", start)
+
+        # Load any macros (rules) now that the commands they refer to are known
+        start = time.time()
+        if os.path.isfile(self.RULES_FILE):
+            self.rules.load(self.RULES_FILE)
+        self._timed("load rules", start)
 
         # Initialise the device to read the remote controls
-        self._initialise_remotes()
+        # (not needed if we are only sending, eg from the command line)
+        if self.polling:
+            start = time.time()
+            self._initialise_remotes()
+            self._timed("initialise remotes", start)
+
+        self.log.info("Startup: %s" % self.startupTiming())
+
+        # Reload the protocol automatically when the file changes
+        if self.PROTOCOL_WATCH and self.protocolmtime:
+            watcher = threading.Thread(target=self._watchProtocol, name="CM19a protocol watcher")
+            watcher.setDaemon(True)
+            watcher.start()
 
         # Start the thread for automatically polling for inbound commands
         # If you just send commands via the CM19a and do not need to check for incoming commands from a remote control
@@ -219,6 +653,21 @@ class CM19aDevice(threading.Thread):
         if self.polling:
             self.start()
 
+            # Keep an eye on the receive thread and the device
+            if self.WATCHDOG_INTERVAL:
+                self.watchdog = Watchdog(self, self.WATCHDOG_INTERVAL, self.WATCHDOG_STALL, self.WATCHDOG_ERRORS)
+                self.watchdog.start()
+
+
+    def _timed(self, stage, start):
+        # Records how long a startup stage took
+        self.startuptimes.append((stage, time.time() - start))
+
+
+    def startupTiming(self):
+        """ Returns how long each startup stage took as text """
+        return ", ".join(["%s %.1f ms" % (stage, seconds * 1000) for stage, seconds in self.startuptimes])
+
 
     def _open_device(self) :
         """ Open the device, claim the interface, and create a device handle """
@@ -229,22 +678,30 @@ class CM19aDevice(threading.Thread):
 
         self.handle = None      # file-like handle
         try:
-            # Open the device and create a handle
-            self.handle = self.device.open()                    # --> DeviceHandle object
+            coredevice = getattr(self.device, 'dev', None)      # pyUSB 1.0 keeps the core device behind the legacy one
+            if self.USE_CORE_API and coredevice is not None:
+                # Open the device through the core API, claim the interface and find the endpoints
+                self.handle = USBTransport(coredevice, self.CONFIGURATION_ID, self.INTERFACE_ID, self.ALTERNATE_SETTING_ID,
+                                           self.READ_EP_ADDRESS, self.WRITE_EP_ADDRESS)
+            else:
+                # Open the device and create a handle
+                handle = self.device.open()                    # --> DeviceHandle object
 
-            # Select the active configuration
-            self.handle.setConfiguration(self.CONFIGURATION_ID)
+                # Select the active configuration
+                handle.setConfiguration(self.CONFIGURATION_ID)
 
-            # detach any other kernel drivers that are currently attached to the required interface
-            #self.handle.detachKernelDriver(self.INTERFACE_ID)
+                # detach any other kernel drivers that are currently attached to the required interface
+                #handle.detachKernelDriver(self.INTERFACE_ID)
 
-            # Claim control of the interface
-            self.handle.claimInterface(self.INTERFACE_ID)
+                # Claim control of the interface
+                handle.claimInterface(self.INTERFACE_ID)
 
-            # Set the alternative setting for this interface
-            self.handle.setAltInterface(self.ALTERNATE_SETTING_ID)
+                # Set the alternative setting for this interface
+                handle.setAltInterface(self.ALTERNATE_SETTING_ID)
+                self.handle = LegacyHandle(handle, self.READ_EP_ADDRESS)
 
-            print "Cm19a opened and interface claimed."
+            if self.verbose:
+                print "Cm19a opened and interface claimed."
             self.log.info("Cm19a opened and interface claimed")
             self.initialised = True
         except usb.USBError, err:
@@ -260,12 +717,7 @@ class CM19aDevice(threading.Thread):
 
     def _initialise_remotes(self):
         # Initilises the CM19a for wireless remote controls
-        sequence=[]
-        sequence.append([0x020,0x034,0x0cb,0x058,0x0a7])       # 5 byte sequence (interestingly this is the same sequence as P16 ON)
-        sequence.append([0x080,0x001,0x000,0x020,0x014])       # 5 byte sequence
-        sequence.append([0x080,0x001,0x000,0x000,0x014,0x024,0x020,0x020])     # 8 byte sequence
-
-        for s in sequence:
+        for s in self.REMOTE_INIT_SEQUENCES:
             result = self._write_bytes(s)
             if not result:
                 self.log.error("Error initialising the CM19a for wireless remote controls")
@@ -281,46 +733,104 @@ class CM19aDevice(threading.Thread):
             set 'self.alive' to False to halt checking
         """
         self.alive = True
-        while self.alive:
+        while self.alive and self.receiver is threading.currentThread():
             # continues to run the following code in a separate thread until alive is set to false
+            # (or the watchdog has replaced this thread because it was stuck in a read)
+            self.lastpoll = time.time()     # heartbeat for the watchdog
+            profiler = self.profiler
             if self.paused:
-                # Device is paused (eg during a send command) so do not read
+                # Device is paused (eg while the receive queue is emptied) so do not read
                 pass
-            else:
-                # Device is not paused so check for incoming commands
-                self.receive()
+            elif profiler and profiler.runcall(self.receive):
+                # (the same but each read is profiled, see cm19aprofile.py)
+                continue
+            elif not profiler and self.receive():
+                # Something was received so check again straight away in case more is waiting
+                continue
 
             # wait for 'refresh' seconds before checking the device again
             time.sleep(self.refresh)
 
 
-    def receive(self):
+    def receive(self, wait=True):
         """ Receive any available data from the Cm19a
-            Append it to the queue
+            Append it to the queue and run any rule for it (or match it to a send if it is an ACK)
+            If 'wait' is False and another thread is already reading then return straight away
+            Returns the decoded command or None if nothing was received
         """
         if not self.initialised:
-            return
+            return None
 
-        # Raw read any data from the device
-        data = None
+        # Raw read any data from the device (one thread at a time as every read uses the same buffer)
+        # (the lock and buffer are kept for the whole read as the watchdog replaces them if a read gets stuck)
+        readlock = self.readlock
+        if not readlock.acquire(wait):
+            return None
+        buffer = self.readbuffer
+        count = 0
         try:
-            data = self.handle.interruptRead(self.READ_EP_ADDRESS, self.PACKET_LENGTH, self.RECEIVE_TIMEOUT)
-        except:
-            # error or simply nothing in the buffer to read
-            pass
-
-        # Decode the data and add any commands to the receive queue
-        if data:
+            count = self.handle.readinto(buffer, self.RECEIVE_TIMEOUT)
+            if count:
+                self.reads += 1
+            self.errorrun = 0
+            self.lasttransfer = time.time()
+        except Exception, err:
+            if _is_timeout(err):
+                # simply nothing in the buffer to read
+                self.readtimeouts += 1
+                self.errorrun = 0
+                self.lasttransfer = time.time()
+            else:
+                # a real error (eg the CM19a was unplugged), counted for the watchdog
+                self.readerrors += 1
+                self.errorrun += 1
+                if self.errorrun == 1:
+                    # log the first of a run of errors only (the receive thread reads several times a second)
+                    self.log.error("Read error: %s" % err)
+        # Decode the data before the buffer can be read into again
+        result = None
+        ack = False
+        raw = None
+        try:
+            if count:
+                if self.capture:
+                    self.capture.write(buffer[:count])
+                if count == 1 and buffer[0] == self.ACK:
+                    ack = True
+                else:
+                    result = self._decode(buffer, count)     # decode the byte stream
+                    if self.recorders:
+                        raw = buffer[:count]
+        finally:
+            readlock.release()
+
+        # Add any commands to the receive queue
+        if count:
             # something read so add it the the receive queue
-            result = self._decode(data)     # decode the byte stream
-            if result == str(self.ACK):
-                # Ignore any send command acknowledgements
-                pass
+            if ack:
+                # Send command acknowledgement
+                self._acknowledge()
             else:
                 self.receivequeue.append(result)
                 self.receivequeuecount = self.receivequeuecount + 1
                 #print "Command %s received via the cm19a and added to the receive queue." % result
                 self.log.info("Command %s received via the cm19a and added to the receive queue." % result)
+                if self.events:
+                    self.events.publish(result)
+                if raw is not None:
+                    self._record(self.RECEIVED, result, raw)
+                # Run any macro for this command straight away
+                # (a sender reading while it waits runs them on its own thread, so its trace is put aside
+                # while they run rather than timing the macro's sends as stages of its own command)
+                trace = getattr(self.tracing, 'trace', None)
+                self.tracing.trace = None
+                try:
+                    self.rules.fire(result)
+                finally:
+                    self.tracing.trace = trace
+                return result
+
+        return None
 
 
     def getReceiveQueue(self):
@@ -345,57 +855,537 @@ class CM19aDevice(threading.Thread):
             return []
 
 
+    def clearReceiveQueue(self):
+        """ Empties the queue of incoming commands """
+        self.paused = True
+        self.receivequeue = []
+        self.receivequeuecount = 0
+        self.paused = False
+
+
+    def lookup(self, command):
+        """ Returns (house, unit, function) for a command such as A1ON or "A 1 ON", or None if it is not in the protocol """
+        frame = self.protocol.commands.get(command.replace(" ", "").upper())
+        if frame:
+            return frame.house, frame.unit, frame.function
+        return None
+
+
+    def startCapture(self, fname):
+        """ Records every raw read from the device (with the time it was read) to a binary trace file (see cm19atrace.py) """
+        import cm19atrace
+        self.stopCapture()
+        self.capture = cm19atrace.TraceWriter(fname)
+        self.log.info("Capturing raw reads to %s" % fname)
+
+
+    def stopCapture(self):
+        capture, self.capture = self.capture, None
+        if capture:
+            capture.close()
+            self.log.info("Capture stopped: %d reads recorded in %s" % (capture.count, capture.fname))
+
+
+    def profile(self, seconds=10, mode='sample'):
+        """
+            Profiles the running driver for 'seconds' (see cm19aprofile.py)
+            'mode' is 'sample' (collapsed stacks of every thread) or 'calls' (cProfile of each read and HTTP request)
+            Returns (True/False, the report)
+        """
+        import cm19aprofile
+        return cm19aprofile.profile(self, seconds, mode)
+
+
+    def memorySnapshot(self):
+        """ Records the number of objects of each type (and the size of each container) for memoryDiff() """
+        import cm19aprofile
+        return cm19aprofile.snapshot()
+
+
+    def memoryDiff(self):
+        """ Returns (True/False, what has grown since memorySnapshot()) """
+        import cm19aprofile
+        return cm19aprofile.memdiff()
+
+
+    def startJournal(self, directory, maxbytes=1024 * 1024, maxage=24 * 60 * 60, segments=10):
+        """ Records every command sent and received in a rotating journal that survives restarts (see cm19ajournal.py) """
+        import cm19ajournal
+        self.stopJournal()
+        self.journal = cm19ajournal.Journal(directory, maxbytes, maxage, segments)
+        self.recorders.append(self.journal.record)
+        self.log.info("Journalling commands to %s" % directory)
+
+
+    def stopJournal(self):
+        journal, self.journal = self.journal, None
+        if journal:
+            self.recorders.remove(journal.record)
+            journal.close()
+
+
+    def queryJournal(self, start=None, end=None, limit=100):
+        """
+            Returns up to 'limit' commands [(time, direction, command, raw bytes, result)] from the journal, oldest first
+            from 'start' (seconds since the epoch) onwards or, with no 'start', the last ones before 'end'
+        """
+        if not self.journal:
+            return []
+        return self.journal.query(start, end, limit)
+
+
+    def startHistory(self, fname, maxage=None):
+        """ Records every command sent and received in a searchable SQLite database (see cm19ahistory.py) """
+        import cm19ahistory
+        self.stopHistory()
+        self.history = cm19ahistory.History(fname, self.lookup, maxage=maxage)
+        self.recorders.append(self.history.record)
+        self.log.info("Recording the command history in %s" % fname)
+
+
+    def stopHistory(self):
+        history, self.history = self.history, None
+        if history:
+            self.recorders.remove(history.record)
+            history.close()
+
+
+    def queryHistory(self, house=None, unit=None, function=None, direction=None, start=None, end=None, limit=100):
+        """
+            Returns up to 'limit' commands (dicts) from the history matching every filter given, oldest first
+            from 'start' (seconds since the epoch) onwards or, with no 'start', the last ones before 'end'
+        """
+        if not self.history:
+            return []
+        return self.history.query(house, unit, function, direction, start, end, limit=limit)
+
+
+    def _record(self, direction, command, raw, result=None):
+        # Passes a command sent or received to each recorder (eg the journal)
+        for recorder in self.recorders:
+            try:
+                recorder(direction, command, raw, result)
+            except Exception, err:
+                self.log.error("Unable to record %s: %s" % (command, err))
+
+
+    def subscribe(self, callback, filter=None, maxbacklog=100):
+        """
+            Calls 'callback' (on a worker thread) with each command received
+            'filter' is None (all commands), a pattern such as A* or *BRIGHTBUTTONPRESSED, or a function that returns True for the commands wanted
+            Up to 'maxbacklog' commands are held while the callback is busy, any more are dropped (see Subscriber.dropped)
+            Returns the Subscriber
+        """
+        if not self.events:
+            self.events = EventDispatcher(self.log, self.SUBSCRIBER_WORKERS)
+        return self.events.subscribe(callback, filter, maxbacklog)
+
+
+    def unsubscribe(self, callback):
+        """ Stops calling 'callback' (the function or the Subscriber returned by subscribe). Returns False if it was not subscribed """
+        if not self.events:
+            return False
+        return self.events.unsubscribe(callback)
+
+
     def send(self, house_code, unit_number, function):
         """
             Sends a command request to the device
-            Tries to send just once
-            Returns False if an error occurs
+            Waits for the CM19a to acknowledge the command and retries (up to SEND_RETRIES times) if it does not
+            Only ON and OFF (and ALLON/ALLOFF) are resent when the ACK is missed: a DIM or BRIGHT may have reached the
+            module with only the ACK lost, and sending it again would step the level twice, so it is reported as
+            unconfirmed (False) instead. Any command is written again if the write itself failed
+            Returns False if an error occurs (or the command was not confirmed)
         """
-        if not self.initialised:
+        if not self._startSend():
             return False
+        try:
+            return self._send(house_code, unit_number, function)
+        finally:
+            self._endSend()
 
+
+    def _send(self, house_code, unit_number, function):
         self.log.info("Sending %s%s %s" % (house_code.upper(), unit_number, function.upper()))
         print "Sending %s%s %s" % (house_code.upper(), unit_number, function.upper())
 
         # Encode the command to the X10 protocol
-        command_sequence = self._encode(house_code, unit_number, function)        # -> list
+        command_sequence = self._encode(house_code, unit_number, function)        # -> X10Frame
+        self._mark('encode')
         if not command_sequence:
             # encoding error
             self.log.error("Unable to send command; encoding error occurred.")
             return False
 
-        # Pause automatic receiving while we send
-        if self.polling:
-            self.paused = True
-            time.sleep(int(self.refresh/2))
-
         # Flush the device before we send anything so we do not lose any incoming requests
-        self.receive()
+        # (unless another thread is reading, which will get them, so a stuck read cannot hold up the send)
+        self.receive(wait=False)
+        self._mark('flush')
 
         # Write the command sequence to the device
-        result = self._write_bytes(command_sequence)
+        result = self._write_frame(command_sequence)
+        self._record(self.SENT, command_sequence.command, command_sequence.buffer, result)
+        self._mark('record')
         self.log.info("Result %s%s %s: %r" % (house_code.upper(), unit_number, function.upper(), result))
         print "Result %s%s %s: %r" % (house_code.upper(), unit_number, function.upper(), result)
 
-        # Restart automatic receiving and return
-        self.paused = False
         return result
 
 
+    def sendBatch(self, commands):
+        """
+            Sends a list of (house_code, unit_number, function) commands one after the other
+            The device is flushed once for the whole batch rather than once per command and
+            up to MAX_OUTSTANDING commands are written before waiting for their ACKs
+            Returns a list of (result, seconds taken) in the same order as the commands
+        """
+        if not self._startSend():
+            return [(False, 0.0)] * len(commands)
+        try:
+            return self._sendBatch(commands)
+        finally:
+            self._endSend()
+
+
+    def sendTraced(self, house_code, unit_number, function, traceid, stages=()):
+        """
+            send() timing each stage (encode, flush, slot, write, ack, record) for the correlation id 'traceid'
+            'stages' are [(stage, ms)] timed by the caller before the send (eg parsing the HTTP request)
+            Returns (result, [(stage, ms)]) and writes the stages to the trace log
+        """
+        description = "%s%s %s" % (house_code.upper(), unit_number, function.upper())
+        return self._traced(traceid, stages, description, self.send, house_code, unit_number, function)
+
+
+    def sendBatchTraced(self, commands, traceid, stages=()):
+        """ sendBatch() timing each stage for the correlation id 'traceid' (see sendTraced). Returns (results, [(stage, ms)]) """
+        return self._traced(traceid, stages, "batch of %d" % len(commands), self.sendBatch, commands)
+
+
+    def _traced(self, traceid, stages, description, func, *args):
+        trace = self.tracing.trace = Trace(traceid, stages)
+        try:
+            result = func(*args)
+        finally:
+            self.tracing.trace = None
+        trace.mark('done')
+        if self.tracelog:
+            self.tracelog.info("%s %s: %s" % (trace.id, description, trace))
+        return result, trace.stages
+
+
+    def _mark(self, stage):
+        # Times a stage of the command being sent by this thread (if it is being traced)
+        trace = getattr(self.tracing, 'trace', None)
+        if trace:
+            trace.mark(stage)
+
+
+    def _sendBatch(self, commands):
+        self.log.info("Sending a batch of %d commands" % len(commands))
+
+        # Flush the device before we send anything so we do not lose any incoming requests
+        # (unless another thread is reading, which will get them, so a stuck read cannot hold up the send)
+        self.receive(wait=False)
+        self._mark('flush')
+
+        results = []
+        for i in range(0, len(commands), self.MAX_OUTSTANDING):
+            # Write the next few commands and then wait for their ACKs
+            window = []
+            for house_code, unit_number, function in commands[i:i + self.MAX_OUTSTANDING]:
+                start = time.time()
+                frame = self._encode(house_code, unit_number, function)
+                pending = None
+                if frame:
+                    pending = self._write_pending(frame)
+                window.append((house_code, unit_number, function, frame, pending, start))
+
+            for house_code, unit_number, function, frame, pending, start in window:
+                if not frame:
+                    result = False
+                elif not self.VERIFY_ACK:
+                    result = pending is not None
+                else:
+                    result = pending is not None and (self._wait_for_ack(pending) or self._resync(pending))
+                    self._mark('ack')
+                    if not result and (pending is None or self._resendable(frame)):
+                        # Missing ACK (or a failed write) so retry this one on its own
+                        result = self._write_frame(frame, self.SEND_RETRIES - 1)
+                self.log.info("Result %s%s %s: %r" % (house_code.upper(), unit_number, function.upper(), result))
+                if frame:
+                    self._record(self.SENT, frame.command, frame.buffer, result)
+                results.append((result, time.time() - start))
+
+        return results
+
+
+    def optimiseScene(self, scene, housewide=False, allon=True):
+        """
+            Works out the fewest frames that put every unit in a scene into its state
+            'scene' is a list of (house_code, unit_number, state) where state is ON or OFF, eg [('C', '1', 'OFF'), ('C', '2', 'OFF'), ('C', '5', 'ON')]
+            'housewide' is True (or a list of house codes) if the scene covers every unit on its houses, so a house's ALLOFF (or ALLON)
+            frame can be sent followed by only the units that differ from it. Units left out of the scene are switched as well
+            which is why it is off by default
+            Set 'allon' to False if the house has appliance modules (X10 ALL ON only turns on lamp modules) so only ALLOFF is used
+            Returns (the commands to send as a list of (house_code, unit_number, function), the number of frames sending each unit on its own takes)
+        """
+        frames = self.protocol.frames
+        houses = {}                     # {house: {unit: state}} (a unit in the scene twice takes its last state)
+        order = []
+        for house_code, unit_number, state in scene:
+            house_code, state = house_code.upper(), state.upper()
+            if house_code not in houses:
+                houses[house_code] = {}
+                order.append(house_code)
+            houses[house_code][str(unit_number)] = state
+        #end for
+
+        plan = []
+        naive = 0
+        for house_code in order:
+            units = sorted(houses[house_code].items(), key=lambda item: (len(item[0]), item[0]))
+            naive += len(units)
+            best = [(house_code, unit_number, state) for unit_number, state in units]
+            if housewide is True or (housewide and house_code in housewide):
+                # Try each house-wide frame followed by the units that end up in the other state
+                for allstate, function in [('OFF', 'ALLOFF'), ('ON', 'ALLON')]:
+                    if (house_code, '0', function) not in frames or (function == 'ALLON' and not allon):
+                        continue
+                    candidate = [(house_code, '0', function)]
+                    candidate += [(house_code, unit_number, state) for unit_number, state in units if state != allstate]
+                    if len(candidate) < len(best):
+                        best = candidate
+                #end for
+            plan.extend(best)
+        #end for
+        return plan, naive
+
+
+    def sendScene(self, scene, housewide=False, allon=True):
+        """
+            Sends a scene (see optimiseScene) using as few frames as possible
+            Returns (the commands sent, the number of frames sending each unit on its own would have taken, the results from sendBatch)
+        """
+        plan, naive = self.optimiseScene(scene, housewide, allon)
+        self.log.info("Scene of %d units sent as %d frames (%d saved)" % (naive, len(plan), naive - len(plan)))
+        return plan, naive, self.sendBatch(plan)
+
+
+    def _startSend(self):
+        # Counts a send in progress so finish() can wait for it
+        # Returns False if the device is not initialised or is shutting down
+        self.inflightlock.acquire()
+        try:
+            if not self.initialised or self.closing:
+                return False
+            self.inflight += 1
+            return True
+        finally:
+            self.inflightlock.release()
+
+
+    def _endSend(self):
+        self.inflightlock.acquire()
+        try:
+            self.inflight -= 1
+            self.inflightlock.notifyAll()
+        finally:
+            self.inflightlock.release()
+
+
+    def _write_frame(self, frame, retries=None):
+        """
+            Writes a frame to the device and waits for the CM19a to acknowledge it
+            Retries with an increasing delay (RETRY_BACKOFF, doubled after each retry) if the write fails or
+            no ACK is received (the latter only for the RETRY_FUNCTIONS, see _resendable)
+            Returns True if the frame was acknowledged (or just written if VERIFY_ACK is False)
+        """
+        if retries is None:
+            retries = self.SEND_RETRIES
+        backoff = self.RETRY_BACKOFF / 1000.0
+
+        for attempt in range(retries + 1):
+            if attempt:
+                self.log.warning("No ACK for %s, retrying (%d of %d)" % (frame.command, attempt, retries))
+                time.sleep(backoff)
+                backoff = backoff * 2
+                self._mark('backoff')
+            pending = self._write_pending(frame)
+            if pending is None:
+                # write failed
+                continue
+            if not self.VERIFY_ACK:
+                return True
+            acked = self._wait_for_ack(pending)
+            self._mark('ack')
+            if acked or self._resync(pending):
+                return True
+            if not self._resendable(frame):
+                return False
+
+        self.log.error("%s was not acknowledged by the CM19a" % frame.command)
+        return False
+
+
+    def _resendable(self, frame):
+        # True if a frame whose ACK was missed can be written again: ON and OFF leave the module in the same state however
+        # many times they arrive, but a DIM or BRIGHT may have reached it (only the ACK lost) and would step the level again
+        if frame.function.upper() in self.RETRY_FUNCTIONS:
+            return True
+        self.log.error("%s was not acknowledged by the CM19a, not resent as it may have been received" % frame.command)
+        return False
+
+
+    def _write_pending(self, frame):
+        """
+            Writes a frame and adds it to the list of sends waiting for an ACK
+            The CM19a acknowledges sends in the order they were written so the next ACK received belongs to the oldest send waiting
+            Returns the PendingSend or None if the write failed
+        """
+        if not self.VERIFY_ACK:
+            result = self._write_bytes(frame.buffer)
+            self._mark('write')
+            if result:
+                return PendingSend(frame)
+            return None
+
+        # Wait for a free slot (the senders holding them either get their ACK or give up within ACK_TIMEOUT)
+        deadline = time.time() + self.ACK_TIMEOUT / 1000.0
+        while not self.outstanding.acquire(False):
+            if time.time() >= deadline:
+                self.log.warning("No free slot to send %s (%d sends waiting for an ACK)" % (frame.command, len(self.pending)))
+                return None
+            if self.receive(wait=False) is None:
+                time.sleep(0.005)
+        self._mark('slot')
+
+        pending = PendingSend(frame)
+        self.sendlock.acquire()
+        try:
+            # Only one write at a time so the pending sends are in the same order as the writes
+            self.acklock.acquire()
+            self.pending.append(pending)
+            self.acklock.release()
+            result = self._write_bytes(frame.buffer)
+        finally:
+            self.sendlock.release()
+        self._mark('write')
+
+        if not result:
+            self._forget(pending)
+            return None
+        return pending
+
+
+    def _wait_for_ack(self, pending):
+        """
+            Reads from the device (unless another thread is reading) until the send is acknowledged or ACK_TIMEOUT expires
+            Returns False if it timed out or the send was abandoned (see _resync)
+        """
+        deadline = time.time() + self.ACK_TIMEOUT / 1000.0
+        while not pending.acked.isSet():
+            if time.time() >= deadline:
+                return False
+            if self.receive(wait=False) is None and not pending.acked.isSet():
+                # Nothing received or another thread is reading (and will match the ACK)
+                pending.acked.wait(0.005)
+        return not pending.abandoned
+
+
+    def _resync(self, pending):
+        """
+            Called when a send has not been acknowledged within ACK_TIMEOUT
+            An ACK does not say which send it is for, so if this send's ACK arrives late it would be matched to the
+            next send waiting (and every match after it would be one out). So every send waiting is abandoned
+            (their senders retry them) and the device is read for ACK_TIMEOUT with nothing written, throwing away
+            any late ACK as there is then no send waiting for it
+            Returns True if the send was acknowledged after all (before the others were abandoned)
+        """
+        self.sendlock.acquire()
+        try:
+            if pending.acked.isSet():
+                # acknowledged just after timing out, or already abandoned by another sender's resync
+                return not pending.abandoned
+
+            abandoned = self._abandon()
+            self.resyncs += 1
+            self.log.warning("No ACK for %s, abandoned %d sends waiting for an ACK and draining the CM19a" % (pending.frame.command, abandoned))
+
+            # Nothing can be written while draining (the send lock is held)
+            deadline = time.time() + self.ACK_TIMEOUT / 1000.0
+            while time.time() < deadline:
+                if self.receive(wait=False) is None:
+                    time.sleep(0.005)
+            return False
+        finally:
+            self.sendlock.release()
+
+
+    def _abandon(self):
+        # Stops every send waiting for an ACK (their senders see them as not acknowledged) and frees their slots
+        # Returns the number abandoned
+        self.acklock.acquire()
+        abandoned = list(self.pending)
+        self.pending.clear()
+        self.acklock.release()
+        for waiting in abandoned:
+            waiting.abandoned = True
+            waiting.acked.set()
+            self.outstanding.release()
+        return len(abandoned)
+
+
+    def _acknowledge(self):
+        # An ACK was received so match it to the oldest send waiting for one
+        self.acklock.acquire()
+        try:
+            if not self.pending:
+                # a late ACK for a send that has been abandoned, it must not be kept for the next send
+                self.log.debug("ACK received but no send was waiting for one (discarded)")
+                return
+            pending = self.pending.popleft()
+        finally:
+            self.acklock.release()
+        pending.acked.set()
+        self.outstanding.release()
+
+
+    def _forget(self, pending):
+        # Stop waiting for an ACK for a send
+        if pending is None:
+            return
+        self.acklock.acquire()
+        try:
+            if pending not in self.pending:
+                # Already acknowledged (or never waiting)
+                return
+            self.pending.remove(pending)
+        finally:
+            self.acklock.release()
+        self.outstanding.release()
+
+
     def _write_bytes(self, bytesequence):
         # Write the bytes to the device
-        # bytesequence is a list of bytes to be written
+        # bytesequence is an array (or list) of bytes to be written
         if len(bytesequence) == 0:
             return False
 
         try:
             chars_written = self.handle.interruptWrite(self.WRITE_EP_ADDRESS, bytesequence, self.SEND_TIMEOUT)
             returnval = True
+            self.writes += 1
+            self.errorrun = 0
+            self.lasttransfer = time.time()
         except Exception, err:
             print >> sys.stderr, err
             self.log.error(str(err))
             chars_written = 0
             returnval = False
+            self.writeerrors += 1
+            if not _is_timeout(err):
+                self.errorrun += 1
 
         if chars_written != len(bytesequence):
             # Incorrect number of bytes written
@@ -408,329 +1398,696 @@ class CM19aDevice(threading.Thread):
 
     def _encode(self, house_code,  unit_number,  on_off):
         """
-            Looks up the X10 protocol for the appropriate byte command sequence
+            Looks up the X10 protocol for the appropriate frame (byte command sequence)
         """
-        key = house_code.upper() + unit_number + on_off.upper()
-        if key in self.protocol:
-            return self.protocol[key]
+        frame = self.protocol.frames.get((house_code.upper(), unit_number, on_off.upper()))
+        if frame:
+            return frame
         else:
+            key = house_code.upper() + unit_number + on_off.upper()
             print >> sys.stderr, "Unable to encode the requested action: %s" %  key
             self.log.error("Unable to encode the requested action: %s" %  key)
             return False
 
 
-    def _decode(self, receive_sequence):
+    def _decode(self, receive_sequence, length=None):
         """
             Uses the X10 protocol to decode a command received by the CM19a
-            'receive_sequence' is a list of decimal values
+            'receive_sequence' is a list (or array) of decimal values, only the first 'length' are decoded (default all of them)
             returns the command (housecode, unit number, on/off) that the sequence represents
             If it cannot decode the sequence then the sequence is simply returned
         """
 
-        if not (self.protocol and self.protocol_remote):
+        node = self.protocol.trie       # (the protocol may be replaced at any time by reloadProtocol)
+        if not node:
             # the protocol has not been loaded
             self.log.error("Cannot decode in inbound command since the protocol is not loaded")
             return ""
+        if length is None:
+            length = len(receive_sequence)
 
-        return_value = None
-
-        # Convert the inbound command sequence (bytes) to a string to it can be compared to the protocol values
-        # the received command sequence is a list of decimal values (not text)
-        # Note: cannot use Python sets for comparing the lists because there may be duplicate values in each list (esp zeros)
-        receive_string = ""
-        for i in range(len(receive_sequence)):
-            receive_string += str(receive_sequence[i])
-
-        # Now search for the string in the protocol
-        for cmd, seq in self.protocol.iteritems():
-            # Protocol is a dict of command:command_sequence pairs
-            # cmd is the command (eg A1OFF)
-            # seq is a list of the command bytes
-            protocol_string = ""
-            for i in range(len(seq)):
-                protocol_string += str(seq[i])
-            if receive_string == protocol_string:
-                # protocol match found
-                return_value = cmd
-                break
-
-        # Now search for the string in the RF remote protocol (this overrides anything found in the above std x10 protocol)
-        for cmd, seq in self.protocol_remote.iteritems():
-            # Protocol is a dict of command:command_sequence pairs
-            # cmd is the command (eg A1OFF)
-            # seq is a list of the command bytes
-            protocol_string = ""
-            for i in range(len(seq)):
-                protocol_string += str(seq[i])
-            if receive_string == protocol_string:
-                # protocol match found
-                return_value = cmd
+        # Look up the bytes received one at a time (RF remote codes take precedence over the std x10 codes)
+        for i in xrange(length):
+            node = node.get(receive_sequence[i])
+            if node is None:
                 break
+        else:
+            frame = node.get(X10Protocol.END)
+            if frame:
+                return frame.command
 
-        if not return_value:
-            # The byte string was not found in the protocol so return the bytes
-            receive_string = ""
-            for i in range(len(receive_sequence)):
-                receive_string += str(receive_sequence[i])+" "
-            return_value = receive_string
-
-        return return_value.strip()
+        # The byte string was not found in the protocol so return the bytes
+        return " ".join([str(receive_sequence[i]) for i in xrange(length)])
 
 
     def _load_protocol(self):
-        # Loads the X10 protocol into a dict
+        # Loads the X10 protocol
 
-        if not self.device:
+        if not self.handle:
             print >> sys.stderr, "Cannot load X10 Protocol since the CM19a is not plugged in."
             self.log.error("Cannot load X10 Protocol since the CM19a is not plugged in.")
             return
 
-        self.protocol = {}  # empty dictionary
-        self.protocol_remote = {}  # empty dictionary
-
         # Open the configuration file
         fname = self.PROTOCOL_FILE
         if not os.path.isfile(fname):
             print >> sys.stderr, "**ERROR**", "Protocol file missing %s" % fname
-            self.log.error("**ERROR**", "Protocol file missing %s" % fname)
+            self.log.error("**ERROR** Protocol file missing %s" % fname)
             self.initialised = False
             return None
-        f = open(fname, "r")
-
-        section=None
-        for aline in f.readlines():
-            aline = aline.strip()
-            if not aline or aline[0] == "#":
-                # comment or blank line so ignore
-                pass
-            elif aline[0] == "[":
-                # new section
-                section = aline
-            else:
-                # extract the data using regular expressions
-                if section == "[CM19A X10 CODES]":
-                    aline = aline.replace(" ", "")  # remove any whitespace
-                    data = aline.split(',', 3)     # Comma separate data but keep the command sequence as a single string
-                    house_code = data[0].upper()
-                    unit_number = data[1]
-                    on_off_dim = data[2].upper()
-                    command_sequence = data[3].split(',')
-                    for i in range(len(command_sequence)):
-                        command_sequence[i] = int(command_sequence[i], 16)      # Convert the list items from text to values (the text representation is hex)
-                    if data:
-                        # add the command to the list (which is actually a dictionary in the form:
-                        #{key : command_sequence}   command_sequence is a list of the bytes
-                        key = house_code + unit_number + on_off_dim
-                        self.protocol[key] =  command_sequence
-                elif section == "[X10 RF REMOTE DIM/BRIGHT CODES]":
-                    aline = aline.replace(" ", "")  # remove any whitespace
-                    data = aline.split(',', 3)     # Comma separate data but keep the command sequence as a single string
-                    house_code = data[0].upper()
-                    unit_number = data[1]
-                    on_off_dim = data[2].upper()
-                    command_sequence = data[3].split(',')
-                    for i in range(len(command_sequence)):
-                        command_sequence[i] = int(command_sequence[i], 16)      # Convert the list items from text to values (the text representation is hex)
-                    if data:
-                        # add the command to the list (which is actually a dictionary in the form:
-                        #{key : command_sequence}   command_sequence is a list of the bytes
-                        key = house_code + unit_number + on_off_dim
-                        self.protocol_remote[key] =  command_sequence
-                elif section == "[OTHER]":
-                    # Not required
-                    pass
-                #endif
-            # endif
-        #end for
 
-        f.close()
+        self.protocol = X10Protocol(fname)
+        self.protocolmtime = os.path.getmtime(fname)
     #endsub
 
 
-    def finish(self):
-        """ Close everything and release device interface """
+    def reloadProtocol(self):
+        """
+            Reloads the protocol file without stopping the driver (eg after adding remote codes)
+            The file is parsed into a new X10Protocol which then replaces the old one in a single step
+            so sends and decodes in progress are never blocked or see a half loaded protocol
+            Returns (True/False, message)
+        """
+        fname = self.PROTOCOL_FILE
+        self.reloadlock.acquire()
+        try:
+            try:
+                mtime = os.path.getmtime(fname)
+                protocol = X10Protocol(fname)
+            except Exception, err:
+                # missing or invalid file so keep the current protocol
+                message = "Unable to reload the protocol from %s: %s" % (fname, err)
+                self.log.error(message)
+                return False, message
+            if not protocol.frames:
+                message = "Unable to reload the protocol: no commands found in %s" % fname
+                self.log.error(message)
+                return False, message
+
+            self.protocol = protocol
+            self.protocolmtime = mtime
+            self.rules.compile()
+        finally:
+            self.reloadlock.release()
+
+        message = "Protocol reloaded from %s: %d commands" % (fname, len(protocol.commands))
+        self.log.info(message)
+        return True, message
+
+
+    def _watchProtocol(self):
+        # Runs in a thread: reloads the protocol whenever the protocol file changes
+        seen = self.protocolmtime
+        while not self.closing:
+            time.sleep(self.PROTOCOL_WATCH)
+            try:
+                mtime = os.path.getmtime(self.PROTOCOL_FILE)
+            except OSError:
+                # file missing (eg while it is being saved) so check again later
+                continue
+            if mtime != seen and not self.closing:
+                # (a file that fails to load is not tried again until it changes again)
+                seen = mtime
+                self.reloadProtocol()
+
+
+    def finish(self, timeout=None):
+        """ Close everything and release device interface
+            New sends are refused straight away, then we wait up to 'timeout' seconds (FINISH_TIMEOUT by default)
+            for the sends in progress, the receive thread and the subscribers to finish
+        """
+        if timeout is None:
+            timeout = self.FINISH_TIMEOUT
+        deadline = time.time() + timeout
+
+        # Stop accepting sends and let the ones in progress finish
+        self.inflightlock.acquire()
+        try:
+            self.closing = True
+            while self.inflight and time.time() < deadline:
+                self.inflightlock.wait(deadline - time.time())
+            if self.inflight:
+                self.log.warning("Shutting down with %d sends still in progress" % self.inflight)
+        finally:
+            self.inflightlock.release()
+
+        # Stop the watchdog (so it does not restart anything) and the receive thread
+        if self.watchdog:
+            self.watchdog.stop()
         self.alive = False
         self.paused = True
-        try:
-            #self.handle.reset()
-            self.handle.releaseInterface()
-        except Exception, err:
-            print >> sys.stderr, err
-            self.log.error(str(err))
+        receiver = self.receiver
+        if receiver.isAlive() and threading.currentThread() is not receiver:
+            receiver.join(max(0, deadline - time.time()))
+            if receiver.isAlive():
+                self.log.warning("The receive thread did not stop in time")
+        if self.events:
+            self.events.stop(max(0, deadline - time.time()))
+        self.stopCapture()
+        self.stopJournal()
+        self.stopHistory()
+
+        if self.handle:
+            try:
+                #self.handle.reset()
+                self.handle.releaseInterface()
+            except Exception, err:
+                print >> sys.stderr, err
+                self.log.error(str(err))
         self.handle, self.device = None, None
+        self.initialised = False
+
+
+    def status(self):
+        """ Returns the health of the driver as a dictionary (see also Watchdog.status) """
+        now = time.time()
+        status = {
+            'initialised': self.initialised,
+            'receiving': self.polling and self.receiver.isAlive(),
+            'secondssincepoll': round(now - self.lastpoll, 3),
+            'secondssincetransfer': round(now - self.lasttransfer, 3),
+            'reads': self.reads,
+            'readtimeouts': self.readtimeouts,
+            'readerrors': self.readerrors,
+            'writes': self.writes,
+            'writeerrors': self.writeerrors,
+            'errorsinarow': self.errorrun,
+            'receivequeue': self.receivequeuecount,
+            'sendsinprogress': self.inflight,
+            'awaitingack': len(self.pending),
+            'ackresyncs': self.resyncs,
+        }
+        if self.watchdog:
+            status['watchdog'] = self.watchdog.status()
+        if self.history:
+            status['history'] = self.history.status()
+        return status
+
+
+    def _restart_receiver(self):
+        # The receive thread has died (or is stuck in a read) so carry on reading in a new one (a Thread cannot be started twice)
+        self.receiver = threading.Thread(target=self.run, name="CM19a receiver")
+        self.receiver.setDaemon(self.isDaemon())
+        self.receiver.start()
+        return True
+
+
+    def _recover(self, step):
+        """
+            Runs a watchdog recovery step (the name of one of the methods below) with nothing else reading or writing
+            A read or write still in progress after RECOVERY_LOCK_WAIT seconds is taken to be stuck (often the very problem
+            being recovered) and the step runs without waiting for it: a stuck read is left with the old read lock and buffer,
+            the step (releasing the interface or resetting the device) should make it return, and a new receive thread is started
+            The sends waiting for an ACK are abandoned as the device will not acknowledge them after it has been recovered
+        """
+        sendlocked = _acquire(self.sendlock, self.RECOVERY_LOCK_WAIT)
+        if not sendlocked:
+            self.log.warning("Watchdog: a write is stuck, recovering without waiting for it")
+        readlock = self.readlock
+        readlocked = _acquire(readlock, self.RECOVERY_LOCK_WAIT)
+        if not readlocked:
+            self.log.warning("Watchdog: a read is stuck, recovering without waiting for it")
+            readlock = threading.RLock()
+            readlock.acquire()
+            self.readbuffer = array.array('B', [0] * self.PACKET_LENGTH)
+            self.readlock = readlock
+        try:
+            return getattr(self, step)()
+        finally:
+            abandoned = self._abandon()
+            if abandoned:
+                self.log.warning("Abandoned %d sends waiting for an ACK while recovering the CM19a" % abandoned)
+            readlock.release()
+            if sendlocked:
+                self.sendlock.release()
+            if not readlocked and self.alive:
+                # (the stuck receive thread stops when it sees it has been replaced)
+                self._restart_receiver()
+
+
+    def _reclaim_interface(self):
+        # First step of recovery: release and claim the interface again
+        self.handle.releaseInterface()
+        self.handle.claimInterface(self.INTERFACE_ID)
+        self.handle.setAltInterface(self.ALTERNATE_SETTING_ID)
+        self._initialise_remotes()
+        return True
+
+
+    def _reset_device(self):
+        # Second step of recovery: USB reset of the CM19a then claim the interface again
+        self.handle.reset()
+        return self._reclaim_interface()
+
+
+    def _reopen_device(self):
+        # Last step of recovery: find the CM19a again (eg after it was unplugged) and open it from scratch
+        if not self.USB_device:
+            # using a handle that was supplied (eg a trace) so there is nothing to reopen
+            return False
+        if self.handle:
+            try:
+                self.handle.releaseInterface()
+            except Exception:
+                pass
+        self.initialised = False
+        self.USB_device = USBdevice(self.VENDOR_ID, self.PRODUCT_ID, self.DEVICE_CACHE)
+        self.device = self.USB_device.device
+        if not self._open_device():
+            return False
+        self._initialise_remotes()
+        return True
 
 
     def print_device_info(self):
-        self.USB_device.print_device_info()
+        if self.USB_device:
+            self.USB_device.print_device_info()
 
 #End class
 
 
-class HTTPServer(BaseHTTPServer.HTTPServer):
+class Watchdog(threading.Thread):
     """
-        Subclasses the BaseHTTPServer and overrides the serve_forever method so that we can interrupt it and quit gracefully
+        Checks the CM19a every 'interval' seconds and recovers it when something has gone wrong
+            - the receive thread has died                   -> the receive thread is restarted
+            - the receive thread is stuck (eg in a read)    -> the device is recovered
+            - 'maxerrors' read/write errors in a row        -> the device is recovered
+        Recovery escalates while the problem persists, one step per check:
+            reclaim the interface, then reset the device, then find and reopen the device from scratch
+        Once a check finds the device healthy again the next problem starts from the first step
     """
-    def serve_forever(self):
-        # override the std serve_forever method which can be stopped only by a Ctrl-C
-        self.alive = True
-        while self.alive:
-            # Continue to respond to HTTP requests until self.alive is set to False
-            self.handle_request()
-        print "HTTP server is shutting down due to a user request"
+
+    STEPS = [("reclaim interface", "_reclaim_interface"),
+             ("reset device", "_reset_device"),
+             ("reopen device", "_reopen_device")]
+
+    def __init__(self, cm19a, interval=5, stall=30, maxerrors=10):
+        threading.Thread.__init__(self, name="CM19a watchdog")
+        self.setDaemon(True)
+        self.cm19a = cm19a
+        self.interval = interval
+        self.stall = stall
+        self.maxerrors = maxerrors
+        self.step = 0                   # Next recovery step to try (0 = the device is healthy)
+        self.problem = None             # The problem found by the last check (None if healthy)
+        self.lastproblem = None         # (time, problem) of the last problem found
+        self.lastrecovery = None        # (time, step, True/False) of the last recovery attempted
+        self.recoveries = 0             # Number of recovery steps tried
+        self.restarts = 0               # Number of times the receive thread was restarted
+        self.checks = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.isSet():
+            self.stopped.wait(self.interval)
+            if self.stopped.isSet() or self.cm19a.closing:
+                break
+            try:
+                self.check()
+            except Exception, err:
+                self.cm19a.log.error("Watchdog: %s" % err)
+
+    def stop(self):
+        self.stopped.set()
+
+    def check(self):
+        """ Checks the receive thread and the transfers, recovering anything that has gone wrong """
+        cm19a = self.cm19a
+        self.checks += 1
+
+        if not cm19a.receiver.isAlive() and cm19a.alive:
+            # the receive thread died (eg an exception) without being asked to stop
+            self._found("the receive thread has stopped")
+            cm19a._restart_receiver()
+            self.restarts += 1
+            cm19a.log.warning("Watchdog: receive thread restarted")
+            return
+
+        problem = None
+        if cm19a.errorrun >= self.maxerrors:
+            problem = "%d USB errors in a row" % cm19a.errorrun
+        elif not cm19a.paused and time.time() - cm19a.lastpoll > self.stall:
+            problem = "no read finished for %.0f seconds" % (time.time() - cm19a.lastpoll)
+
+        if not problem:
+            if self.problem:
+                cm19a.log.info("Watchdog: the CM19a is working again")
+            self.problem = None
+            self.step = 0
+            return
+
+        self._found(problem)
+        self.recover()
+
+    def recover(self):
+        """ Tries the next recovery step (the last step is repeated until it works, eg until the CM19a is plugged back in) """
+        cm19a = self.cm19a
+        name, method = self.STEPS[min(self.step, len(self.STEPS) - 1)]
+        self.step += 1
+        self.recoveries += 1
+        try:
+            ok = cm19a._recover(method)
+        except Exception, err:
+            cm19a.log.error("Watchdog: %s failed: %s" % (name, err))
+            ok = False
+        self.lastrecovery = (time.time(), name, ok)
+        if ok:
+            # give the device a fresh start before judging it again
+            cm19a.errorrun = 0
+            cm19a.lastpoll = cm19a.lasttransfer = time.time()
+            cm19a.log.warning("Watchdog: %s done" % name)
+
+    def _found(self, problem):
+        if self.problem is None:
+            # log when a problem starts rather than at every check (each recovery step is logged as it is tried)
+            self.cm19a.log.error("Watchdog: %s" % problem)
+        self.problem = problem
+        self.lastproblem = (time.time(), problem)
+
+    def status(self):
+        """ Returns the watchdog's view of the device as a dictionary """
+        status = {
+            'healthy': self.problem is None,
+            'problem': self.problem,
+            'checks': self.checks,
+            'recoveries': self.recoveries,
+            'receiverrestarts': self.restarts,
+            'nextstep': self.STEPS[min(self.step, len(self.STEPS) - 1)][0],
+        }
+        if self.lastproblem:
+            status['lastproblem'] = {'time': self.lastproblem[0], 'problem': self.lastproblem[1]}
+        if self.lastrecovery:
+            status['lastrecovery'] = {'time': self.lastrecovery[0], 'step': self.lastrecovery[1], 'ok': self.lastrecovery[2]}
+        return status
+#end of class
+
+
+class Trace:
+    """ The time each stage of a command took (see CM19aDevice.sendTraced) """
+    def __init__(self, traceid, stages=()):
+        self.id = traceid                   # Correlation id (eg from the client's X-Request-ID header)
+        self.stages = list(stages)          # [(stage, ms since the previous stage)]
+        self.last = time.time()
+
+    def mark(self, stage):
+        now = time.time()
+        self.stages.append((stage, round((now - self.last) * 1000, 3)))
+        self.last = now
+
+    def __str__(self):
+        return "total=%.3fms %s" % (sum([ms for stage, ms in self.stages]), " ".join(["%s=%.3fms" % stage for stage in self.stages]))
+#end of class
+
+
+class PendingSend:
+    """ A frame written to the CM19a that is waiting for an ACK """
+    def __init__(self, frame):
+        self.frame = frame
+        self.acked = threading.Event()      # Set when acknowledged (or abandoned)
+        self.abandoned = False              # True if it stopped waiting without an ACK (see CM19aDevice._resync)
+        self.time = time.time()
+#end of class
 
 
-class HTTPhandler(BaseHTTPServer.BaseHTTPRequestHandler):
+class Subscriber:
+    """ A function subscribed to the commands received by a CM19aDevice
+        Commands wait in a bounded backlog until a worker thread calls the function
+        Commands received while the backlog is full are dropped (and counted)
     """
-        Processes HTTP requests
-        Subclasses the BaseHTTPServer and adds additional functionality
 
-        HTTP reponse codes
-            200 OK
-            400 Bad Request
-            500 Error
+    def __init__(self, callback, filter=None, maxbacklog=100):
+        self.callback = callback
+        self.filter = filter            # None (all commands), a trigger style pattern (eg A*) or a function that returns True for wanted commands
+        self.maxbacklog = maxbacklog
+        self.backlog = collections.deque()
+        self.delivered = 0              # Number of commands passed to the callback
+        self.dropped = 0                # Number of commands dropped because the backlog was full
+        self.scheduled = False          # True while the subscriber is waiting for or running on a worker
+        self.lock = threading.Lock()
+        if isinstance(self.filter, types.StringTypes):
+            self.filter = self.filter.replace(" ", "").upper()
+
+    def wants(self, command):
+        if self.filter is None:
+            return True
+        elif callable(self.filter):
+            return self.filter(command)
+        else:
+            return fnmatch.fnmatchcase(command, self.filter)
+#end of class
+
+
+class EventDispatcher:
+    """
+        Passes received commands to the subscribers on a pool of worker threads
+        so a slow subscriber cannot hold up the thread receiving from the CM19a
+        Each subscriber's commands are delivered in the order they were received
     """
 
-    server_version= "MyHandler/1.1"
-
-    def do_GET(self):
-        #self.log_message("Command: %s Path: %s Headers: %r" % (self.command, self.path, self.headers.items()))
-        self.processRequest(None)
-
-
-    def do_POST(self):
-        # A form is posted via a HTML post
-        self.sendPage(400, "text/html", "HTML forms/web pages not yet implemnted")
-        return
-        #self.log_message("Command: %s Path: %s Headers: %r" % ( self.command, self.path, self.headers.items()))
-        #if self.headers.has_key('content-length'):
-        #    length= int(self.headers['content-length'])
-        #    self.dumpReq(self.rfile.read(length))
-        #else:
-        #    self.processRequest(None)
-
-
-    def processRequest(self, formInput=None):
-        # Example client calls
-        # http://192.168.1.3:8008/?house=A&unit=1&command=ON
-        # http://192.168.1.3:8008/?house=A&unit=1&command=DIM
-        # http://192.168.1.3:8008?command=getqueue
-        # http://192.168.1.3:8008?command=getlog
-        # http://192.168.1.3:8008?command=quit
-
-        # remove leading gumph
-        qmarkpos = self.path.find('?')
-        self.path = self.path[qmarkpos+1:]
-
-        # replace any escaped spaces with a real space
-        self.path = self.path.replace('%20',  " ")
-        respcode = 200
-
-        # extract the arguments
-        argsdict = {}
-        for arg in self.path.split('&'):
-            if arg.find('=') >= 0:
-                key = arg.split('=')[0]
-                value = arg.split('=')[1]
-                argsdict[key] = value
-
-        house = ""
-        unit = ""
-        command = ""
-
-        if 'house' in argsdict:
-            house = argsdict['house'].lower()
-        if 'unit' in argsdict:
-            unit = argsdict['unit']
-        if 'command' in argsdict:
-            command = argsdict['command'].lower()
-
-        if command in ['on', 'off', 'dim', 'bright', 'allon', 'alloff']:
-            # Valid command request
+    def __init__(self, log, workers=2):
+        self.log = log
+        self.workers = workers
+        self.subscribers = []           # Replaced (never changed in place) so publish() can loop through it without a lock
+        self.ready = Queue.Queue()      # Subscribers with commands waiting to be delivered
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def subscribe(self, callback, filter=None, maxbacklog=100):
+        subscriber = Subscriber(callback, filter, maxbacklog)
+        self.lock.acquire()
+        try:
+            self.subscribers = self.subscribers + [subscriber]
+            if not self.threads:
+                # Start the workers when they are first needed
+                for i in range(self.workers):
+                    thread = threading.Thread(target=self._worker, name="CM19a subscriber %d" % (i + 1))
+                    thread.setDaemon(True)
+                    thread.start()
+                    self.threads.append(thread)
+        finally:
+            self.lock.release()
+        return subscriber
+
+    def unsubscribe(self, callback):
+        """ Removes a subscriber ('callback' is the function subscribed or the Subscriber returned by subscribe) """
+        self.lock.acquire()
+        try:
+            subscribers = [s for s in self.subscribers if s is not callback and s.callback != callback]
+            found = len(subscribers) < len(self.subscribers)
+            self.subscribers = subscribers
+        finally:
+            self.lock.release()
+        return found
+
+    def publish(self, command):
+        """ Adds a command to the backlog of every subscriber that wants it """
+        for subscriber in self.subscribers:
+            if not subscriber.wants(command):
+                continue
+            subscriber.lock.acquire()
             try:
-                response = cm19a.send(house, unit, command)     # True if the command was sent OK
-            except:
-                response = False
-        elif command in ['getqueue', 'receive', 'getreceivequeue']:
-            response = cm19a.getReceiveQueue()
-            if len(response) > 0:
-                response = ','.join(response)
-            else:
-                response = "Receive queue is empty"
-        elif command in ['clearqueue',]:
-            # clear the queue
-            cm19a.paused = True
-            cm19a.receivequeue = []
-            cm19a.receivequeuecount = 0
-            cm19a.paused = False
-            response = "Receive queue emptied successfully"
-        elif command in ['quit', 'shutdown', 'exit']:
-            response = "Shutting down the server..."
-            # Do a fake call so that the server can terminate
-            global server
-            if server.alive:
-                server.alive = False
-                conn = httplib.HTTPConnection("%s:%s" % (SERVER_IP_ADDRESS, SERVER_PORT))
-                conn.request("GET", '?command=nothing')
-        elif command in ['getversion', 'version']:
-            response = VERSION
-        elif command in ['getlogs',  'getlog']:
-            # Returns the Logs (text only)
-            if not os.path.isfile(LOGFILE):
-                log.error("%s log file missing %s" % LOGFILE)
-                response = ''
-            else:
-                respcode = 200
-                response = "CM19a Device Driver Log\n"
-                f = open(LOGFILE, "r")
-                for aline in f.readlines():
-                    response += aline
-                f.close()
-        elif command in ['getformattedlog',]:
-            # Returns the Logs with HTML formatting for display purposes
-            if not os.path.isfile(LOGFILE):
-                log.error("%s log file missing %s" % LOGFILE)
-                response = ''
-            else:
-                respcode = 200
-                response = "<html><body><p style='font-family:Arial;font-size:14pt;font-weight:bold;color:navy;line-height:100%%'>CM19a Device Driver Log</p>"
-                f = open(LOGFILE, "r")
-                for aline in f.readlines():
-                    if aline.lower().find('critical') >= 0:
-                        response +=  "<p style='font-family:Arial;font-size:10pt;font-weight:bold;color:white;background-color:red;line-height:100%%'>%s</p>" % aline
-                    elif aline.lower().find('error') >= 0:
-                        response +=  "<p style='font-family:Arial;font-size:10pt; font-weight:normal;color:white;background-color:red;line-height:100%%'>%s</p>" % aline
-                    elif aline.lower().find('warning') >= 0:
-                        response +=  "<p style='font-family:Arial;font-size:10pt; font-weight:bold;color:olive;background-color:yellow;line-height:100%%'>%s</p>" % aline
-                    else:
-                        response +=  "<p style='font-family:Arial;font-size:10pt; font-weight:normal;color:gray;background-color:white;line-height:30%%'>%s</p>" % aline
-                f.close()
-                response += "</body></html>"
-        else:
-            # error no command request
-            respcode = 400
-            response = "NAK: Invalid 'command' value"
-
-        if type(response) == types.BooleanType:
-            if response:
-                respcode = 200
-                response = "ACK"
-            else:
-                reposcode = 500
-                response = "NAK"
+                if len(subscriber.backlog) >= subscriber.maxbacklog:
+                    subscriber.dropped += 1
+                    continue
+                subscriber.backlog.append(command)
+                if subscriber.scheduled:
+                    # A worker already has this subscriber
+                    continue
+                subscriber.scheduled = True
+            finally:
+                subscriber.lock.release()
+            self.ready.put(subscriber)
+
+    def stop(self, timeout=None):
+        """ Stops the workers once they have delivered the commands already waiting (waits up to 'timeout' seconds) """
+        for thread in self.threads:
+            self.ready.put(None)
+        deadline = time.time() + (timeout or 0)
+        for thread in self.threads:
+            if timeout and thread is not threading.currentThread():
+                thread.join(max(0, deadline - time.time()))
+        self.threads = []
+
+    def _worker(self):
+        while True:
+            subscriber = self.ready.get()
+            if subscriber is None:
+                # stop() was called
+                break
+            while True:
+                subscriber.lock.acquire()
+                try:
+                    if not subscriber.backlog:
+                        subscriber.scheduled = False
+                        break
+                    command = subscriber.backlog.popleft()
+                finally:
+                    subscriber.lock.release()
+                try:
+                    subscriber.callback(command)
+                except Exception, err:
+                    self.log.error("Subscriber %r failed for %s: %s" % (subscriber.callback, command, err))
+                subscriber.delivered += 1
+#end of class
+
+
+class RuleEngine:
+    """
+        Runs macros (rules) as soon as a command is received from an RF remote
+        A rule maps a trigger (eg A4ON) to a sequence of actions (eg E 1 ON; E 1 DIM; E 2 OFF)
+        Rules are compiled into a dict keyed on the decoded command so nothing needs to be searched or parsed when a command arrives
+
+        Triggers
+            A4ON                    An exact command
+            A*, A*ON                Use * as a wildcard for the unit number and/or command
+            *BRIGHTBUTTONPRESSED    The bright button on a remote for any house code
+            *                       Any command (exact triggers take precedence over wildcards)
+
+        Actions
+            E 1 ON                  Send a command (house unit function)
+            LAST BRIGHT             Send a command to the last device addressed
+            REPEAT                  Re-send the command that was received
+            A function (added via add() only) that is called with the command received
+    """
+
+    LAST = "LAST"
+    REPEAT = "REPEAT"
+    SECTION = "[RULES]"
+
+    def __init__(self, cm19a):
+        self.cm19a = cm19a
+        self.rules = []             # List of (trigger, actions) in the order they were added
+        self.dispatch = {}          # Compiled rules {command: actions}
+        self.pending = []           # Commands waiting for the rule that is running to finish
+        self.lock = threading.Lock()
+        self.lasthouse = ''         # Last device addressed
+        self.lastunit = ''
+
+    def load(self, fname):
+        """ Loads the rules from a config file
+            Format: Trigger, action; action; ...
+        """
+        f = open(fname, "r")
+        section = None
+        for aline in f.readlines():
+            aline = aline.strip()
+            if not aline or aline[0] == "#":
+                # comment or blank line so ignore
+                pass
+            elif aline[0] == "[":
+                # new section
+                section = aline
+            elif section == self.SECTION:
+                data = aline.split(',', 1)
+                if len(data) < 2:
+                    self.cm19a.log.error("Invalid rule (no actions): %s" % aline)
+                    continue
+                self.rules.append((data[0].replace(" ", "").upper(), self._parse_actions(data[1].split(';'))))
+        f.close()
+        self.compile()
+        self.cm19a.log.info("%d rules loaded from %s" % (len(self.rules), fname))
+
+    def add(self, trigger, actions):
+        """ Adds a rule
+            'actions' is a list of action strings (eg "E 1 ON") and/or functions
+        """
+        self.rules.append((trigger.replace(" ", "").upper(), self._parse_actions(actions)))
+        self.compile()
+
+    def clear(self):
+        self.rules = []
+        self.dispatch = {}
+
+    def _parse_actions(self, actions):
+        # Converts the action strings to (house, unit, function) tuples
+        parsed = []
+        for action in actions:
+            if callable(action):
+                parsed.append(action)
+                continue
+            words = action.upper().split()
+            if words == [self.REPEAT]:
+                parsed.append((self.REPEAT, None, None))
+            elif len(words) == 2 and words[0] == self.LAST:
+                parsed.append((self.LAST, None, words[1]))
+            elif len(words) == 3:
+                parsed.append(tuple(words))
+            elif words:
+                self.cm19a.log.error("Invalid rule action: %s" % action)
+        return parsed
+
+    def compile(self):
+        """ Builds the dispatch dict from the rules and the commands in the protocol (again if the protocol is reloaded) """
+        commands = self.cm19a.protocol.commands
+        dispatch = {}
+        for trigger, actions in self.rules:
+            if trigger in commands and trigger not in dispatch:
+                dispatch[trigger] = actions
+        for trigger, actions in self.rules:
+            if trigger.find('*') < 0:
+                if trigger not in commands:
+                    self.cm19a.log.warning("Rule trigger %s is not a known command" % trigger)
+                continue
+            for command in commands:
+                if command not in dispatch and fnmatch.fnmatchcase(command, trigger):
+                    dispatch[command] = actions
+        self.dispatch = dispatch
+
+    def fire(self, command):
+        """ Runs the rule (if any) for a received command
+            A command received while a rule is running (eg during its sends) is run after it
+        """
+        if not (self.dispatch or self.lock.locked()):
+            # no rules
+            return
+
+        self.pending.append(command)
+        while self.pending and self.lock.acquire(False):
+            try:
+                while self.pending:
+                    self._run(self.pending.pop(0))
+            finally:
+                self.lock.release()
+
+    def _run(self, command):
+        # Runs the actions for a received command
+        actions = self.dispatch.get(command)
+        frame = self.cm19a.protocol.commands.get(command)
+        if not actions:
+            if frame and frame.unit != '0':
+                self.lasthouse, self.lastunit = frame.house, frame.unit
+            return
 
-        self.sendPage(respcode, "text/html", str(response))
+        self.cm19a.log.info("Running rule for %s" % command)
+        for action in actions:
+            if callable(action):
+                try:
+                    action(command)
+                except Exception, err:
+                    self.cm19a.log.error("Rule for %s failed: %s" % (command, err))
+                continue
+
+            house, unit, function = action
+            if house == self.REPEAT:
+                if not frame:
+                    continue
+                house, unit, function = frame.house, frame.unit, frame.function
+            elif house == self.LAST:
+                if not self.lasthouse:
+                    self.cm19a.log.warning("Rule for %s: no device has been addressed yet" % command)
+                    continue
+                house, unit = self.lasthouse, self.lastunit
+
+            if not self.cm19a.send(house, unit, function):
+                self.cm19a.log.error("Rule for %s: command %s%s %s failed" % (command, house, unit, function))
+            if unit != '0':
+                self.lasthouse, self.lastunit = house, unit
+#end of class
 
-    def sendPage(self, code,  type, body):
-        body+= "\n\r"
-        self.send_response(code)
-        self.send_header("Content-type", type)
-        self.send_header("Content-length", str(len(body)))
-        self.end_headers()
-        self.wfile.write(body)
-# End Class
 
-def startLogging(progname="CM19a_X10_USB", logfile='./cm19a.log'):
-    return logger.start_logging(progname, logfile)
+def startLogging(progname="CM19a_X10_USB", logfile='./cm19a.log', maxbytes=0, backups=5):
+    import logger
+    return logger.start_logging(progname, logfile, maxbytes=maxbytes, backups=backups)
 
 def processcommandline():
     """Process the command line
@@ -738,34 +2095,143 @@ def processcommandline():
            cm19aDriver.py  house&unitcode ON/OFF
            e.g. cm19aDriver.py A 1 ON     # Turns on device A1, returns 1 if OK, 0 if not
            You can only send a command via the command line, you cannot read/receive a wireless command form anX10 remote"
-        Returns 0 is OK, 1 if failure
+
+        Many commands can be sent by one run (the CM19a is initialised only once)
+           cm19aDriver.py A 1 ON A2OFF B 3 DIM          # commands as "A 1 ON" or "A1ON"
+           cm19aDriver.py --delay=0.5 A1ON A2ON          # seconds to wait between commands
+           cm19aDriver.py --file=commands.txt            # one command per line (blank lines and lines starting with # are skipped,
+           cm19aDriver.py -                              #   "delay 2" waits 2 seconds), - reads them from stdin as they arrive
+        Each command's result is printed (OK or FAILED)
+        Returns 0 is OK, 1 if any command failed
     """
 
     # Get the command line arguments
+    delay = 0.0
+    fname = None
+    words = []
     try:
-        house = sys.argv[1]     # First command line argument after the program name
-        unit = sys.argv[2]      # 2nd argument
-        cmd = sys.argv[3]       # 3rd argument
-        print "Doing %s%s %s..." % (house, unit, cmd)
-        result = cm19a.send(house, unit, cmd)     # True if the command was sent OK
-        if result:
-            print "Result: %r" % result
-            returnval = 0
+        for arg in sys.argv[1:]:
+            if arg.startswith('--delay='):
+                delay = float(arg[len('--delay='):])
+            elif arg.startswith('--file='):
+                fname = arg[len('--file='):]
+            elif arg == '-':
+                fname = '-'
+            else:
+                words.append(arg)
+    except ValueError:
+        print >> sys.stderr, "Invalid command line: --delay must be a number of seconds"
+        return 1
+
+    source = None                   # The file the commands are read from (closed when they have been sent)
+    if fname:
+        if fname == '-':
+            lines = iter(sys.stdin.readline, '')        # (each line is sent as soon as it is read)
         else:
-            print  >> sys.stderr, "Command failed: %s%s %s" % (house, unit, cmd)
-            returnval = 1
-    except:
-        print  >> sys.stderr, "Invalid command line"
-        returnval = 1
+            try:
+                lines = source = open(fname, "r")
+            except IOError, err:
+                print >> sys.stderr, "Unable to read %s: %s" % (fname, err)
+                return 1
+        commands = _commandlines(lines)
+    else:
+        commands = _commandwords(words)
 
-    return returnval
+    sent = 0
+    failed = 0
+    try:
+        for command in commands:
+            if command[0] == 'delay':
+                time.sleep(command[1])
+                continue
+            if sent + failed and delay:
+                time.sleep(delay)
+            text, found = command[1], command[2]
+            if found is None:
+                print >> sys.stderr, "%s: FAILED (invalid command)" % text
+                failed += 1
+                continue
+            house, unit, cmd = found
+            print "Doing %s%s %s..." % (house, unit, cmd)
+            try:
+                result = cm19a.send(house, unit, cmd)     # True if the command was sent OK
+            except Exception, err:
+                log.error("Sending %s failed: %s" % (text, err))
+                result = False
+            if result:
+                print "%s%s %s: OK" % (house, unit, cmd)
+                sent += 1
+            else:
+                print  >> sys.stderr, "%s%s %s: FAILED" % (house, unit, cmd)
+                failed += 1
+        #end for
+    finally:
+        if source:
+            source.close()
+
+    if not sent + failed:
+        print  >> sys.stderr, "Invalid command line"
+        return 1
+    if sent + failed > 1:
+        print "%d commands sent, %d failed" % (sent, failed)
+    if failed:
+        return 1
+    return 0
+
+
+SEND_COMMANDS = ['ON', 'OFF', 'DIM', 'BRIGHT', 'ALLON', 'ALLOFF']     # The functions that can be sent (the others are only received from remotes)
+
+def _lookupsend(text):
+    # (house, unit, command) for a command that can be sent, or None (eg not a command or A0BRIGHTBUTTONPRESSED)
+    found = cm19a.lookup(text)
+    if found and found[2].upper() in SEND_COMMANDS:
+        return found
+    return None
+
+
+def _commandwords(words):
+    # Yields ('send', text, (house, unit, command) or None) for the commands in the arguments
+    # A command is one word (A1ON) or three (A 1 ON)
+    i = 0
+    while i < len(words):
+        found = _lookupsend(words[i])
+        if found:
+            yield 'send', words[i], found
+            i += 1
+            continue
+        text = " ".join(words[i:i + 3])
+        found = _lookupsend(text)
+        if found:
+            yield 'send', text, found
+            i += 3
+        else:
+            yield 'send', words[i], None
+            i += 1
+    #end while
+
+
+def _commandlines(lines):
+    # Yields ('send', text, (house, unit, command) or None) for each command line and ('delay', seconds) for "delay 2"
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        words = line.split()
+        if words[0].lower() in ['delay', 'wait', 'sleep'] and len(words) == 2:
+            try:
+                yield 'delay', float(words[1])
+                continue
+            except ValueError:
+                pass
+        yield 'send', line, _lookupsend(line)
+    #end for
 
 
 #Main
 if __name__ == '__main__':
 
     # Configure logging
-    log = startLogging(LOGFILE)
+    log = startLogging(logfile=LOGFILE, maxbytes=LOG_MAX_BYTES, backups=LOG_BACKUPS)
 
     if MODE.lower() == 'command line':
         # Process the command line (send commands only)
@@ -775,12 +2241,16 @@ if __name__ == '__main__':
             print "Command line usage:"
             print "   cm19a_X10_USB.py  house&unitcode ON/OFF"
             print "   e.g. cm19a_X10_USB.py A 1 ON     # Turns on device A1, returns 1 if OK, 0 if not"
+            print "   cm19a_X10_USB.py [--delay=seconds] A 1 ON A2OFF ...     # Several commands with one initialisation"
+            print "   cm19a_X10_USB.py [--delay=seconds] --file=commands.txt  # One command per line (- for stdin)"
             print "   You can only send a command via the command line, you cannot read/receive a wireless command form an X10 remote"
             sys.exit(2)
         else:
             print "\nInitialising..."
             log.info('Initialising...')
-            cm19a = CM19aDevice(REFRESH, log, polling = False)       # Initialise device. Note: auto receiving in a thread is turned off for this example
+            cm19a = CM19aDevice(REFRESH, log, polling = False, verbose = False)       # Initialise device. Note: auto receiving in a thread is turned off for this example
+            if SHOW_STARTUP_TIMING:
+                print "Startup: %s" % cm19a.startupTiming()
             if cm19a.initialised:
                 result = processcommandline()
                 cm19a.finish()
@@ -795,27 +2265,110 @@ if __name__ == '__main__':
         # Note: $? is the exit status/error level. Zero means success
         #    sudo ./cm19aDriver.py A 1 ON
         #    echo "Result: $?"
+        #    sudo ./cm19aDriver.py --delay=0.5 A1ON A2ON A3OFF
+        #    printf "A1ON\ndelay 2\nA1OFF\n" | sudo ./cm19aDriver.py -
 
     elif MODE.lower() in ['http server', 'web server']:
         # Accept commands via http (eg a Web Browser)
+        import cm19ahttp
+        if HTTP_WORKERS:
+            # Several processes handle the HTTP requests and pass the device calls to this one (the only one to open the CM19a)
+            # The workers are started first so no other thread is running when they are forked
+            log.info("Starting %d HTTP workers on %s:%s" % (HTTP_WORKERS, SERVER_IP_ADDRESS, SERVER_PORT))
+            print "Starting %d HTTP workers on %s:%s" % (HTTP_WORKERS, SERVER_IP_ADDRESS, SERVER_PORT)
+            import cm19aproxy
+            server = cm19ahttp.HTTPServer((SERVER_IP_ADDRESS, SERVER_PORT,), cm19ahttp.HTTPhandler, None, log,
+                                          logfile = LOGFILE, capturefile = CAPTURE_FILE, version = VERSION,
+                                          maxconnections = HTTP_MAX_CONNECTIONS, idletimeout = HTTP_IDLE_TIMEOUT, logtail = HTTP_LOG_TAIL,
+                                          rate = HTTP_RATE, burst = HTTP_BURST, maxsends = HTTP_MAX_SENDS)
+            workers = cm19aproxy.start_workers(server, HTTP_WORKERS, SHUTDOWN_TIMEOUT)
+            server = None
+
         print "\nInitialising..."
         log.info('Initialising...')
         cm19a = CM19aDevice(REFRESH, log, polling = True)       # Initialise device. Note: auto polling/receviing in a thread is turned ON
-        if cm19a.initialised:
+        if cm19a.initialised and JOURNAL_DIR:
+            cm19a.startJournal(JOURNAL_DIR, JOURNAL_MAX_BYTES, JOURNAL_MAX_AGE, JOURNAL_SEGMENTS)
+        if cm19a.initialised and HISTORY_DB:
+            cm19a.startHistory(HISTORY_DB, HISTORY_MAX_AGE)
+        if TRACE_LOG:
+            import logger
+            cm19a.tracelog = logger.start_trace_log(TRACE_LOG, LOG_MAX_BYTES, LOG_BACKUPS)
+        listener = None
+        if cm19a.initialised and UDP_PORT:
+            # Low latency commands from sensors and bridges (served by this process, the one that owns the CM19a)
+            import cm19audp
+            listener = cm19audp.UDPListener((SERVER_IP_ADDRESS, UDP_PORT), cm19a, log)
+            listener.start()
+            log.info("Listening for UDP commands on %s:%s" % (SERVER_IP_ADDRESS, UDP_PORT))
+        if cm19a.initialised and HTTP_WORKERS:
+            owner = cm19aproxy.DeviceOwner(cm19a, log)
+            for process, conn in workers:
+                owner.add(conn)
+
+            # Shut down gracefully when asked to by the system (eg during a deploy) or by ?command=quit
+            import signal
+            def stop(signum, frame):
+                owner.quit.set()
+            signal.signal(signal.SIGTERM, stop)
+
+            log.info("Serving the HTTP workers...")
+            print "Serving the HTTP workers..."
+            try:
+                while not owner.quit.isSet():
+                    owner.quit.wait(0.5)
+            except KeyboardInterrupt:
+                pass
+
+            # Let the workers finish their requests, then the sends in progress, then release the CM19a
+            log.info("Shutting down...")
+            deadline = time.time() + SHUTDOWN_TIMEOUT
+            cm19aproxy.stop_workers(workers, SHUTDOWN_TIMEOUT)
+            if listener:
+                listener.stop(max(0, deadline - time.time()))
+            cm19a.finish(max(0, deadline - time.time()))
+            log.info("All done")
+            import logging
+            logging.shutdown()          # flush the logs
+            sys.exit(0)
+        elif cm19a.initialised:
             log.info("Configuring the HTTP server on %s:%s" % (SERVER_IP_ADDRESS, SERVER_PORT))
             print "Configuring the HTTP server on %s:%s" % (SERVER_IP_ADDRESS, SERVER_PORT)
-            server = HTTPServer((SERVER_IP_ADDRESS, SERVER_PORT,), HTTPhandler)
+            server = cm19ahttp.HTTPServer((SERVER_IP_ADDRESS, SERVER_PORT,), cm19ahttp.HTTPhandler, cm19a, log,
+                                          logfile = LOGFILE, capturefile = CAPTURE_FILE, version = VERSION,
+                                          maxconnections = HTTP_MAX_CONNECTIONS, idletimeout = HTTP_IDLE_TIMEOUT, logtail = HTTP_LOG_TAIL,
+                                          rate = HTTP_RATE, burst = HTTP_BURST, maxsends = HTTP_MAX_SENDS)
+            # Shut down gracefully when asked to by the system (eg during a deploy)
+            import signal
+            def stop(signum, frame):
+                server.alive = False
+            signal.signal(signal.SIGTERM, stop)
+
             log.info("Starting the HTTP server...")
             print "Starting the HTTP server..."
-            server.serve_forever()
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+
             # Finish and tidy up
+            # Stop accepting requests, let the requests and sends in progress finish and then release the CM19a
+            log.info("Shutting down...")
+            deadline = time.time() + SHUTDOWN_TIMEOUT
+            server.stop(SHUTDOWN_TIMEOUT)
+            if listener:
+                listener.stop(max(0, deadline - time.time()))
+            cm19a.finish(max(0, deadline - time.time()))
             server = None
             log.info("All done")
-            cm19a.finish()
+            import logging
+            logging.shutdown()          # flush the logs
             sys.exit(0)
         else:
             print "Error initialising the CM19a...exiting..."
             log.error("Error initialising the CM19a...exiting...")
+            if HTTP_WORKERS:
+                cm19aproxy.stop_workers(workers, SHUTDOWN_TIMEOUT)
             cm19a.finish()
             sys.exit(1)
 
@@ -825,8 +2378,16 @@ if __name__ == '__main__':
         #   http://192.168.1.3:8008?command=clearqueue
         #   http://192.168.1.3:8008?command=getlog
         #   http://192.168.1.3:8008?command=getformattedlog
+        #   http://192.168.1.3:8008?command=getjournal&limit=50       The last 50 commands sent and received as JSON (start=&end= for a time range, see cm19ajournal.py)
+        #   http://192.168.1.3:8008?command=gethistory&house=A&unit=1&limit=20     The last 20 commands for A1 from the history (function=, direction=S/R, start=, end= to filter, see cm19ahistory.py)
         #   http://192.168.1.3:8008?command=getversion
+        #   http://192.168.1.3:8008?command=reloadprotocol        Reloads CM19aProtocol.ini (eg after adding remote codes) without restarting
+        #   http://192.168.1.3:8008?command=getstatus             Receive thread and USB health as JSON (503 while the watchdog is recovering the CM19a)
+        #   http://192.168.1.3:8008?command=profile&seconds=10    Collapsed stacks of every thread (mode=calls for cProfile), memsnapshot/memdiff for growth (see cm19aprofile.py)
+        #   http://192.168.1.3:8008?command=scene&scene=C1OFF,C2OFF,C3OFF,C5ON&housewide=C     Sends a scene in as few frames as possible (here C ALLOFF then C5 ON)
+        #   http://192.168.1.3:8008?command=startcapture          Records every raw read to CAPTURE_FILE until stopcapture (replay it with cm19atrace.py)
         #   http://192.168.1.3:8008?command=quit                  Gracefully shuts down the driver
+        #   POST a JSON array of commands to http://192.168.1.3:8008/ to send them as one batch (see HTTPhandler.do_POST in cm19ahttp.py)
 
         # Example command line using the cURL (a command line URL client that send the command via http)
         #   sudo ./cm19aDriver.py (ensure MODE = 'HTTP SERVER')
@@ -835,6 +2396,11 @@ if __name__ == '__main__':
         #   result=`curl --silent http://192.168.1.3:8008/?command=getqueue`                NOTE the use of the ` character - this is not a single quote
         #   echo $result
         #   curl --silent http://192.168.1.3:8008/?command=quit
+        #   curl --silent -d '["A1ON", "A2ON", {"house": "E", "unit": "1", "command": "DIM"}]' http://192.168.1.3:8008/
+
+        # Example UDP commands (set UDP_PORT, see cm19audp.py)
+        #   echo -n "A1ON A2OFF" | nc -u -w0 192.168.1.3 8009              Fire and forget
+        #   ./cm19audp.py 192.168.1.3:8009 A1ON A2OFF                       Waits for the acknowledgement (#seq ACK or #seq NAK ...)
     else:
         print "Please set the MODE of operation."
 
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+"""
+A searchable history of every command sent and received by the CM19a driver (see cm19adriver.py)
+Kept in an SQLite database (in WAL mode so searching never holds up recording) with indexes on the time,
+house/unit and function so eg "when did A1 last go ON" takes milliseconds however many months are kept
+
+    cm19a.startHistory('./cm19a.db')   (done by the HTTP server when HISTORY_DB is set)
+    http://192.168.1.3:8008?command=gethistory&house=A&unit=1&limit=20                  The last 20 commands for A1
+    http://192.168.1.3:8008?command=gethistory&function=ON&direction=R&start=1318000000  ONs received since a time (seconds since the epoch)
+
+Commands are queued by record() and written in batches by a background thread (one transaction every
+'interval' seconds or 'batch' commands) so sending and receiving never wait for the disk.
+A command can therefore take up to 'interval' seconds to appear in a search.
+
+    python cm19ahistory.py ./cm19a.db [house [unit]]       Prints the last commands in a history database
+"""
+
+import sys, time, threading, collections, sqlite3
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY,
+        time REAL NOT NULL,
+        direction TEXT NOT NULL,
+        command TEXT NOT NULL,
+        house TEXT,
+        unit TEXT,
+        function TEXT,
+        result INTEGER,
+        raw TEXT)""",
+    "CREATE INDEX IF NOT EXISTS events_time ON events (time)",
+    "CREATE INDEX IF NOT EXISTS events_unit ON events (house, unit, time)",
+    "CREATE INDEX IF NOT EXISTS events_function ON events (function, time)",
+]
+COLUMNS = ['time', 'direction', 'command', 'house', 'unit', 'function', 'result', 'raw']
+
+
+class History:
+    """ Records commands to an SQLite database from a background thread and searches it """
+
+    def __init__(self, fname, lookup=None, batch=200, interval=1.0, maxqueue=10000, maxage=None):
+        self.fname = fname
+        self.lookup = lookup            # Returns (house, unit, function) for a command (eg CM19aDevice.lookup) so they can be searched on
+        self.batch = batch              # Most commands written in one transaction
+        self.interval = interval        # Seconds between writes
+        self.maxqueue = maxqueue        # Commands held waiting to be written, any more are dropped (see dropped)
+        self.maxage = maxage            # Commands older than this many seconds are deleted (None = kept for ever)
+        self.queue = collections.deque()
+        self.wakeup = threading.Event()
+        self.local = threading.local()  # Each searching thread has its own connection
+        self.written = 0
+        self.dropped = 0
+        self.lastpurge = 0
+
+        connection = self._connect()    # (create the database before anything is recorded)
+        connection.execute("PRAGMA journal_mode=WAL")
+        for statement in SCHEMA:
+            connection.execute(statement)
+        connection.commit()
+
+        self.alive = True
+        self.writer = threading.Thread(target=self._write, name="CM19a history writer")
+        self.writer.setDaemon(True)
+        self.writer.start()
+
+    def record(self, direction, command, raw=(), result=None):
+        """ Queues a command to be written: 'direction' is S (sent) or R (received), 'raw' the bytes, 'result' True/False for a send """
+        if len(self.queue) >= self.maxqueue:
+            self.dropped += 1
+            return
+        self.queue.append((time.time(), direction, command, raw, result))
+        if len(self.queue) >= self.batch:
+            self.wakeup.set()
+
+    def query(self, house=None, unit=None, function=None, direction=None, start=None, end=None, command=None, limit=100):
+        """
+            Returns up to 'limit' commands (dicts with the COLUMNS) matching every filter given, oldest first
+            From 'start' (seconds since the epoch) onwards or, with no 'start', the last ones before 'end'
+        """
+        where = []
+        args = []
+        for column, value in [('house', house), ('unit', unit), ('function', function), ('direction', direction), ('command', command)]:
+            if value is not None:
+                where.append("%s = ?" % column)
+                args.append(str(value).upper())
+        if start is not None:
+            where.append("time >= ?")
+            args.append(start)
+        if end is not None:
+            where.append("time <= ?")
+            args.append(end)
+        sql = "SELECT %s FROM events" % ", ".join(COLUMNS)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        if start is not None:
+            sql += " ORDER BY time LIMIT ?"
+        else:
+            sql += " ORDER BY time DESC LIMIT ?"
+        args.append(int(limit))
+
+        rows = self._connect().execute(sql, args).fetchall()
+        if start is None:
+            rows.reverse()
+        events = []
+        for row in rows:
+            event = dict(zip(COLUMNS, row))
+            if event['result'] is not None:
+                event['result'] = bool(event['result'])
+            events.append(event)
+        return events
+
+    def status(self):
+        return {'written': self.written, 'waiting': len(self.queue), 'dropped': self.dropped}
+
+    def close(self, timeout=5):
+        """ Writes the commands still waiting and stops the writer """
+        self.alive = False
+        self.wakeup.set()
+        self.writer.join(timeout)
+
+    def _connect(self):
+        # The calling thread's connection (sqlite3 connections cannot be shared between threads)
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = sqlite3.connect(self.fname, timeout=10)
+            connection.execute("PRAGMA synchronous=NORMAL")       # (WAL is still safe after a crash, only the last commits can be lost)
+        return connection
+
+    def _write(self):
+        # Runs in a thread: writes the queued commands in batches until closed
+        connection = self._connect()
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            while self.queue:
+                rows = []
+                while self.queue and len(rows) < self.batch:
+                    timestamp, direction, command, raw, result = self.queue.popleft()
+                    house = unit = function = None
+                    if self.lookup:
+                        try:
+                            house, unit, function = self.lookup(command) or (None, None, None)
+                        except Exception:
+                            pass
+                    rows.append((timestamp, direction, command, house, unit, function,
+                                 {True: 1, False: 0}.get(result), " ".join(["%02x" % b for b in raw])))
+                try:
+                    connection.executemany("INSERT INTO events (%s) VALUES (?, ?, ?, ?, ?, ?, ?, ?)" % ", ".join(COLUMNS), rows)
+                    connection.commit()
+                    self.written += len(rows)
+                except sqlite3.Error, err:
+                    print >> sys.stderr, "Unable to write %d commands to the history: %s" % (len(rows), err)
+                    self.dropped += len(rows)
+            #end while
+            if self.maxage and time.time() - self.lastpurge > 60 * 60:
+                self._purge(connection)
+            if not self.alive:
+                break
+        #end while
+        connection.close()
+
+    def _purge(self, connection):
+        # Deletes the commands older than maxage (hourly)
+        self.lastpurge = time.time()
+        try:
+            connection.execute("DELETE FROM events WHERE time < ?", (self.lastpurge - self.maxage,))
+            connection.commit()
+        except sqlite3.Error, err:
+            print >> sys.stderr, "Unable to delete old commands from the history: %s" % err
+#end of class
+
+
+#Main
+if __name__ == '__main__':
+    if len(sys.argv) <= 1:
+        print "Usage: cm19ahistory.py database [house [unit]]"
+        sys.exit(2)
+
+    history = History(sys.argv[1])
+    for event in history.query(house=len(sys.argv) > 2 and sys.argv[2] or None, unit=len(sys.argv) > 3 and sys.argv[3] or None, limit=20):
+        print "%s %s %-24s %-8s %s" % (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(event['time'])), event['direction'], event['command'],
+                                      {True: "ACK", False: "NAK", None: ""}[event['result']], event['raw'])
+    history.close()
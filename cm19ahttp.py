@@ -0,0 +1,777 @@
+#!/usr/bin/env python
+
+"""
+The HTTP server for the CM19a driver (see cm19adriver.py)
+Loaded only when the driver runs in 'HTTP Server' mode
+
+Example client calls
+    http://192.168.1.3:8008/?house=A&unit=1&command=ON
+    http://192.168.1.3:8008?command=getqueue
+    POST a JSON array of commands to http://192.168.1.3:8008/ to send them as one batch (see HTTPhandler.do_POST)
+
+Each send is timed stage by stage (see CM19aDevice.sendTraced) under a correlation id: the client's X-Request-ID header
+(or a requestid parameter) or a new one. The id comes back in the X-Request-ID header and the stage timings in a
+Server-Timing header (and in the JSON response to a POST), and both are written to the driver's TRACE_LOG
+
+Admission control (see AdmissionControl): each client (IP address) may make 'rate' requests a second with bursts of up to
+'burst' (a POST batch counts each of its commands, so a batch of more than 'burst' commands is refused with
+413 Request Entity Too Large) and at most 'maxsends' sends may be in progress at once. Requests over the
+limits are answered straight away with 429 Too Many Requests or 503 Service Unavailable and a Retry-After header, and are
+counted in ?command=getstatus. The limits apply to each HTTP worker process on its own
+
+The log pages (getlog, getformattedlog) carry an ETag and Last-Modified so a client refreshing them gets 304 Not Modified
+until the log changes, and responses are gzipped for clients that accept it
+"""
+
+import time, os, re, math, threading, itertools, types, json, zlib, collections, email.utils
+import socket, BaseHTTPServer, SocketServer
+
+GZIP_MIN_BYTES = 1024                       # Smaller responses are not worth compressing
+
+
+class HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+        Subclasses the BaseHTTPServer and overrides the serve_forever method so that we can interrupt it and quit gracefully
+        Each connection is handled in its own thread so a client can hold a keep-alive connection open without blocking others
+    """
+    daemon_threads = True
+    timeout = 0.5                           # handle_request() returns after this many seconds without a request so serve_forever() can check alive
+
+    def __init__(self, server_address, RequestHandlerClass, cm19a, log, logfile='./cm19a.log', capturefile='./cm19a.trace',
+                 version='', maxconnections=20, idletimeout=30, logtail=64 * 1024, rate=0, burst=0, maxsends=0):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, RequestHandlerClass)
+        self.cm19a = cm19a                  # The CM19aDevice commands are sent to (a cm19aproxy.DeviceProxy in an HTTP worker process)
+        self.onquit = None                  # Called by ?command=quit (eg to shut down the other HTTP workers)
+        self.log = log
+        self.logfile = logfile              # Returned by ?command=getlog
+        self.logtail = logtail              # ... at most this many bytes from the end of it
+        self.logcache = LogCache(logfile, logtail)
+        self.admission = AdmissionControl(rate, burst, maxsends)
+        self.capturefile = capturefile      # Raw reads are recorded here after ?command=startcapture
+        self.version = version              # Driver version returned by ?command=getversion
+        self.maxconnections = maxconnections
+        self.idletimeout = idletimeout      # Close a keep-alive connection after this many seconds without a request
+        self.connections = 0                # Number of open connections
+        self.requests = set()               # Sockets of the open connections
+        self.connectionslock = threading.Lock()
+
+    def serve_forever(self):
+        # override the std serve_forever method which can be stopped only by a Ctrl-C
+        self.alive = True
+        while self.alive:
+            # Continue to respond to HTTP requests until self.alive is set to False
+            self.handle_request()
+        print "HTTP server is shutting down due to a user request"
+
+    def stop(self, timeout=10):
+        """
+            Stops accepting connections and waits up to 'timeout' seconds for the requests in progress to finish
+            Returns True if every connection closed in time
+        """
+        self.alive = False
+        self.server_close()
+
+        # Stop reading from the open connections: a request in progress still gets its response
+        # but idle keep-alive connections close straight away rather than waiting for another request
+        self.connectionslock.acquire()
+        requests = list(self.requests)
+        self.connectionslock.release()
+        for request in requests:
+            try:
+                request.shutdown(socket.SHUT_RD)
+            except socket.error:
+                pass
+
+        deadline = time.time() + timeout
+        while self.connections and time.time() < deadline:
+            time.sleep(0.05)
+        if self.connections:
+            self.log.warning("HTTP server stopped with %d connections still open" % self.connections)
+        return self.connections == 0
+
+    def process_request(self, request, client_address):
+        # Refuse the connection if there are already too many open
+        self.connectionslock.acquire()
+        try:
+            full = self.connections >= self.maxconnections
+            if not full:
+                self.connections += 1
+                self.requests.add(request)
+        finally:
+            self.connectionslock.release()
+
+        if full:
+            # (close the socket directly since close_request() counts the connection as closed)
+            try:
+                request.sendall("HTTP/1.1 503 Service Unavailable\r\nConnection: close\r\nContent-length: 0\r\n\r\n")
+                request.shutdown(socket.SHUT_WR)
+            except socket.error:
+                pass
+            request.close()
+            return
+
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+    def close_request(self, request):
+        BaseHTTPServer.HTTPServer.close_request(self, request)
+        self.connectionslock.acquire()
+        self.connections -= 1
+        self.requests.discard(request)
+        self.connectionslock.release()
+
+
+class AdmissionControl:
+    """
+        Limits the requests from each client with a token bucket ('rate' tokens a second, holding up to 'burst')
+        and the number of sends in progress at once to 'maxsends' (a 'rate' or 'maxsends' of 0 is no limit)
+    """
+
+    MAX_CLIENTS = 1000                  # Buckets kept before the full (idle) ones are dropped
+
+    def __init__(self, rate=0, burst=0, maxsends=0):
+        self.rate = rate
+        self.burst = max(burst, rate, 1)
+        self.maxsends = maxsends
+        self.buckets = {}               # {client: [tokens, time last refilled]}
+        self.sends = 0                  # Sends in progress
+        self.lock = threading.Lock()
+        self.admitted = 0
+        self.ratelimited = 0            # Requests refused with 429
+        self.overloaded = 0             # Sends refused with 503
+
+    def admit(self, client, cost=1):
+        """
+            Takes 'cost' tokens from the client's bucket. Returns 0 if the request can go ahead, otherwise the seconds until it could
+            (a cost of more than 'burst' is never admitted however long the client waits, see maxBatch)
+        """
+        if not self.rate:
+            self.admitted += 1
+            return 0
+        now = time.time()
+        self.lock.acquire()
+        try:
+            bucket = self.buckets.get(client)
+            if bucket is None:
+                if len(self.buckets) >= self.MAX_CLIENTS:
+                    self._prune(now)
+                bucket = self.buckets[client] = [self.burst, now]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                self.admitted += 1
+                return 0
+            self.ratelimited += 1
+            return (min(cost, self.burst) - bucket[0]) / self.rate
+        finally:
+            self.lock.release()
+
+    def maxBatch(self):
+        """ The most commands a POST batch can have and still be admitted (0 = no limit) """
+        if not self.rate:
+            return 0
+        return int(self.burst)
+
+    def startSend(self):
+        """ Returns False if 'maxsends' sends are already in progress, otherwise counts one until endSend() """
+        self.lock.acquire()
+        try:
+            if self.maxsends and self.sends >= self.maxsends:
+                self.overloaded += 1
+                return False
+            self.sends += 1
+            return True
+        finally:
+            self.lock.release()
+
+    def endSend(self):
+        self.lock.acquire()
+        self.sends -= 1
+        self.lock.release()
+
+    def status(self):
+        return {'admitted': self.admitted, 'ratelimited': self.ratelimited, 'overloaded': self.overloaded,
+                'sendsinprogress': self.sends, 'clients': len(self.buckets)}
+
+    def _prune(self, now):
+        # Drops the buckets that have filled up again (their clients have been idle)
+        for client, (tokens, last) in self.buckets.items():
+            if tokens + (now - last) * self.rate >= self.burst:
+                del self.buckets[client]
+#end of class
+
+
+class LogCache:
+    """
+        The end of the log rendered for ?command=getlog and ?command=getformattedlog
+        Each line is rendered once: when the log grows only the new lines are read and rendered, and the pages
+        (and their gzipped copies) are rebuilt from the rendered lines only when the log has changed since they were last asked for
+        A rotated or truncated log is read again from the start
+    """
+
+    TITLE = {
+        'text': "CM19a Device Driver Log\n",
+        'html': "<html><body><p style='font-family:Arial;font-size:14pt;font-weight:bold;color:navy;line-height:100%'>CM19a Device Driver Log</p>",
+    }
+    END = {'text': "", 'html': "</body></html>"}
+
+    def __init__(self, logfile, tail=64 * 1024):
+        self.logfile = logfile
+        self.tail = tail                    # Keep the lines in at most this many bytes from the end of the log
+        self.lock = threading.Lock()
+        self.read = None                    # (inode, bytes read) of the log
+        self.lines = collections.deque()    # [(line, html)] complete lines at the end of the log
+        self.bytes = 0                      # ... and their total length
+        self.partial = ""                   # The end of the log after the last newline (a line still being written)
+        self.pages = {}                     # {format: (etag, last modified, page, gzipped page)} for the log as last read
+
+    def get(self, format, gzipped=False):
+        """
+            Returns (etag, last modified time, page, gzipped page) with 'format' 'text' or 'html', or None if there is no log
+            The gzipped page is None unless 'gzipped' is True (it is compressed on the first request that wants it)
+        """
+        try:
+            stat = os.stat(self.logfile)
+        except OSError:
+            return None
+        self.lock.acquire()
+        try:
+            if self.read is None or stat.st_ino != self.read[0] or stat.st_size < self.read[1]:
+                # first read, or the log has been rotated or truncated
+                self.lines.clear()
+                self.bytes = 0
+                self.partial = ""
+                self._update(stat.st_ino, max(0, stat.st_size - self.tail), stat.st_size, skipfirst=stat.st_size > self.tail)
+            elif stat.st_size > self.read[1]:
+                self._update(stat.st_ino, self.read[1], stat.st_size)
+
+            etag = '"%x-%x-%s"' % (stat.st_ino, self.read[1], format)
+            page = self.pages.get(format)
+            if page is None or page[0] != etag:
+                body = self.TITLE[format] + "".join([line[format == 'html'] for line in self.lines]) + self.END[format] + "\n\r"
+                page = self.pages[format] = (etag, int(stat.st_mtime), body, None)
+            if gzipped and page[3] is None:
+                page = self.pages[format] = page[:3] + (gzip(page[2]),)
+            return page
+        finally:
+            self.lock.release()
+
+    def _update(self, inode, start, end, skipfirst=False):
+        # Reads and renders the lines from 'start' to 'end' then drops the oldest lines beyond the tail
+        f = open(self.logfile, "r")
+        try:
+            f.seek(start)
+            data = f.read(end - start)
+        finally:
+            f.close()
+        self.read = (inode, start + len(data))
+
+        data = self.partial + data
+        lines = data.split("\n")
+        self.partial = lines.pop()
+        if skipfirst and lines:
+            # the first line is only part of a line
+            lines = lines[1:]
+        for line in lines:
+            line += "\n"
+            self.lines.append((line, render(line)))
+            self.bytes += len(line)
+        while self.bytes > self.tail and self.lines:
+            self.bytes -= len(self.lines.popleft()[0])
+#end of class
+
+
+def render(line):
+    # A line of the log as HTML (errors and warnings highlighted)
+    lower = line.lower()
+    if lower.find('critical') >= 0:
+        return "<p style='font-family:Arial;font-size:10pt;font-weight:bold;color:white;background-color:red;line-height:100%%'>%s</p>" % line
+    elif lower.find('error') >= 0:
+        return "<p style='font-family:Arial;font-size:10pt; font-weight:normal;color:white;background-color:red;line-height:100%%'>%s</p>" % line
+    elif lower.find('warning') >= 0:
+        return "<p style='font-family:Arial;font-size:10pt; font-weight:bold;color:olive;background-color:yellow;line-height:100%%'>%s</p>" % line
+    else:
+        return "<p style='font-family:Arial;font-size:10pt; font-weight:normal;color:gray;background-color:white;line-height:30%%'>%s</p>" % line
+
+
+def serverTiming(stages):
+    # The Server-Timing header for [(stage, ms)]
+    return ", ".join(["%s;dur=%s" % (stage, ms) for stage, ms in stages])
+
+
+def gzip(body):
+    # Returns the body gzip compressed (for Content-Encoding: gzip)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+class HTTPhandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+        Processes HTTP requests
+        Subclasses the BaseHTTPServer and adds additional functionality
+
+        HTTP reponse codes
+            200 OK
+            400 Bad Request
+            500 Error
+    """
+
+    server_version= "MyHandler/1.1"
+    protocol_version = "HTTP/1.1"       # Keep connections open so a client can send many commands (and pipeline them) over one connection
+    wbufsize = -1                       # Buffer the response so the headers and body go out together (flushed after each request)
+
+    SEND_COMMANDS = ['on', 'off', 'dim', 'bright', 'allon', 'alloff']
+    requestids = itertools.count(1)     # Numbers the correlation ids made for requests that did not bring their own
+    requestid = None                    # Correlation id of the request being handled
+
+    def setup(self):
+        self.timeout = self.server.idletimeout
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        # Send each response straight away rather than waiting to fill a packet
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+    def handle_one_request(self):
+        # Each request is profiled while a profile (mode=calls) is running, see cm19aprofile.py
+        profiler = getattr(self.server.cm19a, 'profiler', None)
+        if profiler:
+            profiler.runcall(BaseHTTPServer.BaseHTTPRequestHandler.handle_one_request, self)
+        else:
+            BaseHTTPServer.BaseHTTPRequestHandler.handle_one_request(self)
+
+
+    def do_GET(self):
+        #self.log_message("Command: %s Path: %s Headers: %r" % (self.command, self.path, self.headers.items()))
+        self.requeststart = time.time()
+        self.requestid = None
+        if self.refused():
+            return
+        self.processRequest(None)
+
+
+    def do_POST(self):
+        # A JSON array of commands to send as one batch, eg
+        #   [{"house": "A", "unit": "1", "command": "ON"}, "A2OFF", "E 1 DIM"]
+        # Returns a JSON object with the result (ACK/NAK) and time taken for each command, the correlation id and the time each stage took
+        self.requeststart = time.time()
+        self.requestid = self.requestId()
+        if self.refused():
+            # (the body has not been read so the connection cannot be used again)
+            self.close_connection = 1
+            return
+        try:
+            length = int(self.headers.getheader('content-length', 0))
+            commands = json.loads(self.rfile.read(length))
+        except ValueError:
+            # The body may not have been read so the connection cannot be used again
+            self.close_connection = 1
+            self.sendPage(400, "text/html", "NAK: The body must be a JSON array of commands")
+            return
+        if type(commands) != types.ListType:
+            self.sendPage(400, "text/html", "NAK: The body must be a JSON array of commands")
+            return
+
+        starttime = time.time()
+        results = []
+        batch = []
+        for item in commands:
+            command = self.parseCommand(item)
+            if command:
+                results.append({'house': command[0], 'unit': command[1], 'command': command[2]})
+                batch.append(command)
+            else:
+                results.append({'command': item, 'result': "NAK", 'error': "Invalid command"})
+
+        # Each command in the batch counts against the client's rate (the request itself has already been counted)
+        maxbatch = self.server.admission.maxBatch()
+        if maxbatch and len(batch) > maxbatch:
+            # (it could never be admitted so there is no point asking the client to wait)
+            self.sendPage(413, "text/html", "NAK: A batch can have at most %d commands" % maxbatch)
+            return
+        if len(batch) > 1 and self.refused(len(batch) - 1):
+            return
+        if batch and not self.server.admission.startSend():
+            self.sendOverloaded()
+            return
+        try:
+            sent, stages = self.server.cm19a.sendBatchTraced(batch, self.requestid, [('parse', self.elapsed())])
+        finally:
+            if batch:
+                self.server.admission.endSend()
+        sent = iter(sent)
+        for result in results:
+            if 'result' not in result:
+                ok, seconds = sent.next()
+                result['result'] = ok and "ACK" or "NAK"
+                result['time'] = round(seconds * 1000, 1)       # ms
+
+        naks = len([r for r in results if r['result'] == "NAK"])
+        response = {
+            'results': results,
+            'ack': len(results) - naks,
+            'nak': naks,
+            'time': round((time.time() - starttime) * 1000, 1),
+            'requestid': self.requestid,
+            'stages': [{'stage': stage, 'time': ms} for stage, ms in stages],
+        }
+        if naks:
+            respcode = 500
+        else:
+            respcode = 200
+        self.sendPage(respcode, "application/json", json.dumps(response), [("Server-Timing", serverTiming(stages))])
+
+
+    def parseCommand(self, item):
+        """
+            Converts a command from a batch to a (house, unit, command) tuple
+            'item' is either a dict with house, unit and command keys or a string such as "A1ON" or "A 1 ON"
+            Returns None if it is not a valid command to send
+        """
+        try:
+            if type(item) == types.DictType:
+                command = (str(item.get('house', '')).upper(), str(item.get('unit', '')), str(item.get('command', '')).upper())
+            elif isinstance(item, types.StringTypes):
+                command = self.server.cm19a.lookup(str(item))
+            else:
+                command = None
+        except UnicodeError:
+            # not ASCII (JSON strings are unicode) so it cannot be a command
+            return None
+
+        if not command or command[2].lower() not in self.SEND_COMMANDS:
+            return None
+        return command
+
+
+    def sendScene(self, argsdict):
+        # Returns (HTTP response code, JSON response) for ?command=scene
+        scene = []
+        for item in argsdict.get('scene', '').split(','):
+            command = item and self.server.cm19a.lookup(item)
+            if not command or command[2] not in ['ON', 'OFF']:
+                return 400, json.dumps({'error': "Invalid scene unit: %r (eg scene=C1OFF,C2OFF,C5ON)" % item})
+            scene.append(command)
+
+        housewide = argsdict.get('housewide', '0').upper()
+        if housewide in ['1', 'TRUE', 'YES']:
+            housewide = True
+        elif housewide in ['', '0', 'FALSE', 'NO']:
+            housewide = False
+        else:
+            housewide = housewide.replace(" ", "").split(',')
+        allon = argsdict.get('allon', '1').lower() not in ['0', 'false', 'no']
+
+        if argsdict.get('dryrun', '0').lower() in ['1', 'true', 'yes']:
+            plan, naive = self.server.cm19a.optimiseScene(scene, housewide, allon)
+            results = None
+        else:
+            plan, naive, results = self.server.cm19a.sendScene(scene, housewide, allon)
+
+        response = {
+            'plan': ["%s%s%s" % command for command in plan],
+            'frames': len(plan),
+            'naive': naive,
+            'saved': naive - len(plan),
+        }
+        respcode = 200
+        if results is not None:
+            response['results'] = [{'command': "%s%s%s" % command, 'result': ok and "ACK" or "NAK", 'time': round(seconds * 1000, 1)}
+                                   for command, (ok, seconds) in zip(plan, results)]
+            if not all([ok for ok, seconds in results]):
+                respcode = 500
+        return respcode, json.dumps(response)
+
+
+    def processRequest(self, formInput=None):
+        # Example client calls
+        # http://192.168.1.3:8008/?house=A&unit=1&command=ON
+        # http://192.168.1.3:8008/?house=A&unit=1&command=DIM
+        # http://192.168.1.3:8008?command=getqueue
+        # http://192.168.1.3:8008?command=getlog
+        # http://192.168.1.3:8008?command=getjournal&limit=50
+        # http://192.168.1.3:8008?command=gethistory&house=A&unit=1&limit=20
+        # http://192.168.1.3:8008?command=getstatus
+        # http://192.168.1.3:8008?command=profile&seconds=10
+        # http://192.168.1.3:8008?command=scene&scene=C1OFF,C2OFF,C3OFF,C5ON&housewide=C
+        # http://192.168.1.3:8008?command=quit
+        cm19a = self.server.cm19a
+        log = self.server.log
+
+        # remove leading gumph
+        qmarkpos = self.path.find('?')
+        self.path = self.path[qmarkpos+1:]
+
+        # replace any escaped spaces with a real space
+        self.path = self.path.replace('%20',  " ")
+        respcode = 200
+        contenttype = "text/html"
+
+        # extract the arguments
+        argsdict = {}
+        for arg in self.path.split('&'):
+            if arg.find('=') >= 0:
+                key = arg.split('=')[0]
+                value = arg.split('=')[1]
+                argsdict[key] = value
+
+        self.requestid = self.requestId(argsdict)
+        headers = []
+
+        house = ""
+        unit = ""
+        command = ""
+
+        if 'house' in argsdict:
+            house = argsdict['house'].lower()
+        if 'unit' in argsdict:
+            unit = argsdict['unit']
+        if 'command' in argsdict:
+            command = argsdict['command'].lower()
+
+        # Only so many sends at once (see AdmissionControl)
+        sending = command in self.SEND_COMMANDS or (command == 'scene' and argsdict.get('dryrun', '0').lower() not in ['1', 'true', 'yes'])
+        if sending and not self.server.admission.startSend():
+            self.sendOverloaded()
+            return
+
+        if command in self.SEND_COMMANDS:
+            # Valid command request, timed stage by stage under the request's correlation id
+            try:
+                response, stages = cm19a.sendTraced(house, unit, command, self.requestid, [('parse', self.elapsed())])     # True if the command was sent OK
+                headers.append(("Server-Timing", serverTiming(stages)))
+            except:
+                response = False
+            self.server.admission.endSend()
+        elif command in ['getqueue', 'receive', 'getreceivequeue']:
+            response = cm19a.getReceiveQueue()
+            if len(response) > 0:
+                response = ','.join(response)
+            else:
+                response = "Receive queue is empty"
+        elif command in ['clearqueue',]:
+            # clear the queue
+            cm19a.clearReceiveQueue()
+            response = "Receive queue emptied successfully"
+        elif command in ['quit', 'shutdown', 'exit']:
+            response = "Shutting down the server..."
+            # serve_forever() notices within HTTPServer.timeout seconds and the driver then shuts down gracefully
+            self.close_connection = 1
+            self.server.alive = False
+            if self.server.onquit:
+                self.server.onquit()
+        elif command in ['startcapture',]:
+            cm19a.startCapture(self.server.capturefile)
+            response = "Capturing raw reads to %s" % self.server.capturefile
+        elif command in ['stopcapture',]:
+            cm19a.stopCapture()
+            response = "Capture stopped"
+        elif command in ['reloadprotocol',]:
+            # Reload the protocol file (eg after adding remote codes) without restarting
+            ok, response = cm19a.reloadProtocol()
+            if not ok:
+                respcode = 500
+        elif command in ['scene',]:
+            # Puts many units into a state using as few frames as possible (see CM19aDevice.optimiseScene)
+            #   ?command=scene&scene=C1OFF,C2OFF,C5ON&housewide=C      (housewide=1 for every house in the scene, allon=0 to only use ALLOFF, dryrun=1 to plan without sending)
+            try:
+                respcode, response = self.sendScene(argsdict)
+            finally:
+                if sending:
+                    self.server.admission.endSend()
+            contenttype = "application/json"
+        elif command in ['profile',]:
+            # Profiles the driver for a number of seconds (the response comes when it has finished)
+            try:
+                seconds = float(argsdict.get('seconds', 10))
+                if math.isnan(seconds) or math.isinf(seconds) or seconds <= 0:
+                    raise ValueError(seconds)
+            except ValueError:
+                respcode = 400
+                response = "NAK: seconds must be a number greater than 0"
+            else:
+                ok, response = cm19a.profile(seconds, argsdict.get('mode', 'sample').lower())
+                if not ok:
+                    respcode = 409
+                contenttype = "text/plain"
+        elif command in ['memsnapshot',]:
+            response = cm19a.memorySnapshot()
+            contenttype = "text/plain"
+        elif command in ['memdiff',]:
+            ok, response = cm19a.memoryDiff()
+            if not ok:
+                respcode = 409
+            contenttype = "text/plain"
+        elif command in ['getstatus', 'status']:
+            # Health of the receive thread and the USB transfers (503 while the watchdog is dealing with a problem)
+            status = cm19a.status()
+            status['admission'] = self.server.admission.status()
+            if not status['initialised'] or not status.get('watchdog', {}).get('healthy', True):
+                respcode = 503
+            contenttype = "application/json"
+            response = json.dumps(status, sort_keys=True)
+        elif command in ['getversion', 'version']:
+            response = self.server.version
+        elif command in ['getlogs',  'getlog']:
+            # Returns the end of the Logs (text only)
+            self.sendLog('text', "text/html")
+            return
+        elif command in ['getformattedlog',]:
+            # Returns the end of the Logs with HTML formatting for display purposes
+            self.sendLog('html', "text/html")
+            return
+        elif command in ['getjournal', 'journal']:
+            # Commands sent and received from the journal (see cm19ajournal.py), the last 'limit' or those from 'start' to 'end'
+            #   ?command=getjournal&limit=50    ?command=getjournal&start=1318000000&end=1318003600
+            try:
+                start = 'start' in argsdict and float(argsdict['start']) or None
+                end = 'end' in argsdict and float(argsdict['end']) or None
+                limit = min(int(argsdict.get('limit', 100)), 1000)
+            except ValueError:
+                respcode = 400
+                response = "NAK: start and end must be seconds since the epoch and limit a number"
+            else:
+                records = cm19a.queryJournal(start, end, limit)
+                response = json.dumps([{'time': timestamp, 'direction': direction, 'command': command, 'result': result,
+                                        'raw': " ".join(["%02x" % b for b in raw])}
+                                       for timestamp, direction, command, raw, result in records])
+                contenttype = "application/json"
+        elif command in ['gethistory', 'history']:
+            # Commands sent and received from the history database (see cm19ahistory.py) matching every filter given
+            #   ?command=gethistory&house=A&unit=1&function=ON&direction=R&start=1318000000&end=1318003600&limit=50
+            try:
+                start = 'start' in argsdict and float(argsdict['start']) or None
+                end = 'end' in argsdict and float(argsdict['end']) or None
+                limit = min(int(argsdict.get('limit', 100)), 10000)
+            except ValueError:
+                respcode = 400
+                response = "NAK: start and end must be seconds since the epoch and limit a number"
+            else:
+                filters = [argsdict.get(name) or None for name in ['house', 'unit', 'function', 'direction']]
+                response = json.dumps(cm19a.queryHistory(*(filters + [start, end, limit])))
+                contenttype = "application/json"
+        else:
+            # error no command request
+            respcode = 400
+            response = "NAK: Invalid 'command' value"
+
+        if type(response) == types.BooleanType:
+            if response:
+                respcode = 200
+                response = "ACK"
+            else:
+                reposcode = 500
+                response = "NAK"
+
+        self.sendPage(respcode, contenttype, str(response), headers)
+
+    def refused(self, cost=1):
+        # Answers with 429 and returns True if the client has made too many requests (see AdmissionControl)
+        wait = self.server.admission.admit(self.client_address[0], cost)
+        if not wait:
+            return False
+        self.sendPage(429, "text/html", "NAK: Too many requests", [("Retry-After", str(int(math.ceil(wait))))])
+        return True
+
+
+    def sendOverloaded(self):
+        # Too many sends are in progress so ask the client to try again shortly
+        self.sendPage(503, "text/html", "NAK: Too many sends in progress", [("Retry-After", "1")])
+
+
+    def requestId(self, argsdict={}):
+        # The correlation id of the request: the client's X-Request-ID header or requestid parameter, or a new one
+        requestid = self.headers.getheader('x-request-id') or argsdict.get('requestid')
+        if requestid:
+            # (it is sent back in a header and written to the trace log)
+            requestid = re.sub(r"[^\w.:-]", "", requestid)[:64]
+        if not requestid:
+            requestid = "%x-%x" % (os.getpid(), self.requestids.next())
+        return requestid
+
+
+    def elapsed(self):
+        # Milliseconds since the request was read
+        return round((time.time() - self.requeststart) * 1000, 3)
+
+
+    def sendLog(self, format, type):
+        # Sends the end of the log from the server's LogCache, or 304 Not Modified if the client's copy is still current
+        page = self.server.logcache.get(format, self.acceptsGzip())
+        if page is None:
+            self.server.log.error("Log file %s missing" % self.server.logfile)
+            self.sendPage(200, type, '')
+            return
+        etag, modified, body, gzipped = page
+        headers = [("ETag", etag), ("Last-Modified", email.utils.formatdate(modified, usegmt=True)), ("Cache-Control", "no-cache")]
+        if self.notModified(etag, modified):
+            self.sendNotModified(headers)
+        else:
+            self.sendPage(200, type, body, headers, gzipped, raw=True)
+
+
+    def notModified(self, etag, modified):
+        # True if the request's If-None-Match (or, without one, If-Modified-Since) matches the page the client already has
+        match = self.headers.getheader('if-none-match')
+        if match is not None:
+            return match.strip() == '*' or etag in [tag.strip() for tag in match.split(',')]
+        since = self.headers.getheader('if-modified-since')
+        if since:
+            since = email.utils.parsedate_tz(since)
+            return since is not None and modified <= email.utils.mktime_tz(since)
+        return False
+
+
+    def acceptsGzip(self):
+        encodings = [encoding.split(';')[0].strip().lower() for encoding in self.headers.getheader('accept-encoding', '').split(',')]
+        return 'gzip' in encodings
+
+
+    def sendNotModified(self, headers):
+        self.send_response(304)
+        for keyword, value in headers:
+            self.send_header(keyword, value)
+        if self.requestid:
+            self.send_header("X-Request-ID", self.requestid)
+        self.sendConnection()
+        self.end_headers()
+
+
+    def sendPage(self, code,  type, body, headers=(), gzipped=None, raw=False):
+        # 'gzipped' is the body already compressed (eg by the LogCache), otherwise a large body is compressed here if the client accepts gzip
+        # 'raw' if the body already ends with the newline added to every response
+        if not raw:
+            body+= "\n\r"
+        encoding = None
+        compressible = len(body) >= GZIP_MIN_BYTES
+        if compressible and self.acceptsGzip():
+            if gzipped is None:
+                gzipped = gzip(body)
+            if len(gzipped) < len(body):
+                body = gzipped
+                encoding = "gzip"
+        self.send_response(code)
+        self.send_header("Content-type", type)
+        self.send_header("Content-length", str(len(body)))
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        if compressible:
+            self.send_header("Vary", "Accept-Encoding")
+        for keyword, value in headers:
+            self.send_header(keyword, value)
+        if self.requestid:
+            self.send_header("X-Request-ID", self.requestid)
+        self.sendConnection()
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def sendConnection(self):
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        elif self.request_version == "HTTP/1.0":
+            # HTTP/1.0 clients get a keep-alive connection only if they asked for it (and so need to be told they have it)
+            self.send_header("Connection", "keep-alive")
+# End Class
+
+
+# End of module
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+"""
+A journal of every command sent and received by the CM19a driver (see cm19adriver.py)
+Unlike the text log it survives restarts, is rotated by size and age, and can be searched by time without reading it all
+
+    cm19a.startJournal('./journal')     (done by the HTTP server when JOURNAL_DIR is set)
+    http://192.168.1.3:8008?command=getjournal&limit=50                          The last 50 commands
+    http://192.168.1.3:8008?command=getjournal&start=1318000000&end=1318003600   Commands in an hour (times are seconds since the epoch)
+
+Files (in the journal directory)
+    journal.<first time>.bin    Segment: header 'CM19aJN1' then one record per command
+    journal.<first time>.idx    Index of the segment: (time, offset) of every INDEX_EVERY'th record
+    A new segment is started when the current one reaches 'maxbytes' or 'maxage' seconds old, only the newest 'segments' are kept
+
+Record format (little endian)
+    time (8 byte float), direction (1 byte: S sent, R received), result (1 byte: A ACK, N NAK, - none),
+    command length (1 byte), raw length (1 byte), command, raw bytes
+
+    python cm19ajournal.py ./journal [limit]       Prints the last commands in a journal
+"""
+
+import sys, os, time, struct, threading, glob, bisect
+
+HEADER = "CM19aJN1"
+RECORD = struct.Struct("<dccBB")        # time, direction, result, command length, raw length
+INDEX = struct.Struct("<dQ")            # time, offset of the record in the segment
+INDEX_EVERY = 32                        # Records between index entries
+
+SENT = "S"
+RECEIVED = "R"
+RESULTS = {True: "A", False: "N", None: "-"}
+
+
+class Journal:
+    """ Appends commands to the current segment of a journal directory and searches the segments by time """
+
+    def __init__(self, directory, maxbytes=1024 * 1024, maxage=24 * 60 * 60, segments=10, readonly=False):
+        self.directory = directory
+        self.maxbytes = maxbytes        # Start a new segment when the current one reaches this size
+        self.maxage = maxage            # ... or is this many seconds old
+        self.segments = segments        # Number of segments kept
+        self.lock = threading.Lock()
+        self.f = None                   # Current segment
+        self.index = None               # Index of the current segment
+        self.started = None             # Time the current segment was started
+        self.count = 0                  # Records in the current segment
+        if readonly:
+            # only used to search the journal (eg by another process)
+            return
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._open()
+
+    def record(self, direction, command, raw=(), result=None):
+        """ Appends a command: 'direction' is SENT or RECEIVED, 'raw' the bytes (ints), 'result' True/False for a send """
+        timestamp = time.time()
+        command = command[:255]
+        raw = "".join([chr(b) for b in raw[:255]])
+        data = RECORD.pack(timestamp, direction, RESULTS.get(result, "-"), len(command), len(raw)) + command + raw
+        self.lock.acquire()
+        try:
+            if self.f.tell() >= self.maxbytes or timestamp - self.started >= self.maxage:
+                self._rotate()
+            if self.count % INDEX_EVERY == 0:
+                self.index.write(INDEX.pack(timestamp, self.f.tell()))
+                self.index.flush()
+            self.f.write(data)
+            self.f.flush()
+            self.count += 1
+        finally:
+            self.lock.release()
+
+    def query(self, start=None, end=None, limit=100):
+        """
+            Returns up to 'limit' records [(time, direction, command, raw bytes, result)] oldest first
+            From 'start' (seconds since the epoch) onwards, or the last 'limit' records before 'end' if there is no start
+        """
+        if end is None:
+            end = time.time() + 1
+        if start is not None:
+            records = []
+            segments = self._segments()
+            for i, fname in enumerate(segments):
+                if len(records) >= limit:
+                    break
+                if i + 1 < len(segments) and _started(segments[i + 1]) <= start:
+                    # the whole segment is before 'start'
+                    continue
+                for record in self._read(fname, start):
+                    if record[0] > end or len(records) >= limit:
+                        break
+                    if record[0] >= start:
+                        records.append(record)
+            return records
+
+        # The last records: read back from the newest segment one index entry at a time
+        records = []
+        for fname in reversed(self._segments()):
+            entries = self._index(fname)
+            position = bisect.bisect_right([t for t, offset in entries], end)
+            found = []
+            while position > 0 and len(found) + len(records) < limit:
+                position -= 1
+                stop = position + 1 < len(entries) and entries[position + 1][1] or None
+                chunk = [r for r in self._read(fname, offset=entries[position][1], stop=stop) if r[0] <= end]
+                found = chunk + found
+            records = found + records
+            if len(records) >= limit:
+                break
+        return records[-limit:]
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.f:
+                self.f.close()
+                self.index.close()
+        finally:
+            self.lock.release()
+
+    def _open(self):
+        # Carry on with the newest segment if it can still take records, otherwise start a new one
+        segments = self._segments()
+        if segments:
+            fname = segments[-1]
+            started = _started(fname)
+            if os.path.getsize(fname) < self.maxbytes and time.time() - started < self.maxage:
+                self.f = open(fname, "ab")
+                self.f.seek(0, os.SEEK_END)     # (so tell() gives the offset of the next record on every platform)
+                self.index = open(fname[:-4] + ".idx", "ab")
+                self.started = started
+                self.count = INDEX_EVERY    # (index the next record, the count in the segment is not known)
+                return
+        self._start()
+
+    def _start(self):
+        self.started = time.time()
+        fname = os.path.join(self.directory, "journal.%.6f.bin" % self.started)
+        self.f = open(fname, "wb")
+        self.f.write(HEADER)
+        self.index = open(fname[:-4] + ".idx", "wb")
+        self.count = 0
+
+    def _rotate(self):
+        self.f.close()
+        self.index.close()
+        self._start()
+        for fname in self._segments()[:-self.segments]:
+            # too old so delete it
+            for name in [fname, fname[:-4] + ".idx"]:
+                try:
+                    os.remove(name)
+                except OSError:
+                    pass
+
+    def _segments(self):
+        # Segment files oldest first (the names sort by the time they were started)
+        return sorted(glob.glob(os.path.join(self.directory, "journal.*.bin")), key=_started)
+
+    def _index(self, fname):
+        # Returns [(time, offset)] from a segment's index
+        try:
+            f = open(fname[:-4] + ".idx", "rb")
+            try:
+                data = f.read()
+            finally:
+                f.close()
+        except IOError:
+            data = ""
+        entries = [INDEX.unpack_from(data, i) for i in range(0, len(data) - INDEX.size + 1, INDEX.size)]
+        if not entries or entries[0][1] != len(HEADER):
+            # the segment was carried on after a restart before its first entry (or has no index) so start from the top
+            entries.insert(0, (0.0, len(HEADER)))
+        return entries
+
+    def _read(self, fname, start=None, offset=None, stop=None):
+        # Yields the records of a segment from 'offset' (or the index entry before 'start') to 'stop'
+        if offset is None:
+            offset = len(HEADER)
+            if start is not None:
+                entries = self._index(fname)
+                position = bisect.bisect_right([t for t, o in entries], start) - 1
+                if position >= 0:
+                    offset = entries[position][1]
+        f = open(fname, "rb")
+        try:
+            if f.read(len(HEADER)) != HEADER:
+                return
+            f.seek(offset)
+            while stop is None or f.tell() < stop:
+                header = f.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    break
+                timestamp, direction, result, commandlength, rawlength = RECORD.unpack(header)
+                data = f.read(commandlength + rawlength)
+                if len(data) < commandlength + rawlength:
+                    # incomplete record at the end (eg still being written)
+                    break
+                yield (timestamp, direction, data[:commandlength], [ord(c) for c in data[commandlength:]],
+                       {"A": True, "N": False}.get(result))
+        finally:
+            f.close()
+#end of class
+
+
+def _started(fname):
+    # The time a segment was started (from its name, eg journal.1318000000.123456.bin)
+    return float(os.path.basename(fname)[len("journal."):-len(".bin")])
+
+
+#Main
+if __name__ == '__main__':
+    if len(sys.argv) <= 1:
+        print "Usage: cm19ajournal.py journaldirectory [limit]"
+        sys.exit(2)
+
+    journal = Journal(sys.argv[1], readonly=True)
+    for timestamp, direction, command, raw, result in journal.query(limit=len(sys.argv) > 2 and int(sys.argv[2]) or 20):
+        print "%s %s %-24s %-8s %s" % (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp)), direction, command,
+                                      {True: "ACK", False: "NAK", None: ""}[result], " ".join(["%02x" % b for b in raw]))
+    journal.close()
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+
+"""
+Load test of the HTTP server (cm19ahttp.py) against a simulated CM19a
+Starts the server on localhost with a CM19aDevice whose handle is a SimulatedHandle (writes take as long as
+they would on the CM19a and are acknowledged, RF commands can be received at a steady rate) then drives it
+from many clients at once with a mix of requests and reports the throughput, errors and latency of each
+request type against the targets (SLOs). Exits with 1 if a target is missed so it can gate a deploy.
+
+    python cm19aloadtest.py
+    python cm19aloadtest.py clients=50 seconds=30 mix=send:50,getqueue:20,getlog:10,getformattedlog:5,getstatus:10,batch:5
+    python cm19aloadtest.py slo=send:p95:20,send:p99:50,all:errors:0.1 writelatency=4 received=5
+
+Arguments (name=value, the defaults are in DEFAULTS)
+    clients         Number of clients sending requests at the same time (each over its own keep-alive connection)
+    seconds         How long to run for
+    mix             Request types and their weights: send (a random ON/OFF), getqueue, getlog, getformattedlog,
+                    getstatus, scene (a dry run), batch (a POST of 'batchsize' commands)
+    slo             Targets as type:measure:limit, measure is p50, p95, p99 or max (ms) or errors (percent), type 'all' for every request
+    writelatency    Milliseconds each write to the simulated CM19a takes
+    ackdelay        Milliseconds after a write before its ACK can be read
+    writeerrors     Percentage of writes that fail
+    received        RF commands received by the simulated CM19a each second
+    connection      'keepalive' (default) or 'close' for a new connection for each request
+    rate, burst, maxsends   The server's admission control (see cm19ahttp.AdmissionControl, every client comes from 127.0.0.1)
+"""
+
+import sys, os, time, errno, math, random, threading, tempfile, shutil, logging, httplib, json
+
+DEFAULTS = {
+    'clients': '20',
+    'seconds': '10',
+    'mix': 'send:50,getqueue:20,getlog:10,getformattedlog:5,getstatus:10,batch:5',
+    'slo': 'send:p95:100,send:p99:250,getqueue:p99:25,getstatus:p99:25,all:errors:0.1',
+    'writelatency': '4',
+    'ackdelay': '2',
+    'writeerrors': '0',
+    'received': '2',
+    'batchsize': '5',
+    'connection': 'keepalive',
+    'rate': '0',
+    'burst': '0',
+    'maxsends': '0',
+}
+HOUSES = "ABCDEFGHIJKLMNOP"
+
+
+class SimulatedHandle:
+    """
+        Stands in for the CM19a device handle (see CM19aDevice's 'handle')
+        A write takes 'writelatency' seconds and is acknowledged 'ackdelay' seconds later, a read waits
+        up to its timeout for an ACK or a received RF command (from 'frames', 'received' a second) and
+        then times out like the CM19a. A fraction 'writeerrors' of writes fail
+    """
+
+    ACK = 0x0FF
+
+    def __init__(self, writelatency=0.004, ackdelay=0.002, writeerrors=0.0, received=0.0):
+        self.writelatency = writelatency
+        self.ackdelay = ackdelay
+        self.writeerrors = writeerrors
+        self.received = received        # RF commands received per second
+        self.frames = []                # The byte sequences of the RF commands received (chosen at random)
+        self.due = []                   # Times the ACKs waiting to be read can be read, oldest first
+        self.nextreceived = time.time()
+        self.condition = threading.Condition()
+        self.reads = 0
+        self.writes = 0
+
+    def readinto(self, buffer, timeout):
+        deadline = time.time() + timeout / 1000.0
+        self.condition.acquire()
+        try:
+            while True:
+                now = time.time()
+                if self.due and self.due[0] <= now:
+                    del self.due[0]
+                    buffer[0] = self.ACK
+                    self.reads += 1
+                    return 1
+                if self.received and self.frames and self.nextreceived <= now:
+                    self.nextreceived = now + random.expovariate(self.received)
+                    frame = random.choice(self.frames)
+                    buffer[:len(frame)] = frame
+                    self.reads += 1
+                    return len(frame)
+                if now >= deadline:
+                    raise IOError(errno.ETIMEDOUT, "Connection timed out")
+                wakeup = deadline
+                if self.due:
+                    wakeup = min(wakeup, self.due[0])
+                if self.received and self.frames:
+                    wakeup = min(wakeup, self.nextreceived)
+                self.condition.wait(max(0.0005, wakeup - now))
+        finally:
+            self.condition.release()
+
+    def interruptWrite(self, endpoint, buffer, timeout):
+        time.sleep(self.writelatency)
+        if self.writeerrors and random.random() < self.writeerrors:
+            raise IOError(errno.EIO, "Simulated write error")
+        self.condition.acquire()
+        try:
+            self.writes += 1
+            self.due.append(time.time() + self.ackdelay)
+            self.condition.notify()
+        finally:
+            self.condition.release()
+        return len(buffer)
+
+    def releaseInterface(self):
+        pass
+
+    def claimInterface(self, interface):
+        pass
+
+    def setAltInterface(self, alternate):
+        pass
+
+    def reset(self):
+        pass
+#end of class
+
+
+class Client(threading.Thread):
+    """ Sends requests chosen from the mix until 'deadline' and records (type, seconds, ok) for each """
+
+    def __init__(self, port, mix, deadline, settings):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.port = port
+        self.mix = mix                  # [(cumulative weight, request type)]
+        self.deadline = deadline
+        self.keepalive = settings['connection'] != 'close'
+        self.batchsize = int(settings['batchsize'])
+        self.results = []
+        self.connection = None
+
+    def run(self):
+        total = self.mix[-1][0]
+        while time.time() < self.deadline:
+            choice = random.uniform(0, total)
+            for weight, kind in self.mix:
+                if choice <= weight:
+                    break
+            method, path, body = self.request(kind)
+            start = time.time()
+            try:
+                if self.connection is None:
+                    self.connection = httplib.HTTPConnection("127.0.0.1", self.port, timeout=30)
+                headers = {}
+                if body is not None:
+                    headers['Content-Type'] = "application/json"
+                if not self.keepalive:
+                    headers['Connection'] = "close"
+                self.connection.request(method, path, body, headers)
+                response = self.connection.getresponse()
+                response.read()
+                ok = response.status < 400
+                if not self.keepalive or response.getheader('connection', '').lower() == 'close':
+                    self.close()
+            except (httplib.HTTPException, IOError), err:
+                ok = False
+                self.close()
+            self.results.append((kind, time.time() - start, ok))
+        #end while
+        self.close()
+
+    def close(self):
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    def request(self, kind):
+        # Returns (method, path, body) for a request type
+        house = random.choice(HOUSES)
+        unit = random.randint(1, 16)
+        if kind == 'send':
+            return "GET", "/?house=%s&unit=%d&command=%s" % (house, unit, random.choice(['ON', 'OFF'])), None
+        elif kind == 'batch':
+            commands = ["%s%d%s" % (house, random.randint(1, 16), random.choice(['ON', 'OFF'])) for i in range(self.batchsize)]
+            return "POST", "/", json.dumps(commands)
+        elif kind == 'scene':
+            return "GET", "/?command=scene&scene=%s1OFF,%s2OFF,%s3ON&housewide=%s&dryrun=1" % (house, house, house, house), None
+        return "GET", "/?command=%s" % kind, None
+#end of class
+
+
+def percentile(times, percent):
+    # The 'percent' percentile of a sorted list (nearest rank)
+    if not times:
+        return 0.0
+    return times[min(len(times) - 1, max(0, int(math.ceil(percent / 100.0 * len(times))) - 1))]
+
+
+def parse_mix(mix):
+    # "send:50,getqueue:20" -> [(cumulative weight, type)]
+    cumulative = []
+    total = 0.0
+    for item in mix.split(','):
+        kind, weight = item.split(':')
+        total += float(weight)
+        cumulative.append((total, kind))
+    return cumulative
+
+
+def parse_slo(slo):
+    # "send:p95:25,all:errors:0.1" -> [(type, measure, limit)]
+    return [(kind, measure, float(limit)) for kind, measure, limit in [item.split(':') for item in slo.split(',') if item]]
+
+
+def loadtest(settings):
+    """
+        Runs a load test (see the module's doc for the settings, all strings as given on the command line)
+        Returns ({request type: {'requests', 'errors', 'p50', 'p95', 'p99', 'max'}} with 'all' for every request, seconds taken, handle, admission control counts)
+    """
+    import cm19adriver, cm19ahttp
+
+    class QuietHandler(cm19ahttp.HTTPhandler):
+        def log_message(self, format, *args):
+            pass
+
+    directory = tempfile.mkdtemp(prefix="cm19aloadtest")
+    logfile = os.path.join(directory, "cm19a.log")
+    log = logging.getLogger("CM19a load test")
+    log.propagate = False
+    handler = logging.FileHandler(logfile)
+    handler.setFormatter(logging.Formatter('%(asctime)s, %(levelname)s, %(message)s', '%a %d %b %Y %H:%M:%S'))
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
+
+    handle = SimulatedHandle(float(settings['writelatency']) / 1000, float(settings['ackdelay']) / 1000,
+                             float(settings['writeerrors']) / 100, float(settings['received']))
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")     # (the driver prints every send)
+    try:
+        cm19a = cm19adriver.CM19aDevice(0.1, log, polling=True, handle=handle, verbose=False)
+        handle.frames = [frame.buffer for frame in cm19a.protocol.commands.values() if frame.unit != '0']
+        server = cm19ahttp.HTTPServer(("127.0.0.1", 0), QuietHandler, cm19a, log, logfile=logfile, version=cm19adriver.VERSION,
+                                      maxconnections=int(settings['clients']) + 10, rate=float(settings['rate']),
+                                      burst=float(settings['burst']), maxsends=int(settings['maxsends']))
+        serving = threading.Thread(target=server.serve_forever)
+        serving.setDaemon(True)
+        serving.start()
+
+        start = time.time()
+        deadline = start + float(settings['seconds'])
+        clients = [Client(server.server_address[1], parse_mix(settings['mix']), deadline, settings) for i in range(int(settings['clients']))]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time.time() - start
+
+        server.alive = False
+        serving.join()
+        server.stop()
+        cm19a.finish()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        log.removeHandler(handler)
+        handler.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    times = {}
+    errors = {}
+    for client in clients:
+        for kind, seconds, ok in client.results:
+            for key in [kind, 'all']:
+                times.setdefault(key, []).append(seconds * 1000)
+                if not ok:
+                    errors[key] = errors.get(key, 0) + 1
+    report = {}
+    for kind, values in times.items():
+        values.sort()
+        report[kind] = {'requests': len(values), 'errors': errors.get(kind, 0), 'p50': percentile(values, 50),
+                        'p95': percentile(values, 95), 'p99': percentile(values, 99), 'max': values[-1]}
+    return report, elapsed, handle, server.admission.status()
+
+
+def check(report, slos):
+    """ Returns [(type, measure, limit, measured, True if met)] for each target """
+    results = []
+    for kind, measure, limit in slos:
+        stats = report.get(kind)
+        if not stats:
+            continue
+        if measure == 'errors':
+            measured = 100.0 * stats['errors'] / stats['requests']
+        else:
+            measured = stats[measure]
+        results.append((kind, measure, limit, measured, measured <= limit))
+    return results
+
+
+#Main
+if __name__ == '__main__':
+    settings = dict(DEFAULTS)
+    for arg in sys.argv[1:]:
+        if '=' not in arg or arg.split('=')[0] not in DEFAULTS:
+            print "Unknown argument %s (use name=value with a name from: %s)" % (arg, ", ".join(sorted(DEFAULTS)))
+            sys.exit(2)
+        settings[arg.split('=')[0]] = arg.split('=', 1)[1]
+
+    print "Load test: %s clients for %s seconds, mix %s" % (settings['clients'], settings['seconds'], settings['mix'])
+    report, elapsed, handle, admission = loadtest(settings)
+
+    print "\n%-16s %8s %8s %8s %9s %9s %9s %9s" % ("request", "count", "per sec", "errors", "p50 ms", "p95 ms", "p99 ms", "max ms")
+    for kind in sorted(report, key=lambda kind: (kind == 'all', kind)):
+        stats = report[kind]
+        print "%-16s %8d %8.1f %8d %9.2f %9.2f %9.2f %9.2f" % (kind, stats['requests'], stats['requests'] / elapsed, stats['errors'],
+                                                              stats['p50'], stats['p95'], stats['p99'], stats['max'])
+    print "\n%d writes and %d reads by the simulated CM19a" % (handle.writes, handle.reads)
+    if admission['ratelimited'] or admission['overloaded']:
+        print "%d requests refused by the rate limit (429), %d sends refused as overloaded (503)" % (admission['ratelimited'], admission['overloaded'])
+
+    print "\nTargets"
+    met = True
+    for kind, measure, limit, measured, ok in check(report, parse_slo(settings['slo'])):
+        units = measure == 'errors' and "%" or " ms"
+        print "  %-4s %-16s %-6s %9.2f%s (limit %s%s)" % (ok and "OK" or "MISS", kind, measure, measured, units, limit, units)
+        met = met and ok
+    sys.exit(int(not met))
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+"""
+On demand profiling of the running CM19a driver (see cm19adriver.py)
+Loaded only when a profile or memory snapshot is asked for
+
+Profiles
+    http://192.168.1.3:8008?command=profile&seconds=10              Samples every thread's stack (the receive thread, senders, handlers, subscribers)
+                                                                    Returns collapsed stacks (one line per stack: frames separated by ; then the count)
+                                                                    ready for flamegraph.pl
+    http://192.168.1.3:8008?command=profile&seconds=10&mode=calls   cProfile of each read by the receive thread and each HTTP request (sends included)
+                                                                    Returns the functions sorted by cumulative time (not available with HTTP_WORKERS)
+
+Memory (Python 2 has no tracemalloc so the objects the garbage collector tracks are counted instead)
+    http://192.168.1.3:8008?command=memsnapshot                     Counts the objects of each type and the size of every list, dict, set and deque
+    http://192.168.1.3:8008?command=memdiff                         What has grown since the snapshot (eg CM19aDevice.receivequeue if nobody empties it)
+"""
+
+import sys, os, time, threading, gc, types, collections, cProfile, pstats, StringIO
+
+MAX_SECONDS = 30            # Longest profile allowed (a request waits for the whole profile)
+SAMPLE_INTERVAL = 0.005     # Seconds between stack samples
+REPORT_LINES = 40           # Number of functions (calls mode) or containers (memdiff) reported
+
+_lock = threading.Lock()    # One profile at a time
+_baseline = None            # (object counts by type, {container id: size}) from the last snapshot
+
+
+class CallProfiler:
+    """
+        cProfile of the units of work passed to runcall() (each read by the receive thread and each HTTP request)
+        Each thread gets its own cProfile.Profile and they are added together for the report
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def runcall(self, func, *args, **kwargs):
+        profile = getattr(self.local, 'profile', None)
+        if profile is None:
+            profile = self.local.profile = cProfile.Profile()
+            self.lock.acquire()
+            self.profiles.append(profile)
+            self.lock.release()
+        return profile.runcall(func, *args, **kwargs)
+
+    def report(self, limit=REPORT_LINES):
+        out = StringIO.StringIO()
+        stats = None
+        for profile in self.profiles:
+            if stats is None:
+                stats = pstats.Stats(profile, stream=out)
+            else:
+                stats.add(profile)
+        if stats is None:
+            return "Nothing was profiled (no reads or requests)"
+        print >> out, "%d threads profiled" % len(self.profiles)
+        stats.sort_stats('cumulative').print_stats(limit)
+        return out.getvalue()
+#end of class
+
+
+def profile(cm19a, seconds=10, mode='sample'):
+    """
+        Profiles the running driver for 'seconds' (up to MAX_SECONDS)
+        'mode' is 'sample' (collapsed stacks of every thread) or 'calls' (cProfile, see CallProfiler)
+        Returns (True/False, the report or why there is not one)
+    """
+    seconds = min(max(float(seconds), 0.1), MAX_SECONDS)
+    if mode not in ['sample', 'calls']:
+        return False, "Unknown profile mode %r (use sample or calls)" % mode
+    if not _lock.acquire(False):
+        return False, "A profile is already running"
+    try:
+        cm19a.log.info("Profiling (%s) for %.1f seconds" % (mode, seconds))
+        if mode == 'sample':
+            samples, stacks = sample(seconds)
+            return True, "# %d samples of every thread over %.1f seconds\n%s" % (samples, seconds, collapse(stacks))
+
+        profiler = CallProfiler()
+        cm19a.profiler = profiler
+        try:
+            time.sleep(seconds)
+        finally:
+            cm19a.profiler = None
+        return True, profiler.report()
+    finally:
+        _lock.release()
+
+
+def sample(seconds, interval=SAMPLE_INTERVAL):
+    """ Samples the stack of every other thread every 'interval' seconds. Returns (number of samples, {stack: count}) """
+    me = threading.currentThread().ident
+    stacks = {}
+    samples = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        names = dict([(thread.ident, thread.getName()) for thread in threading.enumerate()])
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            stack.append(names.get(ident, "thread %d" % ident))
+            stack.reverse()
+            stack = ";".join(stack)
+            stacks[stack] = stacks.get(stack, 0) + 1
+        #end for
+        samples += 1
+        time.sleep(interval)
+    #end while
+    return samples, stacks
+
+
+def collapse(stacks):
+    """ Returns the stacks in the collapsed format used by flamegraph.pl (busiest first) """
+    return "\n".join(["%s %d" % (stack, count) for stack, count in sorted(stacks.items(), key=lambda item: -item[1])])
+
+
+def snapshot():
+    """ Records the objects of each type and the size of each container for memdiff(). Returns a summary """
+    global _baseline
+    counts, sizes = _measure()
+    _baseline = (counts, sizes)
+    return "Snapshot: %d objects of %d types, %d containers" % (sum(counts.values()), len(counts), len(sizes))
+
+
+def memdiff(limit=REPORT_LINES):
+    """ Returns (True/False, what has grown since the snapshot) """
+    if not _baseline:
+        return False, "No snapshot yet (use ?command=memsnapshot first)"
+    counts, sizes = _measure()
+    before, beforesizes = _baseline
+
+    lines = ["Object counts (change since the snapshot, now)"]
+    growth = [(counts.get(name, 0) - before.get(name, 0), name) for name in set(counts) | set(before)]
+    growth = [(change, name) for change, name in growth if change]
+    growth.sort(reverse=True)
+    for change, name in growth[:limit]:
+        lines.append("  %+d %s (%d)" % (change, name, counts.get(name, 0)))
+
+    lines.append("Containers that have grown the most (change since the snapshot, now)")
+    grown = [(size - beforesizes.get(ident, 0), ident, size) for ident, size in sizes.items() if size > beforesizes.get(ident, 0)]
+    grown.sort(reverse=True)
+    if grown:
+        wanted = set([ident for change, ident, size in grown[:limit]])
+        containers = dict([(id(o), o) for o in gc.get_objects() if id(o) in wanted])
+        for change, ident, size in grown[:limit]:
+            if ident in containers:
+                lines.append("  %+d %s (%d)" % (change, _describe(containers[ident], containers), size))
+    return True, "\n".join(lines)
+
+
+def _measure():
+    # Returns ({type name: number of objects}, {container id: size}) for the objects tracked by the garbage collector
+    gc.collect()
+    counts = {}
+    sizes = {}
+    ignore = set([id(counts), id(sizes)])      # (our own records are not counted)
+    if _baseline:
+        ignore.update([id(_baseline[0]), id(_baseline[1])])
+    for o in gc.get_objects():
+        if id(o) in ignore:
+            continue
+        if type(o) == types.InstanceType:
+            name = o.__class__.__name__
+        else:
+            name = type(o).__name__
+        counts[name] = counts.get(name, 0) + 1
+        if isinstance(o, (list, dict, set, collections.deque)):
+            sizes[id(o)] = len(o)
+    return counts, sizes
+
+
+def _describe(container, ignore):
+    # Names a container by the attribute that holds it (eg CM19aDevice.receivequeue) where possible
+    # ('ignore' is the dict memdiff() keeps the containers in)
+    name = type(container).__name__
+    for referrer in gc.get_referrers(container):
+        if type(referrer) == types.DictType and referrer is not ignore:
+            for key, value in referrer.items():
+                if value is container:
+                    for owner in gc.get_referrers(referrer):
+                        if getattr(owner, '__dict__', None) is referrer:
+                            return "%s %s.%s" % (name, owner.__class__.__name__, key)
+                    return "%s %s" % (name, key)
+    return name
@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+
+"""
+Runs the HTTP server in several worker processes that share a single CM19a (see cm19adriver.py)
+
+Only one process can claim the CM19a so the driver's own process owns the device (the device owner)
+and the HTTP workers forward every call to it over a pipe. Request handling (eg formatting the log)
+then runs on other cores rather than competing with the thread receiving from the CM19a.
+
+    device owner process        CM19aDevice + DeviceOwner (one thread per worker pipe and a fixed pool of threads running the calls)
+    HTTP worker processes       cm19ahttp.HTTPServer (all accepting on the same socket) + DeviceProxy
+
+The workers' log records are written to the driver's log by the device owner (so only one process rotates it)
+
+Set HTTP_WORKERS in cm19adriver.py to the number of worker processes (0 = serve HTTP in the driver process)
+
+Messages
+    worker -> owner     (call id, method, args)
+                        (None, 'log', (record,))                    a log record (a dict) to write, nothing is sent back
+    owner -> worker     ('reply', call id, True/False, result or error message)
+                        ('event', subscription id, command)         a command received, for a subscribe() made by the worker
+"""
+
+import sys, os, time, threading, itertools, signal, multiprocessing, logging, Queue
+
+
+class ProxyError(Exception):
+    """ The device owner could not complete a call (or did not answer in time) """
+    pass
+
+
+class DeviceProxy:
+    """
+        Stands in for the CM19aDevice in an HTTP worker: each call is passed to the device owner process
+        Calls from different threads can be waiting at the same time (each reply is matched to its call by id)
+    """
+
+    def __init__(self, conn, timeout=60):
+        self.conn = conn
+        self.timeout = timeout          # Seconds to wait for the device owner to answer a call
+        self.ids = itertools.count(1)
+        self.waiting = {}               # {call id: [Event, ok, result]}
+        self.subscribers = {}           # {subscription id: callback}
+        self.sendlock = threading.Lock()
+        self.closed = False
+        self.reader = threading.Thread(target=self._read, name="CM19a proxy reader")
+        self.reader.setDaemon(True)
+        self.reader.start()
+
+    def send(self, house_code, unit_number, function):
+        return self._call('send', house_code, unit_number, function)
+
+    def sendBatch(self, commands):
+        return self._call('sendBatch', list(commands))
+
+    def sendTraced(self, house_code, unit_number, function, traceid, stages=()):
+        return self._call('sendTraced', house_code, unit_number, function, traceid, list(stages))
+
+    def sendBatchTraced(self, commands, traceid, stages=()):
+        return self._call('sendBatchTraced', list(commands), traceid, list(stages))
+
+    def sendScene(self, scene, housewide=False, allon=True):
+        return self._call('sendScene', list(scene), housewide, allon)
+
+    def optimiseScene(self, scene, housewide=False, allon=True):
+        return self._call('optimiseScene', list(scene), housewide, allon)
+
+    def getReceiveQueue(self):
+        return self._call('getReceiveQueue')
+
+    def clearReceiveQueue(self):
+        return self._call('clearReceiveQueue')
+
+    def lookup(self, command):
+        return self._call('lookup', command)
+
+    def startCapture(self, fname):
+        return self._call('startCapture', fname)
+
+    def stopCapture(self):
+        return self._call('stopCapture')
+
+    def reloadProtocol(self):
+        return self._call('reloadProtocol')
+
+    def status(self):
+        return self._call('status')
+
+    def queryJournal(self, start=None, end=None, limit=100):
+        return self._call('queryJournal', start, end, limit)
+
+    def queryHistory(self, house=None, unit=None, function=None, direction=None, start=None, end=None, limit=100):
+        return self._call('queryHistory', house, unit, function, direction, start, end, limit)
+
+    def profile(self, seconds=10, mode='sample'):
+        if mode == 'calls':
+            # (the requests are handled in the workers so the device owner's profiler would never see them)
+            return False, "Profile mode calls is not available with HTTP workers (HTTP_WORKERS), use mode=sample"
+        return self._call('profile', seconds, mode)
+
+    def memorySnapshot(self):
+        return self._call('memorySnapshot')
+
+    def memoryDiff(self):
+        return self._call('memoryDiff')
+
+    def subscribe(self, callback, filter=None, maxbacklog=100):
+        """ Calls 'callback' (on the proxy's reader thread) with each command received. 'filter' must be None or a pattern such as A* """
+        subid = self.ids.next()
+        self.subscribers[subid] = callback
+        self._call('subscribe', subid, filter, maxbacklog)
+        return subid
+
+    def unsubscribe(self, subid):
+        if self.subscribers.pop(subid, None) is None:
+            return False
+        return self._call('unsubscribe', subid)
+
+    def quit(self):
+        """ Asks the device owner to shut the driver down (every worker included) """
+        return self._call('quit')
+
+    def log(self, record):
+        """ Passes a log record (a dict, see OwnerLogHandler) to the device owner to be written to the driver's log """
+        if self.closed:
+            return
+        self.sendlock.acquire()
+        try:
+            self.conn.send((None, 'log', (record,)))
+        except (IOError, EOFError):
+            pass
+        finally:
+            self.sendlock.release()
+
+    def close(self):
+        self.closed = True
+        self.conn.close()
+
+    def _call(self, method, *args):
+        if self.closed:
+            raise ProxyError("The connection to the device owner is closed")
+        callid = self.ids.next()
+        slot = [threading.Event(), False, None]
+        self.waiting[callid] = slot
+        try:
+            self.sendlock.acquire()
+            try:
+                self.conn.send((callid, method, args))
+            finally:
+                self.sendlock.release()
+            slot[0].wait(self.timeout)
+        finally:
+            self.waiting.pop(callid, None)
+
+        event, ok, result = slot
+        if not event.isSet():
+            raise ProxyError("No answer from the device owner to %s" % method)
+        if not ok:
+            raise ProxyError(result)
+        return result
+
+    def _read(self):
+        # Runs in a thread: passes each reply to the call waiting for it and each event to its subscriber
+        while not self.closed:
+            try:
+                message = self.conn.recv()
+            except (EOFError, IOError):
+                break
+            if message[0] == 'reply':
+                slot = self.waiting.get(message[1])
+                if slot:
+                    slot[1], slot[2] = message[2], message[3]
+                    slot[0].set()
+            elif message[0] == 'event':
+                callback = self.subscribers.get(message[1])
+                if callback:
+                    try:
+                        callback(message[2])
+                    except Exception:
+                        pass
+        #end while
+
+        # The device owner has gone so nothing waiting will get an answer
+        self.closed = True
+        for slot in self.waiting.values():
+            slot[2] = "The device owner has stopped"
+            slot[0].set()
+#end of class
+
+
+class OwnerLogHandler(logging.Handler):
+    """ Sends a worker's log records to the device owner (see DeviceProxy.log) """
+
+    def __init__(self, proxy):
+        logging.Handler.__init__(self)
+        self.proxy = proxy
+
+    def emit(self, record):
+        try:
+            message = dict(record.__dict__)
+            message['msg'] = record.getMessage()
+            message['args'] = None
+            if record.exc_info:
+                message['exc_text'] = logging.Formatter().formatException(record.exc_info)
+            message['exc_info'] = None
+            self.proxy.log(message)
+        except Exception:
+            self.handleError(record)
+#end of class
+
+
+class DeviceOwner:
+    """
+        Runs the calls made by the HTTP workers' DeviceProxy on the CM19aDevice
+        Each worker pipe is read by its own thread and the calls are run by a pool of THREADS threads
+        so a slow call (eg a batch of sends) does not hold up the other requests from that worker
+    """
+
+    THREADS = 16                    # Calls run at once (any more wait for a thread)
+
+    METHODS = ['send', 'sendBatch', 'sendTraced', 'sendBatchTraced', 'sendScene', 'optimiseScene', 'getReceiveQueue', 'clearReceiveQueue', 'lookup',
+               'startCapture', 'stopCapture', 'reloadProtocol', 'status', 'queryJournal', 'queryHistory', 'profile', 'memorySnapshot', 'memoryDiff']
+
+    def __init__(self, cm19a, log):
+        self.cm19a = cm19a
+        self.log = log
+        self.quit = threading.Event()   # Set when a worker asks for the driver to shut down
+        self.calls = 0
+        self.queue = Queue.Queue()      # Calls waiting for a thread: (conn, sendlock, call id, method, args)
+        for i in range(self.THREADS):
+            thread = threading.Thread(target=self._dispatch, name="CM19a device owner call %d" % (i + 1))
+            thread.setDaemon(True)
+            thread.start()
+
+    def add(self, conn):
+        """ Starts serving the calls from a worker """
+        thread = threading.Thread(target=self._serve, args=(conn,), name="CM19a device owner")
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+    def _serve(self, conn):
+        sendlock = threading.Lock()
+        subscriptions = {}              # {subscription id: Subscriber} made by this worker
+        while not self.quit.isSet():
+            try:
+                callid, method, args = conn.recv()
+            except (EOFError, IOError):
+                # the worker has stopped
+                break
+            if method == 'log':
+                # a log record from the worker (nothing is sent back)
+                record = logging.makeLogRecord(args[0])
+                logging.getLogger(record.name).handle(record)
+                continue
+            self.calls += 1
+
+            if method == 'quit':
+                self.log.info("Shutdown requested by an HTTP worker")
+                self._reply(conn, sendlock, ('reply', callid, True, True))
+                self.quit.set()
+            elif method == 'subscribe':
+                subid, filter, maxbacklog = args
+                notify = lambda command, subid=subid: self._reply(conn, sendlock, ('event', subid, command))
+                subscriptions[subid] = self.cm19a.subscribe(notify, filter, maxbacklog)
+                self._reply(conn, sendlock, ('reply', callid, True, subid))
+            elif method == 'unsubscribe':
+                subscriber = subscriptions.pop(args[0], None)
+                self._reply(conn, sendlock, ('reply', callid, True, bool(subscriber and self.cm19a.unsubscribe(subscriber))))
+            elif method in self.METHODS:
+                self.queue.put((conn, sendlock, callid, method, args))
+            else:
+                self._reply(conn, sendlock, ('reply', callid, False, "Unknown method %s" % method))
+        #end while
+
+        for subscriber in subscriptions.values():
+            self.cm19a.unsubscribe(subscriber)
+
+    def _dispatch(self):
+        # Runs in each pool thread: runs the calls one after the other
+        while True:
+            self._run(*self.queue.get())
+
+    def _run(self, conn, sendlock, callid, method, args):
+        try:
+            result = getattr(self.cm19a, method)(*args)
+            message = ('reply', callid, True, result)
+        except Exception, err:
+            self.log.error("%s failed for an HTTP worker: %s" % (method, err))
+            message = ('reply', callid, False, str(err))
+        self._reply(conn, sendlock, message)
+
+    def _reply(self, conn, sendlock, message):
+        sendlock.acquire()
+        try:
+            conn.send(message)
+        except (IOError, EOFError):
+            # the worker has gone
+            pass
+        finally:
+            sendlock.release()
+#end of class
+
+
+def start_workers(server, count, shutdowntimeout=10):
+    """
+        Forks 'count' HTTP worker processes that all accept connections on the server's socket
+        Call this before the CM19a is opened (so no other threads are running when the workers are forked)
+        Returns [(process, pipe to the worker)]
+    """
+    workers = []
+    for i in range(count):
+        ownerend, workerend = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_worker, args=(server, workerend, shutdowntimeout), name="CM19a HTTP worker %d" % (i + 1))
+        process.daemon = True
+        process.start()
+        workerend.close()           # (so the owner sees EOF if the worker stops)
+        workers.append((process, ownerend))
+    #end for
+
+    # Only the workers accept connections
+    server.server_close()
+    return workers
+
+
+def stop_workers(workers, timeout=10):
+    """ Asks the workers to finish the requests in progress and stop (waits up to 'timeout' seconds) """
+    for process, conn in workers:
+        if process.is_alive():
+            process.terminate()         # SIGTERM: the worker shuts down gracefully
+    deadline = time.time() + timeout
+    for process, conn in workers:
+        process.join(max(0, deadline - time.time()))
+        conn.close()
+
+
+def _worker(server, conn, shutdowntimeout):
+    # Runs in a worker process: serves HTTP requests, passing the device calls to the device owner
+    proxy = DeviceProxy(conn)
+    server.cm19a = proxy
+    server.onquit = proxy.quit
+
+    # The log handlers were copied from the device owner when the worker was forked: write to them from here
+    # and every process would rotate the same file, so the records are passed to the device owner instead
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(OwnerLogHandler(proxy))
+
+    def stop(signum, frame):
+        server.alive = False
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.stop(shutdowntimeout)
+    proxy.close()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+"""
+Capture and replay of the raw data read from a CM19a X10 RF Transceiver (USB)
+
+Capture
+    The driver records every raw interrupt read (with the time it was read) while capturing
+    e.g. http://192.168.1.3:8008?command=startcapture  ...  http://192.168.1.3:8008?command=stopcapture
+    or cm19a.startCapture('./cm19a.trace') when the driver is imported into another script
+
+Replay
+    Feeds a trace back through the driver's receive path (decode, receive queue, subscribers and rules)
+    without a CM19a so event storms can be reproduced and the receive path benchmarked offline
+    Commands sent by rules are acknowledged but go nowhere
+        python cm19atrace.py cm19a.trace            # as fast as possible
+        python cm19atrace.py cm19a.trace realtime   # with the same timing as the original reads
+
+Trace file format (little endian)
+    Header: 'CM19aTR1'
+    Each read: time (8 byte float, seconds since the epoch), length (1 byte), the bytes read
+"""
+
+import sys, time, errno, struct, threading, mmap, os, logging
+
+HEADER = "CM19aTR1"
+RECORD = struct.Struct("<dB")       # time, length
+
+
+class TraceWriter:
+    """ Appends raw reads to a trace file """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.count = 0
+        self.lock = threading.Lock()
+        self.f = open(fname, "ab")
+        if self.f.tell() == 0:
+            self.f.write(HEADER)
+
+    def write(self, data, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        record = RECORD.pack(timestamp, len(data)) + "".join([chr(b) for b in data])
+        self.lock.acquire()
+        try:
+            self.f.write(record)
+            self.f.flush()
+            self.count += 1
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self.f.close()
+        finally:
+            self.lock.release()
+#end of class
+
+
+def read_trace(fname):
+    """ Returns a generator of (time, data) for each read in a trace file (data is a tuple of ints like interruptRead returns) """
+    f = open(fname, "rb")
+    try:
+        if os.fstat(f.fileno()).st_size < len(HEADER):
+            raise ValueError("%s is not a CM19a trace file" % fname)
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+    try:
+        if buf[:len(HEADER)] != HEADER:
+            raise ValueError("%s is not a CM19a trace file" % fname)
+        offset = len(HEADER)
+        end = len(buf)
+        while offset + RECORD.size <= end:
+            timestamp, length = RECORD.unpack_from(buf, offset)
+            offset += RECORD.size
+            if offset + length > end:
+                # incomplete record at the end of the file (eg still being written)
+                break
+            yield timestamp, struct.unpack_from("%dB" % length, buf, offset)
+            offset += length
+    finally:
+        buf.close()
+
+
+class TraceHandle:
+    """
+        Stands in for the CM19a device handle and returns the reads from a trace
+        Anything written is acknowledged (as the CM19a does) but not sent anywhere
+        If 'realtime' is True the reads are returned with the same timing as they were captured
+        At the end of the trace 'finished' is set and every read times out (as a CM19a with nothing to read does)
+        so the driver does not count it as a USB error
+    """
+
+    ACK = (0x0FF,)
+
+    def __init__(self, fname, realtime=False):
+        self.trace = read_trace(fname)
+        self.realtime = realtime
+        self.start = None               # (time the replay started, time of the first read in the trace)
+        self.acks = 0                   # ACKs waiting to be read
+        self.finished = False           # True when every read in the trace has been returned
+        self.reads = 0
+        self.writes = 0
+
+    def interruptRead(self, endpoint, size, timeout):
+        if self.acks:
+            self.acks -= 1
+            return self.ACK
+        try:
+            timestamp, data = self.trace.next()
+        except StopIteration:
+            if self.finished:
+                # (a receive thread is still reading so wait as long as a read of the CM19a would)
+                time.sleep(timeout / 1000.0)
+            self.finished = True
+            raise IOError(errno.ETIMEDOUT, "End of trace")
+        if self.realtime:
+            if self.start is None:
+                self.start = (time.time(), timestamp)
+            delay = (timestamp - self.start[1]) - (time.time() - self.start[0])
+            if delay > 0:
+                time.sleep(delay)
+        self.reads += 1
+        return data
+
+    def interruptWrite(self, endpoint, buffer, timeout):
+        self.writes += 1
+        self.acks += 1
+        return len(buffer)
+
+    def releaseInterface(self):
+        pass
+#end of class
+
+
+def replay(fname, realtime=False, log=None):
+    """
+        Replays a trace through the driver's receive path
+        Returns (number of reads, number of commands received, seconds taken)
+    """
+    import cm19adriver
+
+    if not log:
+        log = logging.getLogger("CM19a replay")
+        log.addHandler(logging.StreamHandler(sys.stderr))
+        log.setLevel(logging.WARNING)
+
+    handle = TraceHandle(fname, realtime)
+    cm19a = cm19adriver.CM19aDevice(0, log, polling=False, handle=handle)
+    if not cm19a.initialised:
+        return 0, 0, 0.0
+
+    received = 0
+    start = time.time()
+    while not handle.finished:
+        if cm19a.receive():
+            received += 1
+    elapsed = time.time() - start
+    cm19a.finish()
+    return handle.reads, received, elapsed
+
+
+#Main
+if __name__ == '__main__':
+    if len(sys.argv) <= 1:
+        print "Usage: cm19atrace.py tracefile [realtime]"
+        sys.exit(2)
+
+    reads, received, elapsed = replay(sys.argv[1], len(sys.argv) > 2 and sys.argv[2].lower() == 'realtime')
+    print "%d reads replayed, %d commands received in %.3f seconds" % (reads, received, elapsed)
+    if elapsed > 0:
+        print "%.0f reads per second" % (reads / elapsed)
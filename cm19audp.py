@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+"""
+A UDP command listener for the CM19a driver (see cm19adriver.py)
+For fire-and-forget senders (eg motion sensors and button bridges) that want a command sent as soon as possible:
+there is no connection to set up and no HTTP headers to parse, one datagram can carry many commands
+and they are sent as one batch (CM19aDevice.sendBatch, the same send path as a POST to the HTTP server)
+
+Set UDP_PORT in cm19adriver.py to start the listener with the HTTP server
+
+Datagrams (ASCII)
+    A1ON                        Sends A1 ON, nothing is sent back
+    A1ON A2OFF,B1DIM            Several commands separated by spaces, commas, semicolons or newlines
+    #42 A1ON A2OFF              A sequence number (# then up to 10 digits) asks for an acknowledgement datagram:
+                                    #42 ACK                     every command was sent
+                                    #42 NAK A2OFF ...           the commands that failed (or were not valid)
+
+    python cm19audp.py 192.168.1.3:8009 A1ON A2OFF          Sends the commands and waits for the acknowledgement
+"""
+
+import sys, time, socket, threading, itertools, re
+
+MAX_DATAGRAM = 1472         # Largest datagram read (fits in one Ethernet frame)
+SEPARATORS = re.compile(r"[\s,;]+")
+SEND_COMMANDS = ['ON', 'OFF', 'DIM', 'BRIGHT', 'ALLON', 'ALLOFF']
+
+
+class UDPListener(threading.Thread):
+    """ Receives command datagrams and sends the commands in them (see the module's doc) """
+
+    def __init__(self, address, cm19a, log):
+        threading.Thread.__init__(self, name="CM19a UDP listener")
+        self.setDaemon(True)
+        self.cm19a = cm19a
+        self.log = log
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(address)
+        self.socket.settimeout(0.5)     # recvfrom() returns after this many seconds so run() can check alive
+        self.alive = True
+        self.datagrams = 0              # Datagrams received
+        self.commands = 0               # Commands sent
+        self.invalid = 0                # Commands that were not valid
+
+    def run(self):
+        while self.alive:
+            try:
+                data, sender = self.socket.recvfrom(MAX_DATAGRAM)
+            except socket.timeout:
+                continue
+            except socket.error, err:
+                if self.alive:
+                    self.log.error("UDP listener: %s" % err)
+                    time.sleep(0.5)
+                continue
+            self.datagrams += 1
+            try:
+                self.process(data, sender)
+            except Exception, err:
+                self.log.error("UDP listener: could not process %r from %s: %s" % (data[:64], sender[0], err))
+        #end while
+        self.socket.close()
+
+    def process(self, data, sender):
+        """ Sends the commands in a datagram and acknowledges them if it has a sequence number """
+        items = [item for item in SEPARATORS.split(data.strip()) if item]
+        seq = None
+        if items and items[0].startswith('#'):
+            seq = items.pop(0)[1:11]
+
+        batch = []
+        failed = []
+        for item in items:
+            command = self.cm19a.lookup(item)
+            if command and command[2].upper() in SEND_COMMANDS:
+                batch.append(command)
+            else:
+                failed.append(item)
+                self.invalid += 1
+        #end for
+        if failed:
+            self.log.warning("UDP listener: invalid commands from %s: %s" % (sender[0], " ".join(failed)))
+
+        if batch:
+            self.commands += len(batch)
+            for (house, unit, function), (ok, seconds) in zip(batch, self.cm19a.sendBatch(batch)):
+                if not ok:
+                    failed.append("%s%s%s" % (house, unit, function))
+
+        if seq is not None:
+            if failed:
+                reply = "#%s NAK %s" % (seq, " ".join(failed))
+            else:
+                reply = "#%s ACK" % seq
+            try:
+                self.socket.sendto(reply[:MAX_DATAGRAM], sender)
+            except socket.error, err:
+                self.log.warning("UDP listener: could not acknowledge #%s to %s: %s" % (seq, sender[0], err))
+
+    def stop(self, timeout=5):
+        """ Stops listening (a datagram being sent is finished first, waits up to 'timeout' seconds) """
+        self.alive = False
+        if self.isAlive():
+            self.join(timeout)
+
+    def status(self):
+        return {'datagrams': self.datagrams, 'commands': self.commands, 'invalid': self.invalid}
+#end of class
+
+
+_sequence = itertools.count(1)
+
+def send(address, commands, timeout=2.0, acknowledge=True):
+    """
+        Sends commands (eg ["A1ON", "A2OFF"]) to a UDP listener at 'address' (host, port) in one datagram
+        Returns True if every command was sent, False if any failed, or None if no acknowledgement came within 'timeout' seconds
+        (or if 'acknowledge' is False, in which case nothing is waited for)
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        if not acknowledge:
+            sock.sendto(" ".join(commands), address)
+            return None
+        seq = str(_sequence.next())
+        sock.sendto("#%s %s" % (seq, " ".join(commands)), address)
+        sock.settimeout(timeout)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                reply = sock.recv(MAX_DATAGRAM).split()
+            except socket.timeout:
+                break
+            if reply and reply[0] == "#" + seq:
+                return len(reply) > 1 and reply[1] == "ACK"
+        return None
+    finally:
+        sock.close()
+
+
+#Main
+if __name__ == '__main__':
+    if len(sys.argv) <= 2 or ':' not in sys.argv[1]:
+        print "Usage: cm19audp.py host:port command [command...]     e.g. cm19audp.py 192.168.1.3:8009 A1ON A2OFF"
+        sys.exit(2)
+
+    host, port = sys.argv[1].rsplit(':', 1)
+    result = send((host, int(port)), sys.argv[2:])
+    print {True: "ACK", False: "NAK", None: "No acknowledgement"}[result]
+    sys.exit(int(not result))
@@ -1,11 +1,13 @@
 #!/bin/python
 
-import logging,  datetime
+import logging,  logging.handlers,  datetime, os
 
 #LOG_FILENAME = 'AVC_deviceManager.log'
 
-def start_logging(modulename = 'main',  logfilename = "pythonlogger.log",  display = "N"):
+def start_logging(modulename = 'main',  logfilename = "pythonlogger.log",  display = "N", maxbytes = 0, backups = 5):
     """Starts the logging service an returns the logging instance
+        The log is appended to (so it survives a restart) and rotated when it reaches 'maxbytes'
+        keeping 'backups' old logs (eg pythonlogger.log.1), a 'maxbytes' of 0 means it is never rotated
         LEVELS:
             logging.DEBUG,
             logging.INFO,
@@ -14,13 +16,46 @@ def start_logging(modulename = 'main',  logfilename = "pythonlogger.log",  displ
             logging.CRITICAL}
     """
 
-    logging.basicConfig(filename = logfilename, filemode = "w",
-                    level = logging.DEBUG,
-                    format = '%(asctime)s, %(levelname)s, %(message)s', 
-                    datefmt = '%a %d %b %Y %H:%M:%S')
+    if maxbytes:
+        if not _has_handler(logging.getLogger(), logfilename):
+            # (only once, like basicConfig, however many times logging is started)
+            handler = logging.handlers.RotatingFileHandler(logfilename, maxBytes = maxbytes, backupCount = backups)
+            handler.setFormatter(logging.Formatter('%(asctime)s, %(levelname)s, %(message)s', '%a %d %b %Y %H:%M:%S'))
+            logging.getLogger().addHandler(handler)
+        logging.getLogger().setLevel(logging.DEBUG)
+    else:
+        logging.basicConfig(filename = logfilename, filemode = "a",
+                        level = logging.DEBUG,
+                        format = '%(asctime)s, %(levelname)s, %(message)s', 
+                        datefmt = '%a %d %b %Y %H:%M:%S')
 
     logger = logging.getLogger(modulename)
     now = datetime.datetime.now().strftime('%Y-%m-%d_%H%M%S')
     logger.info('---- Starting logging at: %s ----' % now)
 
     return logger
+
+
+def start_trace_log(logfilename = "trace.log", maxbytes = 0, backups = 5):
+    """Returns a logger that writes only to its own file (eg the stage timings of each command) and not to the main log"""
+    logger = logging.getLogger("trace")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    if _has_handler(logger, logfilename):
+        return logger
+    if maxbytes:
+        handler = logging.handlers.RotatingFileHandler(logfilename, maxBytes = maxbytes, backupCount = backups)
+    else:
+        handler = logging.FileHandler(logfilename, mode = "a")
+    handler.setFormatter(logging.Formatter('%(asctime)s.%(msecs)03d, %(message)s', '%a %d %b %Y %H:%M:%S'))
+    logger.addHandler(handler)
+    return logger
+
+
+def _has_handler(logger, logfilename):
+    # True if the logger already writes to the file
+    fname = os.path.abspath(logfilename)
+    for handler in logger.handlers:
+        if getattr(handler, 'baseFilename', None) == fname:
+            return True
+    return False
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+"""Tests for the send path: matching the CM19a's ACKs to the sends waiting for them (CM19aDevice._write_frame and friends) and tracing"""
+
+import sys, os, time, errno, threading, logging, unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import cm19adriver
+
+
+class ScriptedHandle:
+    """
+        Stands in for the CM19a and acknowledges each write after the delay (ms) given for it in 'delays'
+        (None = never acknowledged, writes past the end of the list are never acknowledged either)
+    """
+
+    def __init__(self, delays=()):
+        self.delays = list(delays)
+        self.acks = []                  # When each ACK is due
+        self.received = []              # Frames to return from the next reads (as if sent by a remote)
+        self.stuck = None               # Set to an Event to make the next read block until it is set
+        self.failwrites = 0             # Number of writes to fail (before any is written)
+        self.writes = 0
+        self.claims = 0
+
+    def ack(self, delay=0):
+        self.acks.append(time.time() + delay / 1000.0)
+        self.acks.sort()
+
+    def interruptWrite(self, endpoint, buffer, timeout):
+        if self.failwrites:
+            self.failwrites -= 1
+            raise IOError(errno.EIO, "Input/output error")
+        if self.writes < len(self.delays) and self.delays[self.writes] is not None:
+            self.ack(self.delays[self.writes])
+        self.writes += 1
+        return len(buffer)
+
+    def readinto(self, buffer, timeout):
+        stuck, self.stuck = self.stuck, None
+        if stuck:
+            stuck.wait()
+        if self.received:
+            frame = self.received.pop(0)
+            buffer[:len(frame)] = frame
+            return len(frame)
+        if self.acks and self.acks[0] <= time.time():
+            self.acks.pop(0)
+            buffer[0] = 0xFF
+            return 1
+        time.sleep(0.001)
+        raise IOError(errno.ETIMEDOUT, "Operation timed out")
+
+    def releaseInterface(self):
+        pass
+
+    def claimInterface(self, interface):
+        self.claims += 1
+
+    def setAltInterface(self, alternate):
+        pass
+#end of class
+
+
+class AckTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        os.chdir(ROOT)                  # (the driver reads CM19aProtocol.ini from the current directory)
+        self.log = logging.getLogger("test")
+        self.log.addHandler(logging.NullHandler())
+        self.log.propagate = False
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+
+    def device(self, handle):
+        cm19a = cm19adriver.CM19aDevice(0, self.log, polling=False, handle=handle)
+        cm19a.ACK_TIMEOUT = 50
+        cm19a.RETRY_BACKOFF = 5
+        return cm19a
+
+    def assertSlotsFree(self, cm19a):
+        # Every slot is free and nothing is waiting for an ACK
+        self.assertEqual(len(cm19a.pending), 0)
+        for i in range(cm19a.MAX_OUTSTANDING):
+            self.assertTrue(cm19a.outstanding.acquire(False))
+        for i in range(cm19a.MAX_OUTSTANDING):
+            cm19a.outstanding.release()
+
+    def test_acknowledged_send(self):
+        handle = ScriptedHandle([0])
+        cm19a = self.device(handle)
+        self.assertTrue(cm19a.send('A', '1', 'ON'))
+        self.assertEqual(handle.writes, 1)
+        self.assertSlotsFree(cm19a)
+
+    def test_late_ack_is_not_matched_to_a_retry(self):
+        # The first write is acknowledged after ACK_TIMEOUT and the retries never are,
+        # so the late ACK must not be taken as the ACK for a retry
+        handle = ScriptedHandle([75])
+        cm19a = self.device(handle)
+        self.assertFalse(cm19a.send('A', '1', 'ON'))
+        self.assertEqual(handle.writes, cm19a.SEND_RETRIES + 1)
+        self.assertTrue(cm19a.resyncs >= 1)
+        self.assertSlotsFree(cm19a)
+
+    def test_dim_is_not_resent(self):
+        # The DIM may have reached the module with only the ACK lost: sending it again would dim twice
+        handle = ScriptedHandle()
+        cm19a = self.device(handle)
+        self.assertFalse(cm19a.send('A', '1', 'DIM'))
+        self.assertEqual(handle.writes, 1)
+        self.assertSlotsFree(cm19a)
+
+    def test_dim_is_not_resent_in_a_batch(self):
+        handle = ScriptedHandle([0, None])
+        cm19a = self.device(handle)
+        results = cm19a.sendBatch([('A', '2', 'ON'), ('A', '1', 'BRIGHT')])
+        self.assertEqual([ok for ok, seconds in results], [True, False])
+        self.assertEqual(handle.writes, 2)
+        self.assertSlotsFree(cm19a)
+
+    def test_failed_dim_write_is_retried(self):
+        # nothing reached the module so the DIM can be written again
+        handle = ScriptedHandle([0])
+        handle.failwrites = 1
+        cm19a = self.device(handle)
+        self.assertTrue(cm19a.send('A', '1', 'DIM'))
+        self.assertEqual(handle.writes, 1)
+
+    def test_late_ack_in_a_batch(self):
+        # A1ON's ACK is late, the other two are never acknowledged: the late ACK must not be given to B2OFF
+        handle = ScriptedHandle([75])
+        cm19a = self.device(handle)
+        results = cm19a.sendBatch([('A', '1', 'ON'), ('B', '2', 'OFF'), ('C', '3', 'ON')])
+        self.assertEqual([ok for ok, seconds in results], [False, False, False])
+        self.assertSlotsFree(cm19a)
+
+    def test_stray_ack_is_discarded(self):
+        # An ACK with no send waiting is thrown away rather than kept for the next send
+        handle = ScriptedHandle()
+        cm19a = self.device(handle)
+        handle.ack()
+        cm19a.receive()
+        self.assertFalse(cm19a.send('A', '1', 'ON'))
+        self.assertSlotsFree(cm19a)
+
+    def test_no_free_slot(self):
+        handle = ScriptedHandle()
+        cm19a = self.device(handle)
+        for i in range(cm19a.MAX_OUTSTANDING):
+            cm19a.outstanding.acquire()
+        start = time.time()
+        self.assertEqual(cm19a._write_pending(cm19a._encode('A', '1', 'ON')), None)
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(handle.writes, 0)
+
+    def test_recovery_abandons_the_sends_waiting(self):
+        handle = ScriptedHandle()
+        cm19a = self.device(handle)
+        pending = cm19a._write_pending(cm19a._encode('A', '1', 'ON'))
+        self.assertEqual(len(cm19a.pending), 1)
+        self.assertTrue(cm19a._recover('_reclaim_interface'))
+        self.assertTrue(pending.abandoned)
+        self.assertFalse(cm19a._wait_for_ack(pending))
+        self.assertSlotsFree(cm19a)
+
+    def test_recovery_with_a_stuck_read(self):
+        # A read that never returns holds the read lock: the recovery step still runs and sends still work
+        handle = ScriptedHandle()
+        cm19a = self.device(handle)
+        cm19a.RECOVERY_LOCK_WAIT = 0.1
+        stuck = handle.stuck = threading.Event()
+        reader = threading.Thread(target=cm19a.receive)
+        reader.setDaemon(True)
+        reader.start()
+        time.sleep(0.05)
+        self.assertTrue(reader.isAlive())
+
+        watchdog = cm19adriver.Watchdog(cm19a)
+        watchdog.recover()
+        self.assertEqual(handle.claims, 1)
+        self.assertEqual(watchdog.lastrecovery[1:], ("reclaim interface", True))
+
+        handle.delays = [None] * handle.writes + [0]      # (acknowledge the send, not the writes initialising the remotes)
+        start = time.time()
+        self.assertTrue(cm19a.send('A', '1', 'ON'))
+        self.assertTrue(time.time() - start < 1)
+
+        # the stuck read finishing later releases its own (old) lock
+        stuck.set()
+        reader.join(1)
+        self.assertFalse(reader.isAlive())
+        self.assertTrue(cm19a.send('A', '1', 'ON') is not None)
+
+    def test_rule_sends_are_not_in_the_trace(self):
+        # A4ON is received while E1ON is being sent: the macro it fires is sent on the same thread
+        # but its stages must not be timed as part of E1ON
+        handle = ScriptedHandle([0, 0])
+        cm19a = self.device(handle)
+        cm19a.rules.add("A4ON", ["B 2 OFF"])
+        handle.received.append(cm19a.protocol.commands["A4ON"].buffer)
+        result, stages = cm19a.sendTraced('E', '1', 'ON', "test")
+        self.assertTrue(result)
+        self.assertEqual(handle.writes, 2)
+        self.assertEqual([stage for stage, ms in stages], ['encode', 'flush', 'slot', 'write', 'ack', 'record', 'done'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the HTTP server's request handling (cm19ahttp.py)"""
+
+import sys, os, errno, time, logging, unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import cm19adriver, cm19ahttp
+
+
+class IdleHandle:
+    """ Stands in for a CM19a with nothing to read """
+
+    def readinto(self, buffer, timeout):
+        raise IOError(errno.ETIMEDOUT, "Operation timed out")
+
+    def interruptWrite(self, endpoint, buffer, timeout):
+        return len(buffer)
+
+    def releaseInterface(self):
+        pass
+#end of class
+
+
+class Server:
+    def __init__(self, cm19a):
+        self.cm19a = cm19a
+
+
+class Handler(cm19ahttp.HTTPhandler):
+    # Just enough of a handler to call its methods without a connection
+    def __init__(self, server):
+        self.server = server
+
+
+class ParseCommandTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        os.chdir(ROOT)                  # (the driver reads CM19aProtocol.ini from the current directory)
+        log = logging.getLogger("test")
+        log.addHandler(logging.NullHandler())
+        log.propagate = False
+        self.cm19a = cm19adriver.CM19aDevice(0, log, polling=False, handle=IdleHandle())
+        self.handler = Handler(Server(self.cm19a))
+
+    def tearDown(self):
+        self.cm19a.finish()
+        os.chdir(self.cwd)
+
+    def test_string(self):
+        self.assertEqual(self.handler.parseCommand("A1ON"), ('A', '1', 'ON'))
+        self.assertEqual(self.handler.parseCommand(u"b 2 off"), ('B', '2', 'OFF'))
+
+    def test_dict(self):
+        self.assertEqual(self.handler.parseCommand({'house': 'c', 'unit': 3, 'command': 'dim'}), ('C', '3', 'DIM'))
+
+    def test_not_a_send_command(self):
+        self.assertEqual(self.handler.parseCommand("A0BRIGHTBUTTONPRESSED"), None)
+        self.assertEqual(self.handler.parseCommand("XYZ"), None)
+        self.assertEqual(self.handler.parseCommand(42), None)
+
+    def test_not_ascii(self):
+        self.assertEqual(self.handler.parseCommand(u"A1ÖN"), None)
+        self.assertEqual(self.handler.parseCommand({'house': u"Ö", 'unit': 1, 'command': 'ON'}), None)
+
+
+class AdmissionControlTest(unittest.TestCase):
+
+    def test_no_rate_is_no_limit(self):
+        admission = cm19ahttp.AdmissionControl()
+        for i in range(1000):
+            self.assertEqual(admission.admit("10.0.0.1"), 0)
+        self.assertEqual(admission.maxBatch(), 0)
+
+    def test_burst_then_refused(self):
+        admission = cm19ahttp.AdmissionControl(rate=2, burst=5)
+        for i in range(5):
+            self.assertEqual(admission.admit("10.0.0.1"), 0)
+        wait = admission.admit("10.0.0.1")
+        self.assertTrue(0.4 < wait <= 0.5, wait)
+        self.assertEqual(admission.status()['ratelimited'], 1)
+        # each client has its own bucket
+        self.assertEqual(admission.admit("10.0.0.2"), 0)
+
+    def test_refill(self):
+        admission = cm19ahttp.AdmissionControl(rate=2, burst=5)
+        for i in range(5):
+            admission.admit("10.0.0.1")
+        admission.buckets["10.0.0.1"][1] -= 1.0       # a second has gone by
+        self.assertEqual(admission.admit("10.0.0.1", 2), 0)
+        self.assertNotEqual(admission.admit("10.0.0.1"), 0)
+
+    def test_largest_batch(self):
+        admission = cm19ahttp.AdmissionControl(rate=2, burst=5)
+        self.assertEqual(admission.maxBatch(), 5)
+        # a POST is charged 1 for the request and then 1 for each command after the first
+        self.assertEqual(admission.admit("10.0.0.1"), 0)
+        self.assertEqual(admission.admit("10.0.0.1", admission.maxBatch() - 1), 0)
+
+    def test_burst_is_at_least_the_rate(self):
+        admission = cm19ahttp.AdmissionControl(rate=10, burst=0)
+        self.assertEqual(admission.maxBatch(), 10)
+
+    def test_sends_in_progress(self):
+        admission = cm19ahttp.AdmissionControl(maxsends=2)
+        self.assertTrue(admission.startSend())
+        self.assertTrue(admission.startSend())
+        self.assertFalse(admission.startSend())
+        admission.endSend()
+        self.assertTrue(admission.startSend())
+        self.assertEqual(admission.status()['overloaded'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
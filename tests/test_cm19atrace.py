@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+"""Tests for the capture and replay of raw reads (cm19atrace.py)"""
+
+import sys, os, tempfile, shutil, logging, unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import cm19adriver, cm19atrace
+
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        os.chdir(ROOT)                  # (the driver reads CM19aProtocol.ini from the current directory)
+        self.directory = tempfile.mkdtemp()
+        self.log = logging.getLogger("test")
+        self.log.addHandler(logging.NullHandler())
+        self.log.propagate = False
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def write_trace(self, commands):
+        # Writes a trace of the frames for 'commands' (eg A1ON) and returns its file name
+        fname = os.path.join(self.directory, "test.trace")
+        writer = cm19atrace.TraceWriter(fname)
+        cm19a = cm19adriver.CM19aDevice(0, self.log, polling=False, handle=cm19atrace.TraceHandle(fname))
+        for command in commands:
+            writer.write(cm19a.protocol.commands[command].buffer)
+        writer.close()
+        cm19a.finish()
+        return fname
+
+    def test_replay_decodes_every_read(self):
+        fname = self.write_trace(["A1ON", "B2OFF", "C3ON"])
+        handle = cm19atrace.TraceHandle(fname)
+        cm19a = cm19adriver.CM19aDevice(0, self.log, polling=False, handle=handle)
+        received = []
+        while not handle.finished:
+            command = cm19a.receive()
+            if command:
+                received.append(command)
+        cm19a.finish()
+        self.assertEqual(received, ["A1ON", "B2OFF", "C3ON"])
+
+    def test_end_of_trace_is_not_a_read_error(self):
+        fname = self.write_trace(["A1ON"])
+        handle = cm19atrace.TraceHandle(fname)
+        cm19a = cm19adriver.CM19aDevice(0, self.log, polling=False, handle=handle)
+        for i in range(3):
+            cm19a.receive()
+        cm19a.finish()
+        self.assertTrue(handle.finished)
+        self.assertEqual(cm19a.readerrors, 0)
+        self.assertEqual(cm19a.errorrun, 0)
+        self.assertEqual(cm19a.readtimeouts, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+"""Tests for starting the driver's logs (logger.py)"""
+
+import sys, os, tempfile, shutil, logging, unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import logger
+
+
+class StartLoggingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fname = os.path.join(self.directory, "test.log")
+        # start each test with no handlers on the root logger (basicConfig does nothing if there are any)
+        self.root = logging.getLogger()
+        self.handlers = self.root.handlers[:]
+        self.level = self.root.level
+        for handler in self.handlers:
+            self.root.removeHandler(handler)
+
+    def tearDown(self):
+        for handler in self.root.handlers[:]:
+            handler.close()
+            self.root.removeHandler(handler)
+        for handler in self.handlers:
+            self.root.addHandler(handler)
+        self.root.setLevel(self.level)
+        shutil.rmtree(self.directory)
+
+    def handlersFor(self, logger):
+        return [handler for handler in logger.handlers if getattr(handler, 'baseFilename', None) == os.path.abspath(self.fname)]
+
+    def test_default_is_not_rotated(self):
+        log = logger.start_logging("test_logger", self.fname)
+        log.info("hello")
+        self.assertEqual(len(self.handlersFor(self.root)), 1)
+        self.assertFalse(isinstance(self.handlersFor(self.root)[0], logging.handlers.RotatingFileHandler))
+        self.assertTrue("hello" in open(self.fname).read())
+
+    def test_rotating_handler_added_once(self):
+        logger.start_logging("test_logger", self.fname, maxbytes=1024)
+        log = logger.start_logging("test_logger", self.fname, maxbytes=1024)
+        log.info("hello")
+        handlers = self.handlersFor(self.root)
+        self.assertEqual(len(handlers), 1)
+        self.assertTrue(isinstance(handlers[0], logging.handlers.RotatingFileHandler))
+        self.assertEqual(open(self.fname).read().count("hello"), 1)
+
+
+class StartTraceLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fname = os.path.join(self.directory, "trace.log")
+
+    def tearDown(self):
+        trace = logging.getLogger("trace")
+        for handler in trace.handlers[:]:
+            handler.close()
+            trace.removeHandler(handler)
+        shutil.rmtree(self.directory)
+
+    def test_handler_added_once(self):
+        logger.start_trace_log(self.fname, 1024)
+        trace = logger.start_trace_log(self.fname, 1024)
+        trace.info("A1 ON")
+        self.assertEqual(len(trace.handlers), 1)
+        self.assertEqual(open(self.fname).read().count("A1 ON"), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
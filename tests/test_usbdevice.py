@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+"""Tests for finding the CM19a through sysfs (cm19adriver.find_devices and USBdevice)"""
+
+import sys, os, tempfile, shutil, unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import cm19adriver
+
+VENDOR_ID = cm19adriver.CM19aDevice.VENDOR_ID
+PRODUCT_ID = cm19adriver.CM19aDevice.PRODUCT_ID
+
+
+class Busses:
+    """ Stands in for the usb module and counts the slow searches of every bus """
+
+    def __init__(self):
+        self.searches = 0
+
+    def busses(self):
+        self.searches += 1
+        return []
+#end of class
+
+
+class FindDeviceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.sysfs = os.path.join(self.directory, "devices")
+        os.mkdir(self.sysfs)
+        self.saved = cm19adriver.SYSFS_USB_DEVICES, cm19adriver.usb
+        cm19adriver.SYSFS_USB_DEVICES = self.sysfs
+        cm19adriver.usb = self.usb = Busses()
+        self.add("usb1", 0x1d6b, 0x0002, 1, 1)          # a root hub
+        self.add("1-1:1.0")                             # an interface
+
+    def tearDown(self):
+        cm19adriver.SYSFS_USB_DEVICES, cm19adriver.usb = self.saved
+        shutil.rmtree(self.directory)
+
+    def add(self, port, vendor=None, product=None, busnum=None, devnum=None):
+        path = os.path.join(self.sysfs, port)
+        os.mkdir(path)
+        for name, value in [("idVendor", vendor), ("idProduct", product)]:
+            if value is not None:
+                open(os.path.join(path, name), "w").write("%04x\n" % value)
+        for name, value in [("busnum", busnum), ("devnum", devnum)]:
+            if value is not None:
+                open(os.path.join(path, name), "w").write("%d\n" % value)
+
+    def test_found_in_sysfs(self):
+        self.add("1-1.2", VENDOR_ID, PRODUCT_ID, 1, 5)
+        self.add("2-1", VENDOR_ID, PRODUCT_ID, 2, 3)
+        self.assertEqual(cm19adriver.find_devices(VENDOR_ID, PRODUCT_ID), [("1-1.2", 1, 5), ("2-1", 2, 3)])
+
+    def test_not_plugged_in(self):
+        # sysfs lists the USB devices and none is a CM19a: the busses are not searched
+        self.assertEqual(cm19adriver.find_devices(VENDOR_ID, PRODUCT_ID), [])
+        device = cm19adriver.USBdevice(VENDOR_ID, PRODUCT_ID)
+        self.assertEqual(device.device, None)
+        self.assertEqual(self.usb.searches, 0)
+
+    def test_no_sysfs(self):
+        # (eg not Linux) the busses are searched
+        cm19adriver.SYSFS_USB_DEVICES = os.path.join(self.directory, "missing")
+        self.assertEqual(cm19adriver.find_devices(VENDOR_ID, PRODUCT_ID), None)
+        device = cm19adriver.USBdevice(VENDOR_ID, PRODUCT_ID)
+        self.assertEqual(device.device, None)
+        self.assertEqual(self.usb.searches, 1)
+
+    def test_empty_sysfs(self):
+        # not even a root hub listed so sysfs cannot be relied on
+        shutil.rmtree(self.sysfs)
+        os.mkdir(self.sysfs)
+        self.assertEqual(cm19adriver.find_devices(VENDOR_ID, PRODUCT_ID), None)
+
+
+if __name__ == '__main__':
+    unittest.main()